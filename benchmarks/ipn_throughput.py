@@ -0,0 +1,304 @@
+"""Measure how many IPNs per second the MB Bank and MoMo webhooks sustain.
+
+The script signs every notification of a load profile beforehand, then posts them to
+/payment/mbbank/ipn or /payment/momo/ipn at the profile's rate and concurrency, and reports
+the p50/p95/p99 latency, the throughput and, given --dsn of a database with the
+pg_stat_statements extension, the SQL queries per notification. The notifications mix
+success, pending, cancel and system-error codes; with a redelivery ratio, part of them are
+sent twice like the gateways do.
+
+Each run is appended as one JSON line to --output, with the git revision and the module
+version, and compared with the previous run of the same gateway and profile.
+
+Usage:
+    python benchmarks/ipn_throughput.py --gateway mbbank --hash-secret SECRET --profile steady \\
+        --url http://localhost:8069 --dsn "dbname=odoo"
+    python benchmarks/ipn_throughput.py --gateway momo --access-key KEY --secret-key SECRET --profile burst
+
+Run Odoo with --max-cron-threads=0 so that the query counts only cover the webhook, and with
+--workers matching the worker count to measure.
+"""
+import argparse
+import http.client
+import importlib.util
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IPN_PATHS = {
+    'mbbank': "/payment/mbbank/ipn",
+    'momo': "/payment/momo/ipn",
+}
+
+# Tỷ lệ các mã kết quả: thành công, đang xử lý, huỷ, lỗi hệ thống
+CODE_MIXES = {
+    'mbbank': {'00': 0.7, '12': 0.1, '18': 0.1, '92': 0.1},
+    'momo': {0: 0.7, 1000: 0.1, 1006: 0.1, 99: 0.1},
+}
+
+# rate: notifications per second (0 = as fast as possible)
+PROFILES = {
+    'steady': {'rate': 50, 'concurrency': 8, 'count': 2000, 'redelivery_ratio': 0.0},
+    'burst': {'rate': 0, 'concurrency': 32, 'count': 2000, 'redelivery_ratio': 0.0},
+    'redelivery': {'rate': 0, 'concurrency': 16, 'count': 2000, 'redelivery_ratio': 0.5},
+}
+
+
+def _load_module(module, name):
+    path = os.path.join(ROOT, module, 'tools', 'signature.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    signature = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(signature)
+    return signature
+
+
+def build_mbbank_payloads(args, profile, rng, run_id):
+    signer = _load_module('mbbank_odoo', 'mbbank_signature').MBBankSigner(args.hash_secret)
+    codes, weights = zip(*CODE_MIXES['mbbank'].items())
+    payloads = []
+    for index in range(profile['count']):
+        notification = {
+            'merchant_id': args.merchant_id,
+            'pg_order_reference': f"PSQR{args.reference_prefix}{run_id}x{index}",
+            'pg_transaction_number': f"{run_id}{index:07d}",
+            'pg_issuer_txn_reference': f"FT{rng.randint(10 ** 9, 10 ** 10 - 1)}",
+            'pg_amount': rng.randint(1, 500) * 1000,
+            'error_code': rng.choices(codes, weights)[0],
+            'message': "Benchmark",
+            'mac_type': 'SHA256',
+        }
+        notification['mac'] = signer.sign(notification, 'SHA256')
+        payloads.append((notification['error_code'], json.dumps(notification).encode()))
+    return payloads
+
+
+def build_momo_payloads(args, profile, rng, run_id):
+    signature = _load_module('momo_odoo', 'momo_signature')
+    signer = signature.MoMoSigner(args.secret_key)
+    codes, weights = zip(*CODE_MIXES['momo'].items())
+    payloads = []
+    for index in range(profile['count']):
+        notification = {
+            'partnerCode': args.partner_code,
+            'orderId': f"{args.reference_prefix}{run_id}x{index}",
+            'requestId': f"{run_id}-{index}",
+            'amount': rng.randint(1, 500) * 1000,
+            'orderInfo': "Benchmark",
+            'orderType': 'momo_wallet',
+            'transId': int(f"{run_id}{index:07d}"),
+            'resultCode': rng.choices(codes, weights)[0],
+            'message': "Benchmark",
+            'payType': 'qr',
+            'responseTime': int(time.time() * 1000) + index,
+            'extraData': '',
+        }
+        signed = dict(notification, accessKey=args.access_key)
+        notification['signature'] = signer.sign("&".join(
+            f"{field}={signed[field]}" for field in signature.IPN_SIGNATURE_FIELDS if signed.get(field) is not None
+        ))
+        payloads.append((notification['resultCode'], json.dumps(notification).encode()))
+    return payloads
+
+
+def add_redeliveries(payloads, ratio, rng):
+    """Send a share of the notifications a second time, later in the run"""
+    redelivered = [payload for payload in payloads if rng.random() < ratio]
+    sequence = payloads + redelivered
+    rng.shuffle(sequence)
+    return sequence
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def count_queries(dsn):
+    """Total number of statements executed on the database, or None without pg_stat_statements"""
+    if not dsn:
+        return None
+    try:
+        import psycopg2
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cr:
+            cr.execute("""
+                SELECT sum(calls) FROM pg_stat_statements
+                 WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            """)
+            return int(cr.fetchone()[0] or 0)
+    except Exception as e:
+        print(f"Query counts unavailable: {e}")
+        return None
+
+
+def send_all(url, sequence, rate, concurrency, timeout):
+    """Post the payloads from `concurrency` keep-alive connections, paced at `rate` per second"""
+    target = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+    path = target.path
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies, statuses = [], Counter()
+    start = time.perf_counter()
+
+    def worker():
+        connection = connection_class(target.netloc, timeout=timeout)
+        while True:
+            with lock:
+                index = next(counter)
+            if index >= len(sequence):
+                break
+            if rate:
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            code, body = sequence[index]
+            sent = time.perf_counter()
+            try:
+                connection.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except Exception as e:
+                status = type(e).__name__
+                connection.close()
+                connection = connection_class(target.netloc, timeout=timeout)
+            elapsed = (time.perf_counter() - sent) * 1000
+            with lock:
+                latencies.append((code, elapsed))
+                statuses[status] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - start
+
+
+def summarize(latencies, statuses, duration, queries):
+    values = sorted(elapsed for _code, elapsed in latencies)
+    by_code = {}
+    for code in sorted({code for code, _elapsed in latencies}, key=str):
+        code_values = sorted(elapsed for c, elapsed in latencies if c == code)
+        by_code[str(code)] = {'count': len(code_values), 'p50_ms': percentile(code_values, 0.5)}
+    return {
+        'sent': len(values),
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'duration_s': duration,
+        'throughput_per_s': len(values) / duration if duration else None,
+        'p50_ms': percentile(values, 0.5),
+        'p95_ms': percentile(values, 0.95),
+        'p99_ms': percentile(values, 0.99),
+        'max_ms': values[-1] if values else None,
+        'queries_per_notification': queries / len(values) if queries is not None and values else None,
+        'by_code': by_code,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def module_version(gateway):
+    with open(os.path.join(ROOT, f'{gateway}_odoo', '__manifest__.py')) as f:
+        return eval(f.read()).get('version')
+
+
+def previous_run(output, gateway, profile_name):
+    if not os.path.exists(output):
+        return None
+    previous = None
+    with open(output) as f:
+        for line in f:
+            run = json.loads(line)
+            if run['gateway'] == gateway and run['profile'] == profile_name:
+                previous = run
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--gateway', choices=sorted(IPN_PATHS), required=True)
+    parser.add_argument('--url', default='http://localhost:8069', help="base URL of the Odoo server")
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='steady')
+    parser.add_argument('--rate', type=float, help="override the notifications per second of the profile")
+    parser.add_argument('--concurrency', type=int, help="override the concurrency of the profile")
+    parser.add_argument('--count', type=int, help="override the notification count of the profile")
+    parser.add_argument('--seed', type=int, default=42, help="seed of the code mix and redeliveries")
+    parser.add_argument('--reference-prefix', default='BENCH', help="prefix of the order references")
+    parser.add_argument('--hash-secret', help="MB Bank hash secret of the provider")
+    parser.add_argument('--merchant-id', default='', help="MB Bank merchant id of the provider")
+    parser.add_argument('--partner-code', default='MOMO', help="MoMo partner code of the provider")
+    parser.add_argument('--access-key', help="MoMo access key of the provider")
+    parser.add_argument('--secret-key', help="MoMo secret key of the provider")
+    parser.add_argument('--dsn', help="libpq connection string of the Odoo database, to count queries")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'benchmarks', 'results', 'ipn_throughput.jsonl'),
+                        help="JSON lines file receiving the results")
+    args = parser.parse_args()
+
+    if args.gateway == 'mbbank' and not args.hash_secret:
+        parser.error("--hash-secret is required for mbbank")
+    if args.gateway == 'momo' and not (args.access_key and args.secret_key):
+        parser.error("--access-key and --secret-key are required for momo")
+
+    profile = dict(PROFILES[args.profile])
+    for key in ('rate', 'concurrency', 'count'):
+        if getattr(args, key) is not None:
+            profile[key] = getattr(args, key)
+
+    # Cùng seed cho cùng chuỗi mã kết quả; run_id giữ các tham chiếu duy nhất giữa các lần chạy
+    rng = random.Random(args.seed)
+    run_id = int(time.time()) % 10 ** 6
+    build = build_mbbank_payloads if args.gateway == 'mbbank' else build_momo_payloads
+    sequence = add_redeliveries(build(args, profile, rng, run_id), profile['redelivery_ratio'], rng)
+    print(f"Sending {len(sequence)} {args.gateway} notifications ({args.profile}: {profile})")
+
+    queries_before = count_queries(args.dsn)
+    latencies, statuses, duration = send_all(
+        args.url.rstrip('/') + IPN_PATHS[args.gateway], sequence, profile['rate'], profile['concurrency'], args.timeout)
+    queries_after = count_queries(args.dsn)
+    queries = queries_after - queries_before - 1 if None not in (queries_before, queries_after) else None
+
+    result = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'version': module_version(args.gateway),
+        'gateway': args.gateway,
+        'profile': args.profile,
+        'settings': dict(profile, seed=args.seed),
+        **summarize(latencies, statuses, duration, queries),
+    }
+    print(f"  {result['throughput_per_s']:.1f}/s, p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+          f"p99 {result['p99_ms']:.1f} ms, statuses {result['statuses']}")
+    if result['queries_per_notification'] is not None:
+        print(f"  {result['queries_per_notification']:.1f} queries per notification")
+
+    previous = previous_run(args.output, args.gateway, args.profile)
+    if previous:
+        print(f"  previous run ({previous['revision']}, {previous['timestamp']}): "
+              f"{previous['throughput_per_s']:.1f}/s, p95 {previous['p95_ms']:.1f} ms")
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""Check that the queue polling queries stay on the partial indexes when the tables grow.
+
+The script builds scratch copies of the retry and processing/pending tables in a temporary
+schema, with the same indexes as the modules, and fills them with mostly historical (not due)
+rows. For each size it runs EXPLAIN (ANALYZE, BUFFERS) on the statement of _claim_due_retries,
+i.e. the UPDATE with its FOR UPDATE SKIP LOCKED subselect, rolled back after each run, and on
+the search of the expiry cron. It records the scan types, the buffers and the execution time.
+
+Usage:
+    python benchmarks/queue_index_plans.py --dsn "dbname=bench" --sizes 10000 100000 1000000 3000000 \
+        --plans benchmarks/results/queue_index_plans.txt
+
+Nothing is written outside the scratch schema, which is dropped at the end.
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+
+SCHEMA = 'queue_index_bench'
+
+# Cùng cấu trúc chỉ mục với các model retry và processing/pending: chỉ mục của các trường
+# index=True cạnh tranh với chỉ mục một phần trong init()
+SETUP_SQL = f"""
+    DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+    CREATE SCHEMA {SCHEMA};
+    CREATE TABLE {SCHEMA}.transaction_retry (
+        id serial PRIMARY KEY,
+        transaction_id integer NOT NULL,
+        reference varchar,
+        request_id varchar,
+        state varchar NOT NULL,
+        next_retry timestamp,
+        retry_count integer DEFAULT 0,
+        max_retries integer DEFAULT 5,
+        error_message text,
+        claim_time timestamp,
+        create_date timestamp,
+        write_date timestamp
+    );
+    CREATE TABLE {SCHEMA}.transaction_processing (
+        id serial PRIMARY KEY,
+        transaction_id integer NOT NULL,
+        reference varchar,
+        request_id varchar,
+        create_date timestamp,
+        timeout_time timestamp
+    );
+"""
+
+INDEX_SQL = f"""
+    CREATE INDEX transaction_retry__state_index ON {SCHEMA}.transaction_retry (state);
+    CREATE INDEX transaction_retry__create_date_index ON {SCHEMA}.transaction_retry (create_date);
+    CREATE INDEX transaction_retry_due_retry_idx
+        ON {SCHEMA}.transaction_retry (next_retry, id) WHERE state = 'retry';
+    CREATE INDEX transaction_processing__create_date_index ON {SCHEMA}.transaction_processing (create_date);
+    CREATE INDEX transaction_processing__timeout_time_index ON {SCHEMA}.transaction_processing (timeout_time);
+    CREATE INDEX transaction_processing_timeout_idx
+        ON {SCHEMA}.transaction_processing (timeout_time, id) WHERE timeout_time IS NOT NULL;
+"""
+
+# Phần lớn các bản ghi chưa đến hạn: chỉ due_ratio bản ghi cần xử lý. Odoo lưu thời gian theo UTC
+FILL_SQL = f"""
+    INSERT INTO {SCHEMA}.transaction_retry
+           (transaction_id, reference, request_id, state, next_retry, retry_count, create_date, write_date)
+    SELECT g, 'S' || g, md5(g::text),
+           CASE WHEN g %% 10 = 0 THEN 'processing' ELSE 'retry' END,
+           CASE WHEN random() < %(due_ratio)s THEN (now() at time zone 'UTC') - random() * interval '1 hour'
+                ELSE (now() at time zone 'UTC') + random() * interval '30 days' END,
+           (random() * 5)::integer,
+           now() at time zone 'UTC', now() at time zone 'UTC'
+      FROM generate_series(%(start)s, %(stop)s) g;
+    INSERT INTO {SCHEMA}.transaction_processing (transaction_id, reference, request_id, create_date, timeout_time)
+    SELECT g, 'S' || g, md5(g::text),
+           now() at time zone 'UTC',
+           CASE WHEN random() < %(due_ratio)s THEN (now() at time zone 'UTC') - random() * interval '1 hour'
+                ELSE (now() at time zone 'UTC') + random() * interval '30 days' END
+      FROM generate_series(%(start)s, %(stop)s) g;
+"""
+
+# Các câu lệnh được chạy với tham số %(now)s (thời gian UTC, như fields.Datetime.now())
+QUERIES = {
+    # Câu lệnh của _claim_due_retries, batch mặc định const.RETRY_BATCH_SIZE
+    'claim_due_retries': f"""
+        UPDATE {SCHEMA}.transaction_retry
+           SET state = 'processing', claim_time = %(now)s
+         WHERE id IN (
+            SELECT id FROM {SCHEMA}.transaction_retry
+             WHERE state = 'retry'
+               AND next_retry <= %(now)s
+          ORDER BY next_retry
+             LIMIT 50
+               FOR UPDATE SKIP LOCKED
+         )
+     RETURNING id
+    """,
+    # Câu lệnh sinh bởi search([('timeout_time', '<=', now)], order='timeout_time, id') của cron hết hạn
+    'expired_transactions': f"""
+        SELECT "transaction_processing"."id" FROM {SCHEMA}.transaction_processing
+         WHERE "transaction_processing"."timeout_time" <= %(now)s
+      ORDER BY "transaction_processing"."timeout_time", "transaction_processing"."id"
+    """,
+}
+
+# Chỉ mục một phần mà mỗi câu lệnh phải dùng
+EXPECTED_INDEXES = {
+    'claim_due_retries': 'transaction_retry_due_retry_idx',
+    'expired_transactions': 'transaction_processing_timeout_idx',
+}
+
+
+def _plan_nodes(plan):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def _format_plan(result):
+    """Render an EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) result as an indented text plan"""
+    lines = []
+
+    def add(node, depth):
+        indent = '      ' * depth
+        title = node.get('Operation') if node['Node Type'] == 'ModifyTable' else node['Node Type']
+        if node.get('Index Name'):
+            title += f" using {node['Index Name']}"
+        if node.get('Relation Name'):
+            title += f" on {node['Relation Name']}"
+        if node.get('Actual Loops'):
+            title += (f"  (actual time={node['Actual Startup Time']:.3f}..{node['Actual Total Time']:.3f}"
+                      f" rows={node['Actual Rows']} loops={node['Actual Loops']})")
+        else:
+            title += "  (never executed)"
+        lines.append(f"{indent}->  {title}" if depth else title)
+        for key in ('Index Cond', 'Recheck Cond', 'Filter', 'Sort Key', 'Heap Fetches'):
+            if key in node:
+                value = node[key]
+                lines.append(f"{indent}      {key}: {', '.join(value) if isinstance(value, list) else value}")
+        if node.get('Shared Hit Blocks') or node.get('Shared Read Blocks'):
+            lines.append(f"{indent}      Buffers: shared hit={node.get('Shared Hit Blocks', 0)}"
+                         f" read={node.get('Shared Read Blocks', 0)}")
+        for child in node.get('Plans', []):
+            add(child, depth + 1)
+
+    add(result['Plan'], 0)
+    lines.append(f"Planning Time: {result['Planning Time']:.3f} ms")
+    lines.append(f"Execution Time: {result['Execution Time']:.3f} ms")
+    return "\n".join(lines)
+
+
+def _explain(conn, name, query):
+    """EXPLAIN ANALYZE a statement once, in a transaction rolled back afterwards.
+
+    The statement is run only once per transaction: a second run of the claim would find the
+    rows already claimed by the first one. The text plan is rendered from the same run.
+    """
+    params = {'now': datetime.now(timezone.utc).replace(tzinfo=None)}
+    with conn.cursor() as cr:
+        cr.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+        result = cr.fetchone()[0][0]
+    conn.rollback()
+    nodes = list(_plan_nodes(result['Plan']))
+    scans = [(node['Node Type'], node.get('Index Name')) for node in nodes if 'Scan' in node['Node Type']]
+    return {
+        'scans': scans,
+        'uses_partial_index': any(index == EXPECTED_INDEXES[name] for _node_type, index in scans),
+        'seq_scan': any(node_type == 'Seq Scan' for node_type, _index in scans),
+        'heap_fetches': sum(node.get('Heap Fetches', 0) for node in nodes),
+        'shared_buffers': result['Plan'].get('Shared Hit Blocks', 0) + result['Plan'].get('Shared Read Blocks', 0),
+        'execution_ms': result['Execution Time'],
+        'rows': result['Plan'].get('Actual Rows'),
+        'plan': _format_plan(result),
+    }
+
+
+def run(dsn, sizes, due_ratio, repeat):
+    conn = psycopg2.connect(dsn)
+    results = []
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cr:
+            cr.execute(SETUP_SQL)
+            cr.execute(INDEX_SQL)
+            filled = 0
+            for size in sorted(sizes):
+                start = time.perf_counter()
+                cr.execute(FILL_SQL, {'start': filled + 1, 'stop': size, 'due_ratio': due_ratio})
+                filled = size
+                # VACUUM cập nhật visibility map, như autovacuum trên bảng thật
+                cr.execute(f"VACUUM ANALYZE {SCHEMA}.transaction_retry")
+                cr.execute(f"VACUUM ANALYZE {SCHEMA}.transaction_processing")
+                print(f"Filled {size} rows in {time.perf_counter() - start:.1f}s")
+
+                conn.autocommit = False
+                for name, query in QUERIES.items():
+                    runs = [_explain(conn, name, query) for _i in range(repeat)]
+                    best = min(runs, key=lambda r: r['execution_ms'])
+                    results.append({'rows_in_table': size, 'query': name, **best})
+                    print(f"  {name}: {best['execution_ms']:.3f} ms, {best['shared_buffers']} buffers, "
+                          f"partial index={best['uses_partial_index']}, scans={best['scans']}")
+                conn.autocommit = True
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        with conn.cursor() as cr:
+            cr.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+    return results
+
+
+def write_plans(path, results, due_ratio):
+    """Write the text plans of every size and statement, for reviewing them alongside the code"""
+    with open(path, 'w') as f:
+        f.write(f"# EXPLAIN (ANALYZE, BUFFERS) rendered from the JSON output, best of the runs, "
+                f"{due_ratio:.2%} of the rows due\n")
+        for result in results:
+            f.write(f"\n## {result['query']}, {result['rows_in_table']} rows\n\n{result['plan']}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dsn', required=True, help="libpq connection string of a scratch database")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000, 3000000])
+    parser.add_argument('--due-ratio', type=float, default=0.001,
+                        help="share of the rows that are due (default: 0.1%%)")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per query, the best one is kept")
+    parser.add_argument('--output', default='queue_index_plans.json', help="JSON file receiving the results")
+    parser.add_argument('--plans', help="text file receiving the EXPLAIN output of every run kept")
+    args = parser.parse_args()
+
+    results = run(args.dsn, args.sizes, args.due_ratio, args.repeat)
+    if args.plans:
+        write_plans(args.plans, results, args.due_ratio)
+        print(f"Plans written to {args.plans}")
+    with open(args.output, 'w') as f:
+        json.dump([{key: value for key, value in result.items() if key != 'plan'} for result in results], f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
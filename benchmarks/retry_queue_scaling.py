@@ -0,0 +1,228 @@
+"""Measure one full drain of the MB Bank or MoMo retry queue for growing backlogs.
+
+For each backlog size, the script seeds synthetic pending transactions and due retry records
+with plain SQL, runs the retry cron once until the queue has no due record left, and records
+the wall time, the peak memory growth, the SQL query count and time, and the time the cron
+thread spent waiting for gateway calls versus working in the ORM.
+
+The status queries go to the local gateway emulator, started with --accept-unknown-orders so
+that it answers for the seeded references:
+
+    python mbbank_odoo/scripts/mbbank_emulator.py --hash-secret SECRET --accept-unknown-orders \\
+        --no-ipn --ipn-codes 00=0.8,12=0.1,18=0.1
+    python benchmarks/retry_queue_scaling.py -c odoo.conf -d bench --gateway mbbank \\
+        --sizes 10000 100000 1000000
+
+The cron commits as it goes: use a scratch database, whose provider of the gateway is in test
+mode with its Emulator URL set. The seeded records are deleted at the end unless --keep is given.
+"""
+import argparse
+import json
+import resource
+import threading
+import time
+
+GATEWAYS = {
+    'mbbank': {
+        'retry_model': 'mbbank.transaction.retry',
+        'request_id_column': 'mb_request_id',
+        'emulator_field': 'mb_emulator_url',
+    },
+    'momo': {
+        'retry_model': 'momo.transaction.retry',
+        'request_id_column': 'momo_request_id',
+        'emulator_field': 'momo_emulator_url',
+    },
+}
+
+REFERENCE_PREFIX = 'RQBENCH'
+
+
+class GatewayTimer:
+    """Time spent by the cron thread waiting for gateway calls"""
+
+    def __init__(self, http_client):
+        self.http_client = http_client
+        self.seconds = 0.0
+        self.calls = 0
+        self._thread = threading.current_thread()
+        self._nested = False
+
+    def __enter__(self):
+        self._post_concurrently = post_concurrently = self.http_client.post_json_concurrently
+        self._post = post = self.http_client.GatewayHTTPClient._post
+        timer = self
+
+        def timed_post_json_concurrently(queries, *args, **kwargs):
+            timer._nested = True
+            start = time.perf_counter()
+            try:
+                return post_concurrently(queries, *args, **kwargs)
+            finally:
+                timer.seconds += time.perf_counter() - start
+                timer.calls += len(queries)
+                timer._nested = False
+
+        def timed_post(client, *args, **kwargs):
+            # Các lệnh gọi trong thread pool đã được tính trong post_json_concurrently
+            if timer._nested or threading.current_thread() is not timer._thread:
+                return post(client, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return post(client, *args, **kwargs)
+            finally:
+                timer.seconds += time.perf_counter() - start
+                timer.calls += 1
+
+        self.http_client.post_json_concurrently = timed_post_json_concurrently
+        self.http_client.GatewayHTTPClient._post = timed_post
+        return self
+
+    def __exit__(self, *exc):
+        self.http_client.post_json_concurrently = self._post_concurrently
+        self.http_client.GatewayHTTPClient._post = self._post
+
+
+def get_provider(env, gateway, provider_id):
+    settings = GATEWAYS[gateway]
+    if provider_id:
+        provider = env['payment.provider'].browse(provider_id)
+    else:
+        provider = env['payment.provider'].search([
+            ('code', '=', gateway), ('state', '=', 'test'), (settings['emulator_field'], '!=', False),
+        ], limit=1)
+    if not provider or not provider[settings['emulator_field']] or provider.state != 'test':
+        raise SystemExit(f"No {gateway} provider in test mode with an Emulator URL")
+    return provider
+
+
+def cleanup(env, gateway):
+    retry_table = env[GATEWAYS[gateway]['retry_model']]._table
+    env.cr.execute(f"DELETE FROM {retry_table} WHERE reference LIKE %s", (f"{REFERENCE_PREFIX}-%",))
+    env.cr.execute("DELETE FROM payment_transaction WHERE reference LIKE %s", (f"{REFERENCE_PREFIX}-%",))
+    env.cr.commit()
+
+
+def seed(env, gateway, provider, size):
+    """Insert `size` pending transactions and their due retry records"""
+    settings = GATEWAYS[gateway]
+    template = env['payment.transaction'].create({
+        'reference': f"{REFERENCE_PREFIX}-template",
+        'provider_id': provider.id,
+        'payment_method_id': provider.payment_method_ids[:1].id,
+        'amount': 100000,
+        'currency_id': env.ref('base.VND').id,
+        'partner_id': env.user.partner_id.id,
+        'state': 'pending',
+    })
+    env.flush_all()
+
+    # Sao chép giao dịch mẫu bằng SQL: nhanh hơn nhiều so với ORM khi có hàng triệu bản ghi
+    env.cr.execute("""
+        SELECT column_name FROM information_schema.columns
+         WHERE table_name = 'payment_transaction' AND column_name NOT IN ('id', 'reference')
+    """)
+    columns = ", ".join(f'"{row[0]}"' for row in env.cr.fetchall())
+    env.cr.execute(f"""
+        INSERT INTO payment_transaction (reference, {columns})
+        SELECT %s || '-' || %s || '-' || g, {columns}
+          FROM payment_transaction, generate_series(1, %s) g
+         WHERE id = %s
+    """, (REFERENCE_PREFIX, size, size, template.id))
+
+    retry_table = env[settings['retry_model']]._table
+    request_id = settings['request_id_column']
+    env.cr.execute(f"""
+        INSERT INTO {retry_table}
+               (transaction_id, reference, {request_id}, original_request_id, idempotency_expiry,
+                next_retry, retry_count, max_retries, state, create_uid, write_uid, create_date, write_date)
+        SELECT id, reference, gen_random_uuid()::text, gen_random_uuid()::text,
+               now() at time zone 'UTC' + interval '31 days',
+               now() at time zone 'UTC' - interval '1 minute', 0, 5, 'retry', %s, %s,
+               now() at time zone 'UTC', now() at time zone 'UTC'
+          FROM payment_transaction
+         WHERE reference LIKE %s
+    """, (env.uid, env.uid, f"{REFERENCE_PREFIX}-{size}-%"))
+    seeded = env.cr.rowcount
+    template.unlink()
+    env.cr.execute(f"ANALYZE {retry_table}")
+    env.cr.execute("ANALYZE payment_transaction")
+    env.cr.commit()
+    return seeded
+
+
+def drain(env, gateway, http_client):
+    """Run the retry cron once and measure it"""
+    Retry = env[GATEWAYS[gateway]['retry_model']]
+    thread = threading.current_thread()
+    thread.query_count, thread.query_time = 0, 0.0
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with GatewayTimer(http_client) as gateway_timer:
+        start = time.perf_counter()
+        Retry._cron_process_transaction_retries()
+        wall = time.perf_counter() - start
+
+    env.invalidate_all()
+    stats = Retry._get_queue_stats()
+    return {
+        'wall_s': wall,
+        'gateway_s': gateway_timer.seconds,
+        'gateway_calls': gateway_timer.calls,
+        'orm_s': wall - gateway_timer.seconds,
+        'sql_s': thread.query_time,
+        'queries': thread.query_count,
+        'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+        'left_due': stats['due'],
+        'left_processing': stats['processing'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', help="Odoo configuration file")
+    parser.add_argument('-d', '--database', required=True, help="scratch Odoo database")
+    parser.add_argument('--gateway', choices=sorted(GATEWAYS), required=True)
+    parser.add_argument('--provider-id', type=int, help="provider to use (default: the first one with an Emulator URL)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--keep', action='store_true', help="keep the seeded records of the last size")
+    parser.add_argument('--output', default='retry_queue_scaling.json', help="JSON file receiving the results")
+    args = parser.parse_args()
+
+    import odoo
+    from odoo.tools import config
+    config.parse_config((['-c', args.config] if args.config else []) + ['-d', args.database, '--max-cron-threads=0'])
+    odoo.netsvc.init_logger()
+    http_client = __import__(f'odoo.addons.{args.gateway}_odoo.tools.http_client', fromlist=['http_client'])
+
+    results = []
+    registry = odoo.modules.registry.Registry(args.database)
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        provider = get_provider(env, args.gateway, args.provider_id)
+        cleanup(env, args.gateway)
+        try:
+            for size in args.sizes:
+                start = time.perf_counter()
+                seeded = seed(env, args.gateway, provider, size)
+                print(f"Seeded {seeded} {args.gateway} retries in {time.perf_counter() - start:.1f}s")
+
+                result = {'gateway': args.gateway, 'backlog': seeded, **drain(env, args.gateway, http_client)}
+                results.append(result)
+                print(f"  drained in {result['wall_s']:.1f}s: gateway {result['gateway_s']:.1f}s, "
+                      f"ORM {result['orm_s']:.1f}s (SQL {result['sql_s']:.1f}s, {result['queries']} queries), "
+                      f"peak RSS +{result['peak_rss_growth_kb']} kB, {result['left_due']} due left")
+                if not (args.keep and size == args.sizes[-1]):
+                    cleanup(env, args.gateway)
+        except BaseException:
+            cr.rollback()
+            cleanup(env, args.gateway)
+            raise
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
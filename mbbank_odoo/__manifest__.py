@@ -1,6 +1,6 @@
 {
     'name': 'MB Bank Payment',
-    'version': '1.0',
+    'version': '1.2',
     'category': 'Payment',
     'sequence': 1,
     'summary': 'Integration with MB Bank payment gateway',
@@ -14,6 +14,7 @@
         'views/payment_mbbank_template.xml',
         'views/mbbank_transaction_processing_views.xml',
         'views/mbbank_transaction_retry_views.xml',
+        'views/mbbank_ipn_inbox_views.xml',
         'data/cron_data.xml',
         'data/payment_provider_data.xml',
         'data/payment_method_data.xml',
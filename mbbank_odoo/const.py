@@ -12,6 +12,40 @@ PRODUCTION_DOMAIN = "https://api.mbbank.com.vn"
 CREATE_ORDER_PATH = "/private/ms/pg-paygate-authen/paygate/v2/create-order"
 QUERY_STATUS_PATH = "/private/ms/pg-paygate-authen/v2/paygate/detail"
 REFUND_PATH = "/private/ms/pg-paygate-authen/paygate/refund/single"
+TOKEN_PATH = "/oauth2/v1/token"
+
+# MB Bank OAuth token cache
+# Lifetime used when MB Bank does not return `expires_in` (seconds)
+TOKEN_DEFAULT_LIFETIME = 300
+# Refresh the cached token in the background this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 60
+# First key of the advisory lock serializing the token requests of a provider across worker processes
+TOKEN_LOCK_NAMESPACE = 4105
+# Seconds a worker waits for the token requested by another worker before giving up
+TOKEN_LOCK_WAIT = 15
+# Seconds between two reads of the stored token while waiting
+TOKEN_LOCK_POLL_INTERVAL = 0.2
+
+# Gateway HTTP client
+# Maximum number of kept-alive connections per gateway host
+HTTP_POOL_SIZES = {
+    SANDBOX_DOMAIN: 8,
+    PRODUCTION_DOMAIN: 16,
+}
+HTTP_DEFAULT_POOL_SIZE = 4
+# (connect, read) timeouts in seconds per operation
+HTTP_TIMEOUTS = {
+    'token': (5, 10),
+    'create_order': (5, 30),
+    'status_query': (5, 15),
+    'refund': (5, 30),
+}
+# Defaults of the `mbbank_odoo.http_max_retries` and `mbbank_odoo.http_backoff_factor` system parameters
+HTTP_DEFAULT_MAX_RETRIES = 2
+HTTP_DEFAULT_BACKOFF_FACTOR = 0.3
+HTTP_RETRY_STATUSES = (502, 503, 504)
+# Idempotent operations retried on the statuses above; creating orders and refunds are sent only once
+HTTP_RETRIED_OPERATIONS = ('token', 'status_query')
 
 
 # MB Bank Payment Methods
@@ -25,4 +59,84 @@ PAYMENT_LANG_EN = "en"
 # MB Bank Error Codes
 ERROR_CODE_SUCCESS = "00"
 ERROR_CODE_PENDING = "12"
-ERROR_CODE_CANCELED = "18"
\ No newline at end of file
+ERROR_CODE_CANCELED = "18"
+
+# Gateway state ranks: a notification or status answer ranked below the state already applied to
+# the transaction is stale and dropped. Codes that are not listed are final.
+GATEWAY_STATE_RANK_PENDING = 1
+GATEWAY_STATE_RANK_FINAL = 2
+GATEWAY_STATE_RANKS = {
+    '12': GATEWAY_STATE_RANK_PENDING,
+    '16': GATEWAY_STATE_RANK_PENDING,
+    '92': GATEWAY_STATE_RANK_PENDING,
+    '93': GATEWAY_STATE_RANK_PENDING,
+    '94': GATEWAY_STATE_RANK_PENDING,
+    '95': GATEWAY_STATE_RANK_PENDING,
+}
+
+# IPN inbox
+# Default of the `mbbank_odoo.ipn_batch_size` system parameter
+IPN_BATCH_SIZE = 100
+# Default of the `mbbank_odoo.ipn_max_attempts` system parameter: failed notifications are tried again
+# after 1, 2, 4... minutes, and are left in error after this many attempts
+IPN_MAX_ATTEMPTS = 5
+# Default of the `mbbank_odoo.ipn_ledger_retention_days` system parameter: days during which
+# a redelivered notification is recognized and skipped
+IPN_LEDGER_RETENTION_DAYS = 30
+
+# Status queries
+# Seconds during which a final status answer is reused instead of querying MB Bank again
+STATUS_RESULT_CACHE_TTL = 30
+# resp_code values of a status answer that will not change any more: paid, canceled, failed
+STATUS_FINAL_RESP_CODES = ('00', '18', '54', '56')
+
+# Post-processing
+# Default of the `mbbank_odoo.post_process_batch_size` system parameter: transactions post-processed
+# per committed batch
+POST_PROCESS_BATCH_SIZE = 100
+# Default of the `mbbank_odoo.post_process_chunk_size` system parameter: transactions of a
+# company and partner post-processed together in one savepoint
+POST_PROCESS_CHUNK_SIZE = 20
+# Transactions confirmed longer ago than this many days are left to the standard payment cron
+POST_PROCESS_MAX_AGE_DAYS = 4
+
+# Retry queue
+# Default of the `mbbank_odoo.retry_batch_size` system parameter
+RETRY_BATCH_SIZE = 50
+# Minutes after which a claimed retry that was never released is claimed again
+RETRY_CLAIM_TIMEOUT = 15
+# Default of the `mbbank_odoo.retry_query_concurrency` system parameter: status queries sent at once
+RETRY_QUERY_CONCURRENCY = 8
+
+# Expiry
+# Default of the `mbbank_odoo.expiry_chunk_size` system parameter
+EXPIRY_CHUNK_SIZE = 200
+# Default of the `mbbank_odoo.expiry_max_status_checks` system parameter: failed status checks of an
+# expired transaction before it is moved to the retry queue
+EXPIRY_MAX_STATUS_CHECKS = 5
+
+# Metrics
+# Upper bounds in seconds of the duration histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Seconds between two flushes of the metric samples of a worker to the database
+METRICS_FLUSH_INTERVAL = 10
+# Key of the result code in the MB Bank API answers, used as the `result` label of the gateway call metrics
+METRICS_RESULT_KEY = 'error_code'
+
+# Gateway event logging
+# Keys whose values are masked in the logged events, compared case-insensitively
+LOG_REDACTED_KEYS = ('mac', 'access_code', 'access_token', 'password', 'hash_secret', 'authorization', 'cookie')
+# Share of the events of each kind that are logged (1.0 when not listed); warnings are always logged
+LOG_SAMPLE_RATES = {
+    'ipn_received': 0.1,
+    'status_query_response': 0.1,
+}
+# Events waiting for the background log writer; further events are dropped instead of blocking
+LOG_QUEUE_SIZE = 10000
+
+# Profiling
+# Default of the `mbbank_odoo.profiling_sample_rate` system parameter: share of the requests profiled
+# when the server runs with `mbbank_odoo_profiling = True`
+PROFILING_SAMPLE_RATE = 0.0
+# Functions listed in the readable report of a profile, by cumulative time
+PROFILING_REPORT_LINES = 40
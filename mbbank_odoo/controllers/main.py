@@ -1,5 +1,4 @@
 import logging
-import pprint
 import hmac
 import hashlib
 import json
@@ -10,13 +9,21 @@ from odoo.exceptions import ValidationError
 from odoo.http import request
 from werkzeug.exceptions import Forbidden
 
+from odoo.addons.mbbank_odoo.tools import gateway_log, metrics, profiling
+
 _logger = logging.getLogger(__name__)
 
 
+def _get_ipn_providers(*args, **kwargs):
+    """Providers an IPN may belong to, known only once its signature is checked"""
+    return request.env['payment.provider'].sudo().search([('code', '=', 'mbbank')])
+
+
 class MBBankController(http.Controller):
     _return_url = "/payment/mbbank/return"
     _cancel_url = "/payment/mbbank/cancel"
     _ipn_url = "/payment/mbbank/ipn"
+    _metrics_url = "/payment/mbbank/metrics"
 
     @http.route(_return_url, type="http", methods=["GET", "POST"], auth="public", csrf=False, save_session=False)
     def mbbank_redirect(self, **data):
@@ -58,59 +65,64 @@ class MBBankController(http.Controller):
         return request.redirect("/payment/status")
 
     @http.route(_ipn_url, type="http", auth="public", methods=["POST", "GET"], csrf=False, save_session=False)
+    @metrics.timed('ipn_seconds')
+    @profiling.profiled('ipn', _get_ipn_providers)
     def mbbank_ipn(self, **data):
         """Handle IPN notification from MB Bank."""
-        _logger.info("============= MB Bank IPN CALLED =============")
-        _logger.info("IPN request headers: %s", pprint.pformat(dict(request.httprequest.headers)))
-
         try:
             # Parse JSON data if any
             notification_data = {}
             if not data and request.httprequest.data:
                 notification_data = json.loads(request.httprequest.data.decode('utf-8'))
-                _logger.info("IPN data from body: %s", pprint.pformat(notification_data))
             else:
                 notification_data = data
-                _logger.info("IPN data from params: %s", pprint.pformat(notification_data))
+            gateway_log.log_event('ipn_received', headers=request.httprequest.headers, payload=notification_data)
 
             # IPN sử dụng SHA256 nên đảm bảo mac_type đúng
             if 'mac_type' not in notification_data:
                 notification_data['mac_type'] = 'SHA256'
 
-            # Find transaction
+            # Check the signature before anything touches the database
+            provider_id = request.env['payment.provider'].sudo()._verify_mbbank_notification(notification_data)
+            if not provider_id:
+                _logger.warning("Rejected MB Bank IPN with invalid signature")
+                metrics.recorder.inc('ipn_total', {'result': 'rejected'})
+                return json.dumps({
+                    'status': 'FAILED',
+                    'error_code': '02',
+                    'message': 'Payment notification failed: ERR_INVALID_SIGNATURE'
+                })
+
+            # Store the notification in the inbox; it is processed by the inbox cron
             if 'pg_order_reference' in notification_data:
                 try:
-                    reference = notification_data.get('pg_order_reference')
-                    # Nếu pg_order_reference bắt đầu bằng PSQR, loại bỏ tiền tố
-                    if reference.startswith('PSQR'):
-                        reference = reference[4:]  # Chỉ cần loại bỏ PSQR, không cần chuyển đổi
-
-                    # Find transaction in pending model
-                    pending_tx = request.env['mbbank.transaction.processing'].sudo().search([
-                        ('reference', '=', reference)
-                    ], limit=1)
-
-                    if pending_tx:
-                        _logger.info("Processing IPN via pending model: %s", pending_tx.reference)
-                        pending_tx.process_ipn_notification(notification_data)
-                    else:
-                        _logger.warning("Transaction not found or already processed for orderId: %s", reference)
-
-                    # Always return 204 OK
+                    with request.env.cr.savepoint():
+                        # Redelivered notifications are acknowledged without being processed again
+                        if request.env['mbbank.ipn.ledger'].sudo()._register_notification(provider_id, notification_data):
+                            request.env['mbbank.ipn.inbox'].sudo()._enqueue_notification(provider_id, notification_data)
+                            metrics.recorder.inc('ipn_total', {'result': 'accepted'})
+                        else:
+                            metrics.recorder.inc('ipn_total', {'result': 'redelivered'})
+                            _logger.info("Skipped redelivered MB Bank IPN for %s",
+                                         notification_data.get('pg_order_reference'))
+
                     return request.make_response(json.dumps({
                         'status': 'SUCCESS',
                         'message': 'Payment notification received and processed.'
                     }), headers={'Content-Type': 'application/json'}, status=200)
 
                 except Exception as e:
-                    _logger.exception("Error processing transaction: %s", str(e))
-                    return json.dumps({
+                    _logger.exception("Error storing MB Bank IPN notification: %s", str(e))
+                    metrics.recorder.inc('ipn_total', {'result': 'error'})
+                    # Lỗi HTTP 5xx để MB Bank gửi lại thông báo chưa được lưu
+                    return request.make_response(json.dumps({
                         'status': 'FAILED',
                         'error_code': '500',
                         'message': f"Payment notification failed: {str(e)}"
-                    })
+                    }), headers={'Content-Type': 'application/json'}, status=500)
             else:
                 _logger.warning("Missing pg_order_reference in IPN")
+                metrics.recorder.inc('ipn_total', {'result': 'invalid'})
                 return json.dumps({
                     'status': 'FAILED',
                     'error_code': '01',
@@ -119,8 +131,28 @@ class MBBankController(http.Controller):
 
         except Exception as e:
             _logger.exception("Error processing MB Bank webhook: %s", str(e))
-            return json.dumps({
+            metrics.recorder.inc('ipn_total', {'result': 'error'})
+            return request.make_response(json.dumps({
                 'status': 'FAILED',
                 'error_code': '500',
                 'message': f"INTERNAL SERVER ERROR: {str(e)}"
-            })
+            }), headers={'Content-Type': 'application/json'}, status=500)
+
+    @http.route(_metrics_url, type="http", auth="public", methods=["GET"], csrf=False, save_session=False)
+    def mbbank_metrics(self, **data):
+        """Expose the MB Bank metrics in the Prometheus text format.
+
+        The route is disabled until the `mbbank_odoo.metrics_token` system parameter is set; the
+        scraper sends the token as a bearer token or in the `token` parameter.
+        """
+        token = request.env['ir.config_parameter'].sudo().get_param('mbbank_odoo.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        supplied = authorization[7:] if authorization.startswith('Bearer ') else data.get('token', '')
+        if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+            raise Forbidden()
+
+        # Ghi các mẫu của worker này, rồi đọc bảng trong cursor mới để thấy chúng
+        metrics.recorder.flush(request.db)
+        with request.env.registry.cursor() as cr:
+            body = request.env(cr=cr)['mbbank.gateway.metric'].sudo()._render_prometheus()
+        return request.make_response(body, headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
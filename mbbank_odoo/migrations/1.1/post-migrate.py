@@ -0,0 +1,14 @@
+def migrate(cr, version):
+    # The retry and expiry crons are now triggered when records become due; their periodic run is
+    # only a safety net. The cron records are noupdate, so update the existing ones here.
+    cr.execute("""
+        UPDATE ir_cron
+           SET interval_number = 1, interval_type = 'hours'
+         WHERE id IN (
+            SELECT res_id FROM ir_model_data
+             WHERE module = 'mbbank_odoo'
+               AND model = 'ir.cron'
+               AND name IN ('ir_cron_process_mbbank_transaction_retries',
+                            'ir_cron_process_expired_processing_transactions')
+         )
+    """)
@@ -0,0 +1,20 @@
+def migrate(cr, version):
+    # Gateway IDs are now unique. Clear the duplicates before the constraints are added: refunds
+    # used to copy the transaction ID of their source transaction, which keeps its value.
+    cr.execute("""
+        UPDATE payment_transaction tx
+           SET mb_transaction_id = NULL
+          FROM payment_transaction older
+         WHERE older.mb_transaction_id = tx.mb_transaction_id
+           AND older.provider_id = tx.provider_id
+           AND older.id < tx.id
+    """)
+    # Request IDs of the queue records must be unique as well; give the duplicates a new one
+    for table in ('mbbank_transaction_processing', 'mbbank_transaction_retry'):
+        cr.execute(f"""
+            UPDATE {table} rec
+               SET mb_request_id = gen_random_uuid()::varchar
+              FROM {table} older
+             WHERE older.mb_request_id = rec.mb_request_id
+               AND older.id < rec.id
+        """)
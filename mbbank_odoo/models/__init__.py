@@ -1 +1 @@
-from . import payment_provider, payment_transaction, mbbank_transaction_processing, mbbank_transaction_retry
\ No newline at end of file
+from . import payment_provider, payment_transaction, mbbank_transaction_processing, mbbank_transaction_retry, mbbank_ipn_inbox, mbbank_ipn_ledger, mbbank_gateway_metric, mbbank_status_result
@@ -0,0 +1,130 @@
+import json
+import logging
+import time
+from datetime import timedelta
+
+from odoo import models, fields, api, _
+from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tools import metrics
+from odoo.addons.mbbank_odoo.tools.cron import trigger_cron_at
+
+_logger = logging.getLogger(__name__)
+
+
+class MBBankIPNInbox(models.Model):
+    _name = 'mbbank.ipn.inbox'
+    _description = 'MB Bank IPN Inbox'
+    _rec_name = 'reference'
+    _order = 'id desc'
+
+    reference = fields.Char(string='Order Reference', index=True, readonly=True)
+    provider_id = fields.Many2one('payment.provider', string='Provider', readonly=True, ondelete='cascade')
+    payload = fields.Text(string='Payload', readonly=True)
+    state = fields.Selection([
+        ('new', 'New'),
+        ('error', 'Error')
+    ], string='Status', default='new', required=True, index=True)
+    attempts = fields.Integer(string='Attempts', default=0, readonly=True)
+    next_attempt = fields.Datetime(string='Next Attempt', readonly=True)
+    error_message = fields.Text(string='Error Message', readonly=True)
+    create_date = fields.Datetime(string='Received On', index=True, readonly=True)
+
+    @api.model
+    def _enqueue_notification(self, provider_id, notification_data):
+        """Store an IPN notification received for a provider and wake up the inbox cron to process it."""
+        record = self.create({
+            'reference': notification_data.get('pg_order_reference'),
+            'provider_id': provider_id,
+            'payload': json.dumps(notification_data),
+        })
+        cron = self.env.ref('mbbank_odoo.ir_cron_process_mbbank_ipn_inbox', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return record
+
+    def action_process_again(self):
+        """Put failed notifications back in the inbox"""
+        self.write({'state': 'new', 'attempts': 0, 'next_attempt': False, 'error_message': False})
+        self.env.ref('mbbank_odoo.ir_cron_process_mbbank_ipn_inbox').sudo()._trigger()
+        return True
+
+    def _process_notifications(self):
+        """Process the notifications one by one, each in its own savepoint.
+
+        Returns:
+            The notifications that were processed successfully; the postponed ones stay in the inbox
+        """
+        ProcessingModel = self.env['mbbank.transaction.processing'].sudo()
+        processed = self.browse()
+        max_attempts = int(self.env['ir.config_parameter'].sudo().get_param(
+            'mbbank_odoo.ipn_max_attempts', const.IPN_MAX_ATTEMPTS))
+        for record in self:
+            start = time.perf_counter()
+            outcome = 'done'
+            try:
+                with self.env.cr.savepoint():
+                    result = ProcessingModel._handle_ipn_notification_data(json.loads(record.payload))
+                if result is None:
+                    # The record is held by another worker: keep the notification for the next run
+                    outcome = 'postponed'
+                    continue
+                processed |= record
+            except Exception as e:
+                outcome = 'failed'
+                _logger.exception("Error processing MB Bank IPN %s for %s: %s", record.id, record.reference, e)
+                attempts = record.attempts + 1
+                if attempts < max_attempts:
+                    # Lỗi tạm thời (lock timeout, serialization failure...): thử lại sau
+                    next_attempt = fields.Datetime.now() + timedelta(minutes=2 ** (attempts - 1))
+                    record.write({'attempts': attempts, 'next_attempt': next_attempt, 'error_message': str(e)})
+                    trigger_cron_at(self.env, 'mbbank_odoo.ir_cron_process_mbbank_ipn_inbox', [next_attempt])
+                else:
+                    record.write({
+                        'state': 'error',
+                        'attempts': attempts,
+                        'next_attempt': False,
+                        'error_message': str(e),
+                    })
+                    # Cho phép cổng thanh toán gửi lại thông báo thay vì bị bỏ qua như bản trùng lặp
+                    self.env['mbbank.ipn.ledger'].sudo()._forget_notification(
+                        record.provider_id.id, json.loads(record.payload))
+            finally:
+                metrics.recorder.observe('ipn_process_seconds', time.perf_counter() - start, {'result': outcome})
+        return processed
+
+    @api.model
+    @metrics.timed('cron_seconds', cron='ipn_inbox')
+    def _cron_process_ipn_inbox(self, batch_size=None):
+        """Drain the inbox, processing the notifications in batches committed one at a time.
+
+        Each batch is locked with SKIP LOCKED so that several workers can drain the inbox at once.
+        """
+        if not batch_size:
+            batch_size = int(self.env['ir.config_parameter'].sudo().get_param(
+                'mbbank_odoo.ipn_batch_size', const.IPN_BATCH_SIZE))
+
+        processed_count = 0
+        while True:
+            self.env.cr.execute(f"""
+                SELECT id FROM {self._table}
+                 WHERE state = 'new'
+                   AND (next_attempt IS NULL OR next_attempt <= now() at time zone 'UTC')
+              ORDER BY id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+            """, (batch_size,))
+            batch = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not batch:
+                break
+
+            processed = batch._process_notifications()
+            processed.unlink()
+            self.env.cr.commit()
+            processed_count += len(processed)
+
+            # Stop when the batch was the last one, or when all its notifications were postponed or failed
+            if len(batch) < batch_size or not processed:
+                break
+
+        if processed_count:
+            _logger.info("Processed %s MB Bank IPN notifications from the inbox", processed_count)
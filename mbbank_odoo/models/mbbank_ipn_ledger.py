@@ -0,0 +1,79 @@
+import logging
+from datetime import timedelta
+
+from odoo import models, fields, api
+from odoo.addons.mbbank_odoo import const
+
+_logger = logging.getLogger(__name__)
+
+
+class MBBankIPNLedger(models.Model):
+    _name = 'mbbank.ipn.ledger'
+    _description = 'MB Bank IPN Idempotency Ledger'
+    _rec_name = 'transaction_number'
+    _order = 'id desc'
+    _log_access = False
+
+    provider_id = fields.Many2one('payment.provider', string='Provider', required=True, ondelete='cascade')
+    transaction_number = fields.Char(string='Gateway Transaction Number', required=True)
+    result_code = fields.Char(string='Result Code', required=True)
+    received_date = fields.Datetime(string='Received On', required=True, index=True)
+
+    _sql_constraints = [
+        ('notification_uniq', 'unique(provider_id, transaction_number, result_code)',
+         "An IPN notification can only be registered once."),
+    ]
+
+    @api.model
+    def _register_notification(self, provider_id, notification_data):
+        """Record an IPN notification in the ledger.
+
+        The insertion and the duplicate check are done by a single statement on the unique index.
+
+        Returns:
+            False if the same notification was already received, True otherwise
+        """
+        key = self._get_notification_key(notification_data)
+        if not key:
+            # Không có mã giao dịch cổng thanh toán: không thể chống trùng lặp
+            return True
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} (provider_id, transaction_number, result_code, received_date)
+                 VALUES (%s, %s, %s, now() at time zone 'UTC')
+            ON CONFLICT (provider_id, transaction_number, result_code) DO NOTHING
+              RETURNING id
+        """, (provider_id, *key))
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _forget_notification(self, provider_id, notification_data):
+        """Remove a notification from the ledger, so that a redelivery of it is accepted again.
+
+        Called when the processing of the notification failed for good: the gateway redelivery is
+        then the only way to recover it.
+        """
+        key = self._get_notification_key(notification_data)
+        if key and provider_id:
+            self.env.cr.execute(f"""
+                DELETE FROM {self._table}
+                 WHERE provider_id = %s AND transaction_number = %s AND result_code = %s
+            """, (provider_id, *key))
+
+    @api.model
+    def _get_notification_key(self, notification_data):
+        """Return the (transaction number, result code) identifying a notification, or None"""
+        transaction_number = notification_data.get('pg_transaction_number')
+        if transaction_number in (None, ''):
+            return None
+        result_code = notification_data.get('error_code')
+        return str(transaction_number), '' if result_code is None else str(result_code)
+
+    @api.autovacuum
+    def _gc_ledger(self):
+        """Forget the notifications older than the retention period"""
+        retention_days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'mbbank_odoo.ipn_ledger_retention_days', const.IPN_LEDGER_RETENTION_DAYS))
+        self.env.cr.execute(f"DELETE FROM {self._table} WHERE received_date < %s",
+                            (fields.Datetime.now() - timedelta(days=retention_days),))
+        if self.env.cr.rowcount:
+            _logger.info("Removed %s expired MB Bank IPN ledger entries", self.env.cr.rowcount)
@@ -0,0 +1,52 @@
+import json
+import logging
+from datetime import timedelta
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+class MBBankStatusResult(models.Model):
+    _name = 'mbbank.status.result'
+    _description = 'MB Bank Status Query Result'
+    _rec_name = 'reference'
+    _order = 'id desc'
+    _log_access = False
+
+    reference = fields.Char(string='Reference', required=True)
+    response = fields.Text(string='Response', required=True)
+    received_date = fields.Datetime(string='Received On', required=True, index=True)
+
+    _sql_constraints = [
+        ('reference_uniq', 'unique(reference)', "A reference can only have one status query result."),
+    ]
+
+    @api.model
+    def _get_final_result(self, reference, ttl):
+        """Return the final status answer of a reference received in the last `ttl` seconds, or None"""
+        self.env.cr.execute(f"""
+            SELECT response FROM {self._table}
+             WHERE reference = %s AND received_date >= %s
+        """, (reference, fields.Datetime.now() - timedelta(seconds=ttl)))
+        row = self.env.cr.fetchone()
+        return json.loads(row[0]) if row else None
+
+    @api.model
+    def _store_final_result(self, reference, result):
+        """Share the final status answer of a reference with the other worker processes"""
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} (reference, response, received_date)
+                 VALUES (%s, %s, %s)
+            ON CONFLICT (reference) DO UPDATE
+                    SET response = EXCLUDED.response,
+                        received_date = EXCLUDED.received_date
+        """, (reference, json.dumps(result), fields.Datetime.now()))
+
+    @api.autovacuum
+    def _gc_results(self):
+        """Remove the results that no caller can use any more"""
+        self.env.cr.execute(f"DELETE FROM {self._table} WHERE received_date < %s",
+                            (fields.Datetime.now() - timedelta(hours=1),))
+        if self.env.cr.rowcount:
+            _logger.info("Removed %s expired MB Bank status query results", self.env.cr.rowcount)
@@ -1,9 +1,13 @@
 import hashlib
 import hmac
 from datetime import timedelta
-import requests
 
 from odoo import models, fields, api, _
+from odoo.tools import split_every
+from odoo.tools.sql import create_index
+from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tools import http_client, locking, metrics, single_flight
+from odoo.addons.mbbank_odoo.tools.cron import trigger_cron_at
 import logging
 import uuid
 
@@ -23,14 +27,41 @@ class MBBankTransactionProcessing(models.Model):
     reference = fields.Char(string='Reference', related='transaction_id.reference',
                             store=True, index=True)
     signature = fields.Char(string='Signature')
-    mb_request_id = fields.Char(string='MB Bank Request ID', index=True)
+    mb_request_id = fields.Char(string='MB Bank Request ID')
     create_date = fields.Datetime(string='Created On', index=True)
     timeout_time = fields.Datetime(string='Timeout', index=True)
+    expiry_checks = fields.Integer(string='Failed Expiry Checks', default=0, readonly=True,
+                                   help="Status queries sent at expiry that could not confirm the transaction status.")
+
+    _sql_constraints = [
+        ('mb_request_id_uniq', 'unique(mb_request_id)', "The MB Bank request ID must be unique."),
+    ]
+
+    def init(self):
+        # Chỉ mục (timeout_time, id) cho phép cron hết hạn đọc trực tiếp từ chỉ mục
+        create_index(self.env.cr, f'{self._table}_timeout_idx', self._table,
+                     ['timeout_time', 'id'], where="timeout_time IS NOT NULL")
 
     def _compute_name(self):
         for record in self:
             record.name = f"Processing: {record.reference or ''}"
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        records._schedule_expiry_cron()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'timeout_time' in vals:
+            self._schedule_expiry_cron()
+        return res
+
+    def _schedule_expiry_cron(self):
+        """Trigger the expiry cron when the records time out"""
+        trigger_cron_at(self.env, 'mbbank_odoo.ir_cron_process_expired_processing_transactions', self.mapped('timeout_time'))
+
     @api.model
     def create_processing_transaction(self, transaction, signature=None, request_id=None):
         """Create a minimalist pending transaction record."""
@@ -53,6 +84,38 @@ class MBBankTransactionProcessing(models.Model):
             'target': 'current',
         }
 
+    def _try_lock(self):
+        """Lock the records without waiting, skipping those another worker is handling.
+
+        Returns:
+            The records that were locked; the caller owns them until the end of the transaction
+        """
+        return self.browse(locking.try_lock(self.env.cr, self._table, self.ids))
+
+    @api.model
+    def _handle_ipn_notification_data(self, notification_data):
+        """Find the processing record matching an IPN notification and process it.
+
+        Returns None, without processing the notification, when another worker holds the record.
+        """
+        reference = notification_data.get('pg_order_reference')
+        # Nếu pg_order_reference bắt đầu bằng PSQR, loại bỏ tiền tố
+        if reference.startswith('PSQR'):
+            reference = reference[4:]  # Chỉ cần loại bỏ PSQR, không cần chuyển đổi
+
+        processing_tx = self.search([('reference', '=', reference)], limit=1)
+        if not processing_tx:
+            _logger.warning("Transaction not found or already processed for orderId: %s", reference)
+            return False
+
+        if not processing_tx._try_lock():
+            # Bản ghi đang được worker khác xử lý: để thông báo trong inbox và xử lý lại sau
+            _logger.info("Transaction %s is being handled by another worker, IPN postponed", reference)
+            return None
+
+        _logger.info("Processing IPN via pending model: %s", processing_tx.reference)
+        return processing_tx.process_ipn_notification(notification_data)
+
     def process_ipn_notification(self, notification_data):
         """Process IPN notification and delete record after completion"""
         self.ensure_one()
@@ -67,6 +130,10 @@ class MBBankTransactionProcessing(models.Model):
                             transaction.reference)
             return False
 
+        # Bỏ qua thông báo cũ hơn trạng thái đã áp dụng (chỉ sau khi chữ ký hợp lệ)
+        if not transaction._accept_mbbank_gateway_state(notification_data.get('error_code')):
+            return False
+
         # Uncomment test lỗi
         # notification_data['error_code'] = '92'
         # _logger.info("Simulate error : change error_code to 92")
@@ -89,6 +156,7 @@ class MBBankTransactionProcessing(models.Model):
             if 'pg_issuer_txn_reference' in notification_data:
                 transaction.mb_ft_code = notification_data.get('pg_issuer_txn_reference')
                 _logger.info(f"Saved FT code: {transaction.mb_ft_code}")
+            transaction._schedule_mbbank_post_processing()
 
             # Delete pending record after completion
             _logger.info(f"Deleting processing record for completed transaction {self.reference}")
@@ -126,41 +194,125 @@ class MBBankTransactionProcessing(models.Model):
             self.sudo().unlink()
             return False
 
+    def _reconcile_expired_transactions(self):
+        """Apply the real MB Bank status of expired records before they get canceled.
+
+        The status queries of all the records are sent concurrently. Records whose transaction
+        turns out to be paid or failed are deleted. Only the records whose query succeeded and
+        confirmed that the transaction is still unpaid are returned, to be canceled; the status
+        of the others is checked again later.
+        """
+        queries = []
+        for record in self:
+            try:
+                query = record.transaction_id._prepare_mbbank_status_query()
+            except Exception as e:
+                _logger.exception("Error preparing MB Bank status query for %s: %s", record.reference, str(e))
+                continue
+            if query:
+                queries.append((record, query))
+
+        max_workers = int(self.env['ir.config_parameter'].sudo().get_param(
+            'mbbank_odoo.retry_query_concurrency', const.RETRY_QUERY_CONCURRENCY))
+        results = http_client.post_json_concurrently(
+            [query for _record, query in queries], 'status_query', max_workers=max_workers,
+            flight=single_flight.status_queries
+        )
+        confirmed = self.browse()
+        for (record, _query), (response_data, error) in zip(queries, results):
+            if error is not None:
+                _logger.warning("Could not query the final MB Bank status of %s: %s", record.reference, error)
+                continue
+            record.transaction_id._apply_mbbank_status_result(response_data)
+            if isinstance(response_data, dict) and response_data.get('error_code') == '00':
+                confirmed |= record
+
+        # Only transactions that MB Bank confirmed as unpaid get canceled
+        settled = confirmed.filtered(lambda r: r.transaction_id.state not in ('draft', 'pending'))
+        if settled:
+            _logger.info("Transactions %s settled before expiry: %s",
+                         ", ".join(settled.mapped('reference')), ", ".join(settled.transaction_id.mapped('state')))
+            settled.sudo().unlink()
+        (self - confirmed)._postpone_expiry()
+        return confirmed - settled
+
+    def _postpone_expiry(self):
+        """Check again later the status of expired records that could not be confirmed.
+
+        The next check is delayed exponentially. After `mbbank_odoo.expiry_max_status_checks`
+        failed checks, the record is handed to the retry queue, which keeps querying MB Bank,
+        instead of being canceled without knowing whether it was paid.
+        """
+        if not self:
+            return
+        max_checks = int(self.env['ir.config_parameter'].sudo().get_param(
+            'mbbank_odoo.expiry_max_status_checks', const.EXPIRY_MAX_STATUS_CHECKS))
+        now = fields.Datetime.now()
+        for record in self:
+            checks = record.expiry_checks + 1
+            if checks < max_checks:
+                record.write({'expiry_checks': checks, 'timeout_time': now + timedelta(minutes=2 ** checks)})
+                _logger.info("Expiry of %s postponed after %s failed status checks", record.reference, checks)
+                continue
+            _logger.warning("Status of expired transaction %s still unknown after %s checks, moved to retry",
+                            record.reference, checks)
+            self.env['mbbank.transaction.retry'].sudo().create_retry_transaction(
+                transaction=record.transaction_id,
+                signature=record.signature,
+                request_id=record.mb_request_id,
+                error_message="Status unknown at expiry"
+            )
+            record.sudo().unlink()
+
+    def _expire_transactions(self):
+        """Cancel the transactions of expired records and delete the records"""
+        payment_txs = self.transaction_id
+        payment_txs._set_canceled(state_message="MB Bank: Transaction expired (timeout)")
+        _logger.info("Transactions %s marked as canceled due to timeout", ", ".join(payment_txs.mapped('reference')))
+        self.sudo().unlink()
+
     @api.model
-    def _cron_process_expired_processing_transactions(self):
+    @metrics.timed('cron_seconds', cron='expiry')
+    def _cron_process_expired_processing_transactions(self, chunk_size=None):
         """
         Cron job to process expired MB Bank pending transactions.
         A transaction is considered expired if it exceeds the configured timeout.
+
+        Expired records are handled in chunks. The real status of each chunk is queried first, and
+        only the transactions that are still unpaid get canceled: they are canceled together, the
+        chunk is deleted with one statement and committed. A chunk that fails is handled again
+        record by record.
         """
         _logger.info("Starting cron job to process expired MB Bank processing transactions")
+        if not chunk_size:
+            chunk_size = int(self.env['ir.config_parameter'].sudo().get_param(
+                'mbbank_odoo.expiry_chunk_size', const.EXPIRY_CHUNK_SIZE))
 
         # Current time
         current_time = fields.Datetime.now()
 
         # Find all transactions that have exceeded timeout
-        expired_transactions = self.search([('timeout_time', '<=', current_time)])
+        expired_ids = self.search([('timeout_time', '<=', current_time)], order='timeout_time, id').ids
 
-        _logger.info("Found %s expired MB Bank processing transactions", len(expired_transactions))
+        _logger.info("Found %s expired MB Bank processing transactions", len(expired_ids))
 
-        # Process each transaction
-        for transaction in expired_transactions:
+        # Process expired records chunk by chunk, committing after each chunk
+        for chunk_ids in split_every(chunk_size, expired_ids):
             try:
-                # Get original transaction
-                payment_tx = transaction.transaction_id
-
-                # Mark transaction as expired
-                payment_tx._set_canceled(state_message="MB Bank: Transaction expired (timeout)")
-                _logger.info("Transaction %s marked as canceled due to timeout", payment_tx.reference)
-
-                # Delete processing record
-                transaction.sudo().unlink()
-
-                # Commit after each transaction to avoid losing progress if there's an error
+                self.browse(chunk_ids).exists()._try_lock()._reconcile_expired_transactions()._expire_transactions()
                 self.env.cr.commit()
-
             except Exception as e:
-                _logger.exception("Error in cron job for transaction %s: %s",
-                                  transaction.reference if hasattr(transaction, 'reference') else "Unknown", str(e))
+                _logger.exception("Error in cron job for a chunk of %s records, retrying them one by one: %s",
+                                  len(chunk_ids), str(e))
                 self.env.cr.rollback()
 
+                # Fall back to one record at a time so that one bad record does not block the others
+                for record in self.browse(chunk_ids).exists():
+                    try:
+                        record._try_lock()._reconcile_expired_transactions()._expire_transactions()
+                        self.env.cr.commit()
+                    except Exception as e:
+                        _logger.exception("Error in cron job for transaction %s: %s", record.reference, str(e))
+                        self.env.cr.rollback()
+
         _logger.info("Finished processing expired MB Bank processing transactions")
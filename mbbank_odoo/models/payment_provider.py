@@ -1,10 +1,17 @@
+import base64
 import logging
 import json
 import uuid
 import hmac
 import hashlib
-from odoo import _, api, fields, models
+import time
+from datetime import timedelta
+
+from odoo import _, api, fields, models, tools
+from odoo.modules.registry import Registry
 from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tools import http_client, locking
+from odoo.addons.mbbank_odoo.tools.signature import get_signer
 
 _logger = logging.getLogger(__name__)
 
@@ -43,6 +50,29 @@ class PaymentProviderMBBank(models.Model):
         default='QR',
         required_if_provider="mbbank"
     )
+    mb_defer_post_processing = fields.Boolean(
+        string="Defer Post-Processing",
+        help="Only record the payment outcome when MB Bank notifies it, and confirm the orders "
+             "of confirmed transactions in batches from a background job. When unchecked, the "
+             "standard post-processing of Odoo confirms them.",
+    )
+    mb_emulator_url = fields.Char(
+        string="Emulator URL",
+        help="In test mode, send every MB Bank API call to this local gateway emulator instead of "
+             "the MB Bank sandbox, e.g. http://localhost:8078 (see scripts/mbbank_emulator.py).",
+    )
+    mb_profiling = fields.Boolean(
+        string="Profile Requests",
+        help="Record a cProfile profile and the SQL queries of every MB Bank IPN and checkout of this "
+             "provider in the data directory. Only effective when the server runs with "
+             "mbbank_odoo_profiling = True in its configuration file.",
+    )
+    mb_access_token = fields.Char(
+        string="Access Token", groups="base.group_system", copy=False, readonly=True
+    )
+    mb_token_expiry = fields.Datetime(
+        string="Access Token Expiry", groups="base.group_system", copy=False, readonly=True
+    )
     # qr_type = fields.Selection([
     #     ('type1_dynamic', 'Type 1 Dynamic'),
     #     ('type1_static', 'Type 1 Static'),
@@ -54,6 +84,31 @@ class PaymentProviderMBBank(models.Model):
     #     (1, 'Sub-Merchant')
     # ], string="Payment Type", default=1, required_if_provider="mbbank")
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Override to drop the cached MB Bank signing keys when a provider is added."""
+        providers = super().create(vals_list)
+        if any(provider.code == 'mbbank' for provider in providers):
+            self.env.registry.clear_cache()
+        return providers
+
+    def write(self, vals):
+        """Override to drop the cached MB Bank token and signing keys when the credentials change."""
+        if {'mb_username', 'mb_password', 'mb_emulator_url', 'state'} & vals.keys():
+            vals = dict(vals, mb_access_token=False, mb_token_expiry=False)
+        res = super().write(vals)
+        if {'code', 'state', 'mb_merchant_id', 'mb_hash_secret'} & vals.keys():
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        """Override to drop the cached MB Bank signing keys when a provider is deleted."""
+        clear_cache = any(provider.code == 'mbbank' for provider in self)
+        res = super().unlink()
+        if clear_cache:
+            self.env.registry.clear_cache()
+        return res
+
     @api.model
     def _get_compatible_providers(
             self, *args, currency_id=None, is_validation=False, **kwargs
@@ -81,23 +136,151 @@ class PaymentProviderMBBank(models.Model):
             )
         return supported_currencies
 
+    def _mbbank_uses_emulator(self):
+        """Whether the MB Bank API calls go to the local gateway emulator."""
+        self.ensure_one()
+        return self.state == 'test' and bool(self.mb_emulator_url)
+
+    def _get_mbbank_base_url(self):
+        """Get the MB Bank API base URL based on environment."""
+        self.ensure_one()
+        if self._mbbank_uses_emulator():
+            return self.mb_emulator_url.rstrip('/')
+        return const.SANDBOX_DOMAIN if self.state == 'test' else const.PRODUCTION_DOMAIN
+
     def _get_mbbank_api_url(self):
         """Get the appropriate MB Bank API URL based on environment."""
-        base_url = const.SANDBOX_DOMAIN if self.state == 'test' else const.PRODUCTION_DOMAIN
-        return f"{base_url}{const.CREATE_ORDER_PATH}"
+        return f"{self._get_mbbank_base_url()}{const.CREATE_ORDER_PATH}"
 
     def _get_mbbank_refund_url(self):
         """Get the appropriate MB Bank API URL based on environment."""
-        base_url = const.SANDBOX_DOMAIN if self.state == 'test' else const.PRODUCTION_DOMAIN
-        return f"{base_url}{const.REFUND_PATH}"
+        return f"{self._get_mbbank_base_url()}{const.REFUND_PATH}"
+
+    def _get_mbbank_http_client(self):
+        """Get the keep-alive HTTP client of this process for MB Bank API calls."""
+        ICP = self.env['ir.config_parameter'].sudo()
+        return http_client.get_client(
+            const.HTTP_POOL_SIZES,
+            const.HTTP_TIMEOUTS,
+            default_pool_size=const.HTTP_DEFAULT_POOL_SIZE,
+            max_retries=int(ICP.get_param('mbbank_odoo.http_max_retries', const.HTTP_DEFAULT_MAX_RETRIES)),
+            backoff_factor=float(ICP.get_param('mbbank_odoo.http_backoff_factor', const.HTTP_DEFAULT_BACKOFF_FACTOR)),
+            status_forcelist=const.HTTP_RETRY_STATUSES,
+            retried_operations=const.HTTP_RETRIED_OPERATIONS,
+        )
 
     def _get_mbbank_auth_token(self):
-        """Get OAuth 2.0 token for MB Bank API using Basic Authentication."""
-        from odoo.addons.mbbank_odoo import const
-        import base64
-        import requests
+        """Get OAuth 2.0 token for MB Bank API from the shared token cache.
 
-        auth_endpoint = f"{const.SANDBOX_DOMAIN}/oauth2/v1/token"
+        The token is stored on the provider so that every worker reuses it until it expires.
+        Shortly before expiry, the refresh cron is woken up to renew it in the background while
+        the current token keeps being used. Only when there is no valid token is one requested
+        inline, by one worker process at a time.
+        """
+        self.ensure_one()
+        provider_sudo = self.sudo()
+        token, expiry = self.env.cr.cache.get('mbbank_auth_tokens', {}).get(self.id) or (
+            provider_sudo.mb_access_token, provider_sudo.mb_token_expiry)
+        now = fields.Datetime.now()
+        if token and expiry and now < expiry:
+            # Chỉ đánh thức cron một lần cho mỗi token trong cursor này
+            triggered = self.env.cr.cache.setdefault('mbbank_token_refresh_triggered', {})
+            if now >= expiry - timedelta(seconds=const.TOKEN_REFRESH_MARGIN) and triggered.get(self.id) != expiry:
+                triggered[self.id] = expiry
+                self.env.ref('mbbank_odoo.ir_cron_refresh_mbbank_auth_tokens').sudo()._trigger()
+            return token
+        return self._fetch_and_store_mbbank_auth_token()
+
+    def _fetch_and_store_mbbank_auth_token(self):
+        """Request a new token for the provider unless another worker process is already doing it.
+
+        The requests are serialized by an advisory lock on the provider, taken in a new cursor.
+        The worker getting the lock requests the token and stores it before releasing the lock;
+        the others wait up to `TOKEN_LOCK_WAIT` seconds and use the stored token instead of
+        requesting another one. If the caller holds a lock on the provider, e.g. after a write()
+        that cleared the token, the token is stored once the current transaction is committed.
+
+        Returns:
+            The new token, or None if it could not be obtained
+        """
+        dbname, provider_id = self.env.cr.dbname, self.id
+        deadline = time.monotonic() + const.TOKEN_LOCK_WAIT
+        with Registry(dbname).cursor() as cr:
+            while True:
+                cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (const.TOKEN_LOCK_NAMESPACE, provider_id))
+                locked = cr.fetchone()[0]
+                cr.execute(f"SELECT mb_access_token, mb_token_expiry FROM {self._table} WHERE id = %s",
+                           (provider_id,))
+                token, expiry = cr.fetchone()
+                if token and expiry and fields.Datetime.now() < expiry:
+                    # Token vừa được một tiến trình khác lấy và lưu
+                    self.env.cr.cache.setdefault('mbbank_auth_tokens', {})[self.id] = (token, expiry)
+                    return token
+                if locked:
+                    break
+                if time.monotonic() >= deadline:
+                    _logger.warning("Timed out waiting for another worker to obtain the MB Bank token of provider %s",
+                                    provider_id)
+                    return None
+                # Kết thúc transaction để lần đọc tiếp theo thấy token vừa được commit
+                cr.rollback()
+                time.sleep(const.TOKEN_LOCK_POLL_INTERVAL)
+
+            token, expires_in = self._fetch_mbbank_auth_token()
+            if not token:
+                return None
+            expiry = fields.Datetime.now() + timedelta(seconds=expires_in)
+            # Các lệnh gọi tiếp theo trong cùng transaction dùng lại token này
+            self.env.cr.cache.setdefault('mbbank_auth_tokens', {})[self.id] = (token, expiry)
+            _logger.info("Obtained MB Bank token for provider %s, valid for %s seconds", self.id, expires_in)
+
+            # Không ghi đè token mới hơn, ví dụ do cron làm mới
+            values = {'mb_access_token': token, 'mb_token_expiry': expiry}
+            where, params = "mb_token_expiry IS NULL OR mb_token_expiry < %s", (expiry,)
+            if locking.try_update(cr, self._table, [provider_id], values, where=where, params=params):
+                return token
+
+        # Bản ghi đang bị khoá, có thể bởi chính transaction gọi: lưu sau khi transaction này commit
+        @self.env.cr.postcommit.add
+        def store_token():
+            with Registry(dbname).cursor() as cr:
+                locking.try_update(cr, self._table, [provider_id], values, where=where, params=params)
+        return token
+
+    @api.model
+    def _cron_refresh_mbbank_auth_tokens(self):
+        """Renew the MB Bank tokens that are about to expire, so that requests never wait for one"""
+        now = fields.Datetime.now()
+        providers = self.search([
+            ('code', '=', 'mbbank'),
+            ('state', '!=', 'disabled'),
+            ('mb_access_token', '!=', False),
+            ('mb_token_expiry', '>', now),
+            ('mb_token_expiry', '<=', now + timedelta(seconds=const.TOKEN_REFRESH_MARGIN)),
+        ])
+        for provider in providers:
+            # Bỏ qua nhà cung cấp mà một tiến trình khác đang lấy token
+            self.env.cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (const.TOKEN_LOCK_NAMESPACE, provider.id))
+            if not self.env.cr.fetchone()[0]:
+                continue
+            token, expires_in = provider._fetch_mbbank_auth_token()
+            if not token:
+                continue
+            provider.write({
+                'mb_access_token': token,
+                'mb_token_expiry': fields.Datetime.now() + timedelta(seconds=expires_in),
+            })
+            self.env.cr.commit()
+            _logger.info("Refreshed MB Bank token for provider %s, valid for %s seconds", provider.id, expires_in)
+
+    def _fetch_mbbank_auth_token(self):
+        """Request a new OAuth 2.0 token for MB Bank API using Basic Authentication.
+
+        Returns:
+            Tuple of (token, lifetime in seconds), or (None, None) on failure
+        """
+        base_url = self._get_mbbank_base_url() if self._mbbank_uses_emulator() else const.SANDBOX_DOMAIN
+        auth_endpoint = f"{base_url}{const.TOKEN_PATH}"
 
         # Sử dụng username và password được cung cấp
         username = self.mb_username  # RKzfCQIZBosvPVSXbi4kL4LRg45njNjr
@@ -117,16 +300,19 @@ class PaymentProviderMBBank(models.Model):
         }
 
         try:
-            response = requests.post(auth_endpoint, headers=headers, data=data)
+            response = self._get_mbbank_http_client().post(
+                auth_endpoint, 'token', provider=self.id, headers=headers, data=data
+            )
             if response.status_code == 200:
                 token_data = response.json()
-                return token_data.get('access_token')
+                expires_in = int(token_data.get('expires_in') or const.TOKEN_DEFAULT_LIFETIME)
+                return token_data.get('access_token'), expires_in
             else:
                 _logger.error("Failed to obtain MB Bank authorization token: %s", response.text)
-                return None
+                return None, None
         except Exception as e:
             _logger.exception("Error obtaining MB Bank token: %s", str(e))
-            return None
+            return None, None
 
     def _generate_mbbank_signature(self, params, mac_type='MD5'):
         """Generate signature for MB Bank request.
@@ -135,23 +321,33 @@ class PaymentProviderMBBank(models.Model):
             params: Dictionary of parameters to sign
             mac_type: Type of MAC algorithm to use ('MD5' or 'SHA256')
         """
-        # Tạo bản sao của params để không thay đổi params gốc
-        sign_params = {k: str(v) for k, v in params.items() if k not in ['mac', 'mac_type']}
+        return get_signer(self.mb_hash_secret).sign(params, mac_type)
 
-        # Sắp xếp tham số theo thứ tự bảng chữ cái
-        sign_string = "&".join([f"{key}={sign_params[key]}" for key in sorted(sign_params.keys())])
+    @tools.ormcache()
+    def _get_mbbank_signing_keys(self):
+        """Get the (provider id, merchant id, hash secret) of every enabled MB Bank provider.
 
-        # Tạo dữ liệu để băm - Hash Secret đặt ở đầu chuỗi
-        sign_data = self.mb_hash_secret + sign_string
+        The result is cached in memory so that IPN signatures can be checked without any query.
+        """
+        providers = self.sudo().search([('code', '=', 'mbbank'), ('state', '!=', 'disabled')])
+        return tuple((p.id, p.mb_merchant_id, p.mb_hash_secret) for p in providers)
 
-        # Log để debug
-        _logger.debug(f"String to hash ({mac_type}): {sign_data}")
+    @api.model
+    def _verify_mbbank_notification(self, notification_data):
+        """Find the MB Bank provider whose hash secret signed an IPN notification.
 
-        # Tạo băm dựa trên kiểu mac
-        if mac_type.upper() == 'MD5':
-            return hashlib.md5(sign_data.encode('utf-8')).hexdigest().upper()
-        else:  # SHA256
-            return hashlib.sha256(sign_data.encode('utf-8')).hexdigest().upper()
+        Returns:
+            The id of the provider, or None if the signature is invalid
+        """
+        if not notification_data.get('mac'):
+            return None
+        merchant_id = notification_data.get('merchant_id')
+        for provider_id, provider_merchant_id, hash_secret in self._get_mbbank_signing_keys():
+            if merchant_id and provider_merchant_id and merchant_id != provider_merchant_id:
+                continue
+            if get_signer(hash_secret).verify(notification_data):
+                return provider_id
+        return None
 
     def _get_default_payment_method_codes(self):
         """Override of payment to return the default payment method codes."""
@@ -3,14 +3,18 @@ import json
 import uuid
 import hmac
 import hashlib
-import requests
+from collections import defaultdict
 from datetime import datetime, timedelta
 from werkzeug import urls
 
 from odoo import _, models, fields, api
 from odoo.exceptions import ValidationError
+from odoo.tools import split_every
 from odoo.http import request
 from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tools import gateway_log, http_client, locking, metrics, profiling, single_flight
+from odoo.addons.mbbank_odoo.tools.cron import trigger_cron_at
+from odoo.addons.mbbank_odoo.tools.signature import get_signer
 from odoo.addons.mbbank_odoo.controllers.main import MBBankController
 
 _logger = logging.getLogger(__name__)
@@ -29,8 +33,14 @@ class PaymentTransaction(models.Model):
                                        string='MB Bank Processing Record')
     mb_retry_id = fields.One2many('mbbank.transaction.retry', 'transaction_id', string='MB Bank Retry Record')
     mb_expire_time = fields.Datetime(string="MB Bank Expire Time", readonly=True)
+    mb_gateway_state_rank = fields.Integer(string="MB Bank Gateway State Rank", readonly=True)
     # mb_refund_id = fields.Char(string="MB Bank Refund ID", readonly=True)
 
+    _sql_constraints = [
+        ('mb_transaction_id_uniq', 'unique(mb_transaction_id, provider_id)',
+         "The MB Bank transaction ID must be unique per provider."),
+    ]
+
     # @api.model
     # def _compute_reference(self, provider_code, prefix=None, separator='c', **kwargs):
     #     """Override để tạo reference không chứa ký tự đặc biệt cho MB Bank."""
@@ -45,6 +55,8 @@ class PaymentTransaction(models.Model):
     #         # Giữ nguyên hành vi cho các provider khác
     #         return super()._compute_reference(provider_code, prefix, separator, **kwargs)
 
+    @profiling.profiled('rendering', lambda tx, *args, **kwargs: tx.provider_id.filtered(
+        lambda provider: provider.code == 'mbbank'))
     def _get_specific_rendering_values(self, processing_values):
         """Override to return MB Bank-specific rendering values."""
         self.ensure_one()
@@ -72,6 +84,12 @@ class PaymentTransaction(models.Model):
         ipn_url = "https://api-sandbox.mbbank.com.vn/integration-paygate-t4tek/v1.0/payIpn"
         return_url = urls.url_join("https://pay-dev.t4tek.tk", MBBankController._return_url)
         cancel_url = urls.url_join("https://pay-dev.t4tek.tk", MBBankController._cancel_url)
+        if self.provider_id._mbbank_uses_emulator():
+            # Emulator gọi IPN trực tiếp về Odoo
+            base_url = self.provider_id.get_base_url()
+            ipn_url = urls.url_join(base_url, MBBankController._ipn_url)
+            return_url = urls.url_join(base_url, MBBankController._return_url)
+            cancel_url = urls.url_join(base_url, MBBankController._cancel_url)
 
         params = {
             'amount': str(int(self.amount)),
@@ -87,21 +105,17 @@ class PaymentTransaction(models.Model):
             'pay_type': 'pay',
             'payment_method': self.provider_id.mb_payment_method,
         }
-        # Thêm log để hiển thị tham số trước khi tạo chữ ký
-        _logger.info("====== MB BANK REQUEST PARAMS ======")
-        _logger.info(json.dumps(params, indent=2))
-        _logger.info("======================================")
+        gateway_log.log_event('create_order_request', reference=self.reference, params=params)
 
         # Tạo MAC signature
         params['mac'] = self.provider_id._generate_mbbank_signature(params, 'MD5')
 
         # Gửi request
         try:
-            response = requests.post(create_order_url, json=params, headers=headers)
-            response_data = response.json()
-            _logger.info("====== MB BANK RESPONSE ======")
-            _logger.info(json.dumps(response_data, indent=2))
-            _logger.info("==============================")
+            _response, response_data = self.provider_id._get_mbbank_http_client().post_json(
+                create_order_url, 'create_order', provider=self.provider_id.id, json=params, headers=headers
+            )
+            gateway_log.log_event('create_order_response', reference=self.reference, response=response_data)
 
             if response_data.get('error_code') == '00':
                 # Lưu thông tin phản hồi
@@ -246,48 +260,175 @@ class PaymentTransaction(models.Model):
             _logger.warning("MB Bank notification missing signature")
             return False
 
-        # Lưu lại các giá trị để không bị mất sau khi pop
-        received_mac = notification_data.get('mac')
-        mac_type = notification_data.get('mac_type', 'SHA256')  # Mặc định SHA256 cho IPN
-
-        # Tạo bản sao dữ liệu không bao gồm các trường liên quan đến MAC
-        verification_data = {k: v for k, v in notification_data.items() if k not in ['mac', 'mac_type']}
+        # Với IPN luôn sử dụng SHA256, với các API khác sử dụng mac_type từ notification_data
+        is_valid = get_signer(self.provider_id.mb_hash_secret).verify(notification_data)
+        if not is_valid:
+            _logger.warning("Signature verification failed for transaction %s", self.reference)
 
-        # Tạo chuỗi ký tự cho chữ ký - sắp xếp alphabet
-        sign_string = "&".join([f"{k}={v}" for k, v in sorted(verification_data.items())])
+        return is_valid
 
-        # Thêm hash_secret vào đầu chuỗi - điều quan trọng
-        sign_data = self.provider_id.mb_hash_secret + sign_string
+    def _accept_mbbank_gateway_state(self, code):
+        """Record the rank of an MB Bank result code, unless it is older than the applied state.
 
-        _logger.debug(f"Signature verification - Data to sign: {sign_data}")
+        Returns:
+            False if the result is stale and must be dropped, True otherwise
+        """
+        self.ensure_one()
+        rank = const.GATEWAY_STATE_RANKS.get(code, const.GATEWAY_STATE_RANK_FINAL)
+        if rank < self.mb_gateway_state_rank:
+            _logger.info("Dropped stale MB Bank result %s for %s", code, self.reference)
+            return False
+        if rank > self.mb_gateway_state_rank:
+            self.write({'mb_gateway_state_rank': rank})
+        return True
+
+    def _schedule_mbbank_post_processing(self):
+        """Wake up the batched post-processing job for the transactions whose provider defers it.
+
+        The other transactions are left to Odoo: the payment status page and the standard
+        post-processing cron post-process them.
+        """
+        if any(tx.provider_id.mb_defer_post_processing for tx in self):
+            trigger_cron_at(self.env, 'mbbank_odoo.ir_cron_post_process_mbbank_transactions', [fields.Datetime.now()])
+
+    @api.model
+    @metrics.timed('cron_seconds', cron='post_process')
+    def _cron_post_process_mbbank_transactions(self, batch_size=None):
+        """Post-process the confirmed MB Bank transactions of the providers deferring it, in batches.
+
+        Transactions are handled in batches, each committed on its own. Transactions locked by
+        another worker, e.g. by the customer polling the payment status, are left to it.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not batch_size:
+            batch_size = int(ICP.get_param('mbbank_odoo.post_process_batch_size', const.POST_PROCESS_BATCH_SIZE))
+        chunk_size = int(ICP.get_param('mbbank_odoo.post_process_chunk_size', const.POST_PROCESS_CHUNK_SIZE))
+        domain = [
+            ('provider_id.code', '=', 'mbbank'),
+            ('provider_id.mb_defer_post_processing', '=', True),
+            ('state', '=', 'done'),
+            ('is_post_processed', '=', False),
+            ('last_state_change', '>=', fields.Datetime.now() - timedelta(days=const.POST_PROCESS_MAX_AGE_DAYS)),
+        ]
+
+        skipped_ids = []
+        processed_count = 0
+        while True:
+            txs = self.search(domain + [('id', 'not in', skipped_ids)], limit=batch_size, order='id')
+            if not txs:
+                break
+            locked = self.browse(locking.try_lock(self.env.cr, self._table, txs.ids))
+            skipped_ids += (txs - locked).ids
+            try:
+                processed = locked._post_process_mbbank_batch(chunk_size)
+                self.env.cr.commit()
+                processed_count += len(processed)
+                skipped_ids += (locked - processed).ids
+            except Exception as e:
+                _logger.exception("Error post-processing %s MB Bank transactions: %s", len(locked), str(e))
+                self.env.cr.rollback()
+                skipped_ids += locked.ids
+            if len(txs) < batch_size:
+                break
+
+        if processed_count or skipped_ids:
+            _logger.info("Post-processed %s MB Bank transactions, %s skipped", processed_count, len(skipped_ids))
+
+    def _post_process_mbbank_batch(self, chunk_size):
+        """Post-process transactions grouped by company and partner, chunk by chunk.
+
+        The sale orders and invoices of all the transactions are fetched with a few bulk queries
+        beforehand, so that post-processing reads them from the cache instead of querying them
+        transaction by transaction. Each chunk runs in its own savepoint; the transactions of a
+        chunk that fails are post-processed one by one.
+
+        Returns:
+            The transactions that were post-processed
+        """
+        self.fetch(['company_id', 'partner_id', 'amount', 'currency_id', 'operation', 'state'])
+        orders = self.sale_order_ids
+        orders.fetch(['state', 'amount_total', 'currency_id', 'partner_id', 'company_id'])
+        orders.order_line.fetch(['product_id', 'product_uom_qty', 'qty_invoiced', 'price_unit'])
+        self.invoice_ids.fetch(['state', 'move_type', 'amount_residual', 'payment_state'])
+
+        groups = defaultdict(list)
+        for tx in self:
+            groups[tx.company_id, tx.partner_id].append(tx.id)
+
+        processed_ids = []
+        for (company, _partner), tx_ids in groups.items():
+            for chunk in split_every(chunk_size, tx_ids, self.with_company(company).browse):
+                try:
+                    with self.env.cr.savepoint():
+                        chunk._post_process()
+                    processed_ids += chunk.ids
+                except Exception as e:
+                    _logger.warning("Error post-processing %s MB Bank transactions together, "
+                                    "retrying them one by one: %s", len(chunk), str(e))
+                    for tx in chunk:
+                        try:
+                            with self.env.cr.savepoint():
+                                tx._post_process()
+                            processed_ids.append(tx.id)
+                        except Exception as e:
+                            _logger.exception("Error post-processing transaction %s: %s", tx.reference, str(e))
+        return self.browse(processed_ids)
+
+    @api.model
+    def _get_tx_from_mbbank_transaction_id(self, mb_transaction_id, provider=None):
+        """Find the transaction with the given MB Bank transaction number.
+
+        The search is served by the unique index on (mb_transaction_id, provider_id).
+        """
+        if not mb_transaction_id:
+            return self.browse()
+        domain = [('mb_transaction_id', '=', mb_transaction_id)]
+        if provider:
+            domain.append(('provider_id', '=', provider.id))
+        return self.search(domain, limit=1)
+
+    @api.model
+    def _get_tx_from_mbbank_request_id(self, request_id):
+        """Find the transaction of an MB Bank request ID through its processing or retry record"""
+        if not request_id:
+            return self.browse()
+        for model_name in ('mbbank.transaction.processing', 'mbbank.transaction.retry'):
+            record = self.env[model_name].sudo().search([('mb_request_id', '=', request_id)], limit=1)
+            if record:
+                return record.transaction_id.with_env(self.env)
+        return self.browse()
 
-        # Tính toán chữ ký - Với IPN luôn sử dụng SHA256
-        # Với các API khác, sử dụng mac_type từ notification_data
-        if mac_type.upper() == 'MD5':
-            calculated_mac = hashlib.md5(sign_data.encode('utf-8')).hexdigest().upper()
-        else:  # Mặc định là SHA256
-            calculated_mac = hashlib.sha256(sign_data.encode('utf-8')).hexdigest().upper()
+    def _query_mbbank_transaction_status(self):
+        """Query the current status of an MB Bank transaction."""
+        self.ensure_one()
+        _logger.info("Querying MB Bank transaction status for %s", self.reference)
 
-        # Log để kiểm tra lỗi
-        _logger.debug(f"Signature: Received={received_mac}, Calculated={calculated_mac}")
+        query = self._prepare_mbbank_status_query()
+        if not query:
+            return
 
-        # So sánh chữ ký an toàn
-        is_valid = hmac.compare_digest(received_mac, calculated_mac)
-        if not is_valid:
-            _logger.warning(f"Signature verification failed: {received_mac} vs {calculated_mac}")
+        # Call API
+        response_data, error = http_client.post_json_concurrently(
+            [query], 'status_query', flight=single_flight.status_queries)[0]
+        if error is not None:
+            _logger.error("Error querying MB Bank transaction status: %s", str(error), exc_info=error)
+            return
+        self._apply_mbbank_status_result(response_data)
 
-        return is_valid
+    def _prepare_mbbank_status_query(self):
+        """Build the status query of an MB Bank transaction.
 
-    def _query_mbbank_transaction_status(self):
-        """Query the current status of an MB Bank transaction."""
+        Returns:
+            Dictionary of request arguments for http_client.post_json_concurrently, or None if
+            no token could be obtained
+        """
         self.ensure_one()
-        _logger.info("Querying MB Bank transaction status for %s", self.reference)
 
         # Khởi tạo và lấy token OAuth
         token = self.provider_id._get_mbbank_auth_token()
         if not token:
             _logger.error("Failed to obtain MB Bank token for transaction status query")
-            return
+            return None
 
         # Chuẩn bị tham số truy vấn
         params = {
@@ -307,27 +448,35 @@ class PaymentTransaction(models.Model):
             'ClientMessageId': str(uuid.uuid4())
         }
 
-        # Call API
-        try:
-            api_url = f"{const.SANDBOX_DOMAIN if self.provider_id.state == 'test' else const.PRODUCTION_DOMAIN}/private/ms/pg-paygate-authen/v2/paygate/detail"
-            response = requests.post(api_url, json=params, headers=headers)
-            response_data = response.json()
+        base_url = self.provider_id._get_mbbank_base_url()
+        return {
+            'client': self.provider_id._get_mbbank_http_client(),
+            'url': f"{base_url}{const.QUERY_STATUS_PATH}",
+            'provider': self.provider_id.id,
+            'json': params,
+            'headers': headers,
+            'flight_key': (self.env.cr.dbname, self.reference),
+        }
 
-            if response_data.get('error_code') == '00':
-                # Process transaction based on resp_code
-                resp_code = response_data.get('resp_code')
-                if resp_code == '00':
-                    self._set_done()
-                    self.mb_transaction_id = response_data.get('transaction_number')
-                    self.mb_ft_code = response_data.get('ft_code')
-                elif resp_code in ['12', '16']:
-                    self._set_pending()
-                else:
-                    self._set_error(f"MB Bank: {response_data.get('message', 'Unknown error')}")
+    def _apply_mbbank_status_result(self, response_data):
+        """Update the transaction from the answer of a status query."""
+        self.ensure_one()
+        if response_data.get('error_code') == '00':
+            # Process transaction based on resp_code
+            resp_code = response_data.get('resp_code')
+            if not self._accept_mbbank_gateway_state(resp_code):
+                return
+            if resp_code == '00':
+                self._set_done()
+                self.mb_transaction_id = response_data.get('transaction_number')
+                self.mb_ft_code = response_data.get('ft_code')
+                self._schedule_mbbank_post_processing()
+            elif resp_code in ['12', '16']:
+                self._set_pending()
             else:
-                _logger.warning("MB Bank transaction status query failed: %s", response_data.get('message'))
-        except Exception as e:
-            _logger.exception("Error querying MB Bank transaction status: %s", str(e))
+                self._set_error(f"MB Bank: {response_data.get('message', 'Unknown error')}")
+        else:
+            _logger.warning("MB Bank transaction status query failed: %s", response_data.get('message'))
 
     def _send_refund_request(self, amount_to_refund=None):
         """Request a refund for the transaction through MB Bank API."""
@@ -369,10 +518,7 @@ class PaymentTransaction(models.Model):
         # Generate MAC signature
         params['mac'] = self.provider_id._generate_mbbank_signature(params, 'MD5')
 
-        # Log request parameters for debugging
-        _logger.info("====== MB BANK REFUND REQUEST PARAMS ======")
-        _logger.info(json.dumps(params, indent=2))
-        _logger.info("======================================")
+        gateway_log.log_event('refund_request', reference=self.reference, params=params)
 
         # Prepare headers
         headers = {
@@ -396,13 +542,11 @@ class PaymentTransaction(models.Model):
         # Call MB Bank refund API
         try:
             refund_url = self.provider_id._get_mbbank_refund_url()
-            response = requests.post(refund_url, json=params, headers=headers, timeout=30)
-            response_data = response.json()
+            _response, response_data = self.provider_id._get_mbbank_http_client().post_json(
+                refund_url, 'refund', provider=self.provider_id.id, json=params, headers=headers
+            )
 
-            # Log response for debugging
-            _logger.info("====== MB BANK REFUND RESPONSE ======")
-            _logger.info(json.dumps(response_data, indent=2))
-            _logger.info("==============================")
+            gateway_log.log_event('refund_response', reference=self.reference, response=response_data)
 
             # Process response
             if response_data.get('error_code') == '00':
@@ -411,8 +555,7 @@ class PaymentTransaction(models.Model):
                 refund_tx.write({
                     'state': 'done',
                     'state_message': f"Refund successful: {response_data.get('message', 'Success')}",
-                    'mb_refund_id': response_data.get('refund_id'),
-                    'mb_transaction_id': response_data.get('refund_id', self.mb_transaction_id),
+                    'mb_transaction_id': response_data.get('refund_id'),
                     'mb_ft_code': response_data.get('refund_reference_id', self.mb_ft_code),
                 })
                 # Update source transaction state
@@ -0,0 +1,334 @@
+"""Local MB Bank gateway emulator for offline development and load tests.
+
+Implements the token, create-order, detail (status query) and refund endpoints of MB Bank, with
+configurable latency, HTTP failures and outcome distribution, and fires signed IPNs back at the
+`ipn_url` of each order, like MB Bank does.
+
+The emulator only uses the standard library; it signs with the module's own signer so that its
+MACs always match what the module verifies.
+
+Usage:
+    python mbbank_odoo/scripts/mbbank_emulator.py --hash-secret SECRET --port 8078 \\
+        --latency 20:80 --ipn-delay 1:3 --ipn-codes 00=0.95,18=0.03,92=0.02 --http-errors 503=0.01
+
+Then set the Emulator URL of the MB Bank provider (test mode) to http://localhost:8078.
+Counters are served as JSON on GET /_emulator/stats.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_logger = logging.getLogger('mbbank_emulator')
+
+# Dùng cùng đường dẫn API với module (const.py)
+TOKEN_PATH = "/oauth2/v1/token"
+CREATE_ORDER_PATH = "/private/ms/pg-paygate-authen/paygate/v2/create-order"
+QUERY_STATUS_PATH = "/private/ms/pg-paygate-authen/v2/paygate/detail"
+REFUND_PATH = "/private/ms/pg-paygate-authen/paygate/refund/single"
+STATS_PATH = "/_emulator/stats"
+
+# IPN error codes that only mean the notification failed: the payment itself went through
+SYSTEM_ERROR_CODES = ('92', '93', '94', '95')
+MESSAGES = {
+    '00': "Success",
+    '12': "Transaction is processing",
+    '16': "Transaction is pending",
+    '18': "Transaction canceled by user",
+    '54': "Transaction expired",
+    '56': "Transaction failed",
+    '92': "System error",
+    '93': "System error",
+    '94': "System error",
+    '95': "System error",
+}
+
+
+def _load_signer_class():
+    """Load MBBankSigner from the module without importing Odoo"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools', 'signature.py')
+    spec = importlib.util.spec_from_file_location('mbbank_signature', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.MBBankSigner
+
+
+def parse_range(value):
+    """Parse 'MIN:MAX' (or a single value) into a (min, max) tuple of floats"""
+    low, _sep, high = value.partition(':')
+    return float(low), float(high or low)
+
+
+def parse_distribution(value):
+    """Parse 'code=weight,code=weight' into a list of (code, weight)"""
+    distribution = []
+    for item in filter(None, value.split(',')):
+        code, _sep, weight = item.partition('=')
+        distribution.append((code.strip(), float(weight or 1)))
+    return distribution
+
+
+class Emulator:
+    """State of the emulated gateway: orders, IPN queue and counters"""
+
+    def __init__(self, options):
+        self.options = options
+        self.signer = _load_signer_class()(options.hash_secret)
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.ipn_queue = queue.Queue()
+        self.ipn_codes = parse_distribution(options.ipn_codes)
+        self.http_errors = parse_distribution(options.http_errors)
+
+    # Helpers
+
+    def sleep_latency(self):
+        low, high = parse_range(self.options.latency)
+        time.sleep(random.uniform(low, high) / 1000)
+
+    def draw_http_error(self):
+        """Return an HTTP status to fail with, or None"""
+        draw = random.random()
+        for status, probability in self.http_errors:
+            if draw < probability:
+                return int(status)
+            draw -= probability
+        return None
+
+    def draw_ipn_code(self):
+        codes, weights = zip(*self.ipn_codes)
+        return random.choices(codes, weights)[0]
+
+    def check_mac(self, params):
+        if not self.options.check_mac:
+            return True
+        return self.signer.sign(params, params.get('mac_type') or 'MD5') == str(params.get('mac', '')).upper()
+
+    @staticmethod
+    def order_key(reference):
+        # Module gửi PSQR<reference> (thay '-' bằng 'e') khi tạo đơn và <reference> khi truy vấn
+        reference = reference or ''
+        return (reference[4:] if reference.startswith('PSQR') else reference).replace('-', 'e')
+
+    # Endpoints
+
+    def token(self, _params):
+        self.stats['token'] += 1
+        return 200, {'access_token': uuid.uuid4().hex, 'token_type': 'bearer', 'expires_in': self.options.token_lifetime}
+
+    def create_order(self, params):
+        self.stats['create_order'] += 1
+        if not self.check_mac(params):
+            self.stats['create_order_bad_mac'] += 1
+            return 200, {'error_code': '91', 'message': "Invalid signature"}
+
+        reference = params.get('order_reference')
+        ipn_delay = random.uniform(*parse_range(self.options.ipn_delay))
+        order = {
+            'order_reference': reference,
+            'amount': params.get('amount'),
+            'ipn_url': self.options.ipn_url or params.get('ipn_url'),
+            'outcome': self.draw_ipn_code(),
+            'transaction_number': str(random.randint(10 ** 11, 10 ** 12 - 1)),
+            'ft_code': f"FT{random.randint(10 ** 9, 10 ** 10 - 1)}",
+            'notify_at': time.monotonic() + ipn_delay,
+        }
+        with self.lock:
+            self.orders[self.order_key(reference)] = order
+        if not self.options.no_ipn and order['ipn_url']:
+            self.ipn_queue.put((order['notify_at'], order))
+
+        session_id = uuid.uuid4().hex
+        expire_time = datetime.now() + timedelta(minutes=self.options.order_lifetime)
+        base_url = f"http://{self.options.host}:{self.options.port}"
+        return 200, {
+            'error_code': '00',
+            'message': "Success",
+            'session_id': session_id,
+            'payment_url': f"{base_url}/pay/{session_id}",
+            'qr_url': f"{base_url}/qr/{session_id}",
+            'expire_time': expire_time.strftime('%d-%m-%Y %H:%M:%S'),
+        }
+
+    def detail(self, params):
+        self.stats['status_query'] += 1
+        if not self.check_mac(params):
+            return 200, {'error_code': '91', 'message': "Invalid signature"}
+        with self.lock:
+            order = self.orders.get(self.order_key(params.get('order_reference')))
+            if not order and self.options.accept_unknown_orders:
+                # Đơn không tạo qua emulator (vd. dữ liệu benchmark): kết quả rút ngẫu nhiên ngay
+                order = self.orders[self.order_key(params.get('order_reference'))] = {
+                    'order_reference': params.get('order_reference'),
+                    'outcome': self.draw_ipn_code(),
+                    'transaction_number': str(random.randint(10 ** 11, 10 ** 12 - 1)),
+                    'ft_code': f"FT{random.randint(10 ** 9, 10 ** 10 - 1)}",
+                    'notify_at': time.monotonic(),
+                }
+        if not order:
+            return 200, {'error_code': '01', 'message': "Order not found"}
+
+        if time.monotonic() < order['notify_at']:
+            resp_code = '12'
+        elif order['outcome'] in SYSTEM_ERROR_CODES:
+            resp_code = '00'
+        else:
+            resp_code = order['outcome']
+        return 200, {
+            'error_code': '00',
+            'resp_code': resp_code,
+            'message': MESSAGES.get(resp_code, "Unknown"),
+            'transaction_number': order['transaction_number'],
+            'ft_code': order['ft_code'],
+        }
+
+    def refund(self, params):
+        self.stats['refund'] += 1
+        if not self.check_mac(params):
+            return 200, {'error_code': '91', 'message': "Invalid signature"}
+        return 200, {
+            'error_code': '00',
+            'message': "Success",
+            'refund_id': str(random.randint(10 ** 11, 10 ** 12 - 1)),
+            'refund_reference_id': f"FT{random.randint(10 ** 9, 10 ** 10 - 1)}",
+            'refund_amount': params.get('txn_amount'),
+        }
+
+    # IPN
+
+    def build_ipn(self, order):
+        notification = {
+            'merchant_id': self.options.merchant_id,
+            'pg_order_reference': order['order_reference'],
+            'pg_transaction_number': order['transaction_number'],
+            'pg_issuer_txn_reference': order['ft_code'],
+            'pg_amount': order['amount'],
+            'error_code': order['outcome'],
+            'message': MESSAGES.get(order['outcome'], "Unknown"),
+            'mac_type': 'SHA256',
+        }
+        notification['mac'] = self.signer.sign(notification, 'SHA256')
+        return notification
+
+    def send_ipn(self, order):
+        body = json.dumps(self.build_ipn(order)).encode()
+        request = urllib.request.Request(order['ipn_url'], data=body, headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.options.ipn_timeout) as response:
+                response.read()
+                self.stats[f"ipn_{response.status}"] += 1
+        except Exception as e:
+            self.stats['ipn_failed'] += 1
+            _logger.warning("IPN for %s failed: %s", order['order_reference'], e)
+        finally:
+            with self.lock:
+                self.stats['ipn_total_ms'] += int((time.perf_counter() - start) * 1000)
+
+    def ipn_worker(self):
+        while True:
+            notify_at, order = self.ipn_queue.get()
+            delay = notify_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.send_ipn(order)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    emulator = None
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == STATS_PATH:
+            return self._reply(200, dict(self.emulator.stats, orders=len(self.emulator.orders)))
+        return self._reply(404, {'message': "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length).decode() if length else ''
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(raw or '{}')
+        else:
+            params = dict(item.split('=', 1) for item in raw.split('&') if '=' in item)
+
+        routes = {
+            TOKEN_PATH: self.emulator.token,
+            CREATE_ORDER_PATH: self.emulator.create_order,
+            QUERY_STATUS_PATH: self.emulator.detail,
+            REFUND_PATH: self.emulator.refund,
+        }
+        route = routes.get(self.path)
+        if not route:
+            return self._reply(404, {'message': "Not found"})
+
+        self.emulator.sleep_latency()
+        error_status = self.emulator.draw_http_error()
+        if error_status:
+            self.emulator.stats[f"http_{error_status}"] += 1
+            return self._reply(error_status, {'message': "Emulated failure"})
+        return self._reply(*route(params))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8078)
+    parser.add_argument('--hash-secret', required=True, help="hash secret configured on the provider")
+    parser.add_argument('--merchant-id', default='', help="merchant_id put in the IPNs")
+    parser.add_argument('--latency', default='20:80', help="API latency range in milliseconds, MIN:MAX")
+    parser.add_argument('--http-errors', default='', help="HTTP failure probabilities, e.g. 503=0.01,504=0.005")
+    parser.add_argument('--ipn-codes', default='00=1', help="IPN error_code distribution, e.g. 00=0.95,18=0.05")
+    parser.add_argument('--ipn-delay', default='1:3', help="delay before the IPN in seconds, MIN:MAX")
+    parser.add_argument('--ipn-url', help="send the IPNs here instead of the ipn_url of the orders")
+    parser.add_argument('--ipn-workers', type=int, default=8, help="IPNs sent at the same time")
+    parser.add_argument('--ipn-timeout', type=float, default=10)
+    parser.add_argument('--no-ipn', action='store_true', help="never send IPNs (status queries only)")
+    parser.add_argument('--accept-unknown-orders', action='store_true',
+                        help="answer status queries of orders not created here with an outcome from --ipn-codes")
+    parser.add_argument('--no-check-mac', dest='check_mac', action='store_false', help="accept any request MAC")
+    parser.add_argument('--token-lifetime', type=int, default=300)
+    parser.add_argument('--order-lifetime', type=int, default=15, help="minutes before an order expires")
+    parser.add_argument('--log-level', default='INFO')
+    options = parser.parse_args()
+    logging.basicConfig(level=options.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    emulator = Emulator(options)
+    for _i in range(options.ipn_workers):
+        threading.Thread(target=emulator.ipn_worker, daemon=True).start()
+
+    Handler.emulator = emulator
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    _logger.info("MB Bank emulator listening on http://%s:%s", options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _logger.info("Stats: %s", dict(emulator.stats))
+
+
+if __name__ == '__main__':
+    main()
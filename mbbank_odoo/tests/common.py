@@ -0,0 +1,18 @@
+from odoo.addons.payment.tests.common import PaymentCommon
+
+
+class MBBankCommon(PaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.mbbank = cls._prepare_provider('mbbank', update_values={
+            'mb_merchant_id': '111111',
+            'mb_hash_secret': 'test_hash_secret',
+            'mb_username': 'test_username',
+            'mb_password': 'test_password',
+        })
+        cls.provider = cls.mbbank
+
+    def _create_mbbank_transaction(self, reference):
+        return self._create_transaction('redirect', reference=reference)
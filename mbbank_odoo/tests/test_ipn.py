@@ -0,0 +1,99 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tests.common import MBBankCommon
+from odoo.addons.mbbank_odoo.tools.signature import get_signer
+
+
+@tagged('post_install', '-at_install')
+class TestMBBankIPN(MBBankCommon):
+
+    def _notification(self, **values):
+        return {
+            'pg_order_reference': self.reference,
+            'pg_transaction_number': 'FT0001',
+            'error_code': '00',
+            **values,
+        }
+
+    def test_redelivered_notification_is_registered_once(self):
+        Ledger = self.env['mbbank.ipn.ledger']
+        notification = self._notification()
+        self.assertTrue(Ledger._register_notification(self.mbbank.id, notification))
+        self.assertFalse(Ledger._register_notification(self.mbbank.id, notification))
+        # Một kết quả khác của cùng giao dịch là một thông báo mới
+        self.assertTrue(Ledger._register_notification(self.mbbank.id, self._notification(error_code='12')))
+
+    def test_notification_without_transaction_number_is_always_accepted(self):
+        Ledger = self.env['mbbank.ipn.ledger']
+        notification = self._notification(pg_transaction_number='')
+        self.assertTrue(Ledger._register_notification(self.mbbank.id, notification))
+        self.assertTrue(Ledger._register_notification(self.mbbank.id, notification))
+
+    def test_forgotten_notification_is_only_accepted_again_for_its_provider(self):
+        Ledger = self.env['mbbank.ipn.ledger']
+        other_provider = self.mbbank.copy()
+        notification = self._notification()
+        Ledger._register_notification(self.mbbank.id, notification)
+        Ledger._register_notification(other_provider.id, notification)
+
+        Ledger._forget_notification(self.mbbank.id, notification)
+        self.assertTrue(Ledger._register_notification(self.mbbank.id, notification))
+        self.assertFalse(Ledger._register_notification(other_provider.id, notification))
+
+    def test_signing_keys_follow_created_and_deleted_providers(self):
+        Provider = self.env['payment.provider']
+        notification = self._notification()
+        notification['mac'] = get_signer('other_hash_secret').sign(notification, 'SHA256')
+        self.assertIsNone(Provider._verify_mbbank_notification(notification))
+
+        other_provider = Provider.create({
+            'name': "MB Bank (other)",
+            'code': 'mbbank',
+            'state': 'test',
+            'mb_hash_secret': 'other_hash_secret',
+        })
+        self.assertEqual(Provider._verify_mbbank_notification(notification), other_provider.id)
+
+        other_provider.unlink()
+        self.assertIsNone(Provider._verify_mbbank_notification(notification))
+
+    def test_older_gateway_state_is_dropped(self):
+        tx = self._create_mbbank_transaction(self.reference)
+        self.assertTrue(tx._accept_mbbank_gateway_state('12'))
+        self.assertEqual(tx.mb_gateway_state_rank, const.GATEWAY_STATE_RANK_PENDING)
+        self.assertTrue(tx._accept_mbbank_gateway_state('00'))
+        self.assertEqual(tx.mb_gateway_state_rank, const.GATEWAY_STATE_RANK_FINAL)
+        self.assertFalse(tx._accept_mbbank_gateway_state('12'))
+        self.assertEqual(tx.mb_gateway_state_rank, const.GATEWAY_STATE_RANK_FINAL)
+
+    def test_process_again_resets_the_attempts(self):
+        notification = self.env['mbbank.ipn.inbox']._enqueue_notification(self.mbbank.id, self._notification())
+        notification.write({'state': 'error', 'attempts': const.IPN_MAX_ATTEMPTS, 'error_message': "Failed"})
+
+        notification.action_process_again()
+        self.assertRecordValues(notification, [{
+            'provider_id': self.mbbank.id,
+            'state': 'new',
+            'attempts': 0,
+            'next_attempt': False,
+            'error_message': False,
+        }])
+
+    def test_failed_notification_is_forgotten_after_the_last_attempt(self):
+        Ledger = self.env['mbbank.ipn.ledger']
+        payload = self._notification()
+        Ledger._register_notification(self.mbbank.id, payload)
+        notification = self.env['mbbank.ipn.inbox']._enqueue_notification(self.mbbank.id, payload)
+        notification.attempts = const.IPN_MAX_ATTEMPTS - 1
+
+        processing_model = type(self.env['mbbank.transaction.processing'])
+        with patch.object(processing_model, '_handle_ipn_notification_data', side_effect=ValueError("Failed")):
+            processed = notification._process_notifications()
+
+        self.assertFalse(processed)
+        self.assertEqual(notification.state, 'error')
+        # Cổng thanh toán có thể gửi lại thông báo
+        self.assertTrue(Ledger._register_notification(self.mbbank.id, payload))
@@ -0,0 +1,99 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tests.common import MBBankCommon
+from odoo.addons.mbbank_odoo.tools import http_client
+
+
+@tagged('post_install', '-at_install')
+class TestMBBankRetryQueue(MBBankCommon):
+
+    def setUp(self):
+        super().setUp()
+        # Các claim được commit ngay để các worker khác thấy: không commit trong test
+        self.patch(self.env.cr, 'commit', lambda: None)
+        self.now = fields.Datetime.now()
+
+    def _create_retry(self, reference, next_retry, **values):
+        tx = self._create_mbbank_transaction(reference)
+        retry = self.env['mbbank.transaction.retry'].create_retry_transaction(tx)
+        retry.write({'next_retry': next_retry, **values})
+        return retry
+
+    def test_claim_only_takes_due_records_once(self):
+        due = self._create_retry('TEST-DUE', self.now - timedelta(minutes=1))
+        later = self._create_retry('TEST-LATER', self.now + timedelta(hours=1))
+        claimed_elsewhere = self._create_retry('TEST-CLAIMED', self.now - timedelta(minutes=1), state='processing')
+        retries = due | later | claimed_elsewhere
+
+        claimed = self.env['mbbank.transaction.retry']._claim_due_retries(const.RETRY_BATCH_SIZE)
+        self.assertEqual(claimed & retries, due)
+        self.assertEqual(due.state, 'processing')
+        self.assertTrue(due.claim_time)
+
+        claimed = self.env['mbbank.transaction.retry']._claim_due_retries(const.RETRY_BATCH_SIZE)
+        self.assertFalse(claimed & retries)
+
+    def test_stale_claims_are_released(self):
+        stale = self._create_retry('TEST-STALE', self.now, state='processing',
+                                   claim_time=self.now - timedelta(minutes=const.RETRY_CLAIM_TIMEOUT + 1))
+        recent = self._create_retry('TEST-RECENT', self.now, state='processing', claim_time=self.now)
+
+        self.env['mbbank.transaction.retry']._release_stale_claims()
+        self.assertRecordValues(stale | recent, [
+            {'state': 'retry', 'claim_time': False},
+            {'state': 'processing', 'claim_time': self.now},
+        ])
+
+    def test_transition_skips_records_in_another_state(self):
+        retry = self._create_retry('TEST-TRANSITION', self.now)
+        self.assertFalse(retry._try_transition('processing', {'state': 'retry'}))
+        self.assertEqual(retry._try_transition('retry', {'state': 'processing'}), retry)
+        self.assertEqual(retry.state, 'processing')
+
+    def test_older_status_answer_drops_the_retry(self):
+        retry = self._create_retry('TEST-OLDER', self.now, state='processing')
+        tx = retry.transaction_id
+        # Một IPN đã áp dụng trạng thái cuối cùng
+        tx._accept_mbbank_gateway_state('00')
+        tx._set_done()
+
+        self.assertFalse(retry._process_mbbank_response({'error_code': '00', 'resp_code': '12'}))
+        self.assertFalse(retry.exists())
+        self.assertEqual(tx.state, 'done')
+
+    def test_expired_transaction_with_unknown_status_is_postponed(self):
+        tx = self._create_mbbank_transaction('TEST-EXPIRED')
+        processing = self.env['mbbank.transaction.processing'].create({
+            'transaction_id': tx.id,
+            'timeout_time': self.now - timedelta(minutes=1),
+        })
+
+        tx_model = type(tx)
+        with patch.object(tx_model, '_prepare_mbbank_status_query', return_value={'url': 'status'}), \
+                patch.object(http_client, 'post_json_concurrently', return_value=[(None, TimeoutError())]):
+            to_cancel = processing._reconcile_expired_transactions()
+
+        self.assertFalse(to_cancel)
+        self.assertEqual(processing.expiry_checks, 1)
+        self.assertGreater(processing.timeout_time, self.now)
+        self.assertEqual(tx.state, 'draft')
+
+    def test_expired_transaction_confirmed_unpaid_is_canceled(self):
+        tx = self._create_mbbank_transaction('TEST-UNPAID')
+        processing = self.env['mbbank.transaction.processing'].create({
+            'transaction_id': tx.id,
+            'timeout_time': self.now - timedelta(minutes=1),
+        })
+
+        tx_model = type(tx)
+        answer = {'error_code': '00', 'resp_code': '12'}
+        with patch.object(tx_model, '_prepare_mbbank_status_query', return_value={'url': 'status'}), \
+                patch.object(http_client, 'post_json_concurrently', return_value=[(answer, None)]):
+            to_cancel = processing._reconcile_expired_transactions()
+
+        self.assertEqual(to_cancel, processing)
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+
+def _ceil_to_minute(dt):
+    if dt.second or dt.microsecond:
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    return dt
+
+
+def trigger_cron_at(env, xmlid, times):
+    """Trigger a cron at the given times, once the current transaction is committed.
+
+    Times are rounded up to the minute and deduplicated within the transaction, so that
+    scheduling many records at once only creates a few triggers.
+
+    Args:
+        env: The environment whose transaction schedules the cron
+        xmlid: XML id of the cron to trigger
+        times: Iterable of datetimes; empty values are ignored
+    """
+    times = {_ceil_to_minute(dt) for dt in times if dt}
+    if not times:
+        return
+
+    pending_times = env.cr.precommit.data.setdefault(f'trigger_cron_at.{xmlid}', set())
+    if not pending_times:
+        @env.cr.precommit.add
+        def trigger():
+            cron = env.ref(xmlid, raise_if_not_found=False)
+            if cron and pending_times:
+                cron.sudo()._trigger(sorted(pending_times))
+    pending_times.update(times)
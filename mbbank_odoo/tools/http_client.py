@@ -0,0 +1,179 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tools import metrics
+
+_logger = logging.getLogger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class GatewayHTTPClient:
+    """Keep-alive HTTP client shared by every call to the payment gateway in a process.
+
+    Connections are pooled per gateway host so that TCP and TLS sessions are reused across
+    checkouts, status queries, refunds and token requests.
+    """
+
+    def __init__(self, pool_sizes, timeouts, default_pool_size=4, max_retries=0, backoff_factor=0.0,
+                 status_forcelist=(), retried_operations=()):
+        """
+        Args:
+            pool_sizes: Dictionary of {host URL prefix: maximum number of kept-alive connections}
+            timeouts: Dictionary of {operation: (connect timeout, read timeout)} in seconds
+            default_pool_size: Pool size for hosts that are not listed in pool_sizes
+            max_retries: Number of retries on connection errors and retryable statuses
+            backoff_factor: Backoff factor between retries, see urllib3's Retry
+            status_forcelist: HTTP statuses that are retried
+            retried_operations: Idempotent operations that may be retried; the others are sent once
+        """
+        self.timeouts = timeouts
+        self.retried_operations = frozenset(retried_operations)
+        self._pool_sizes = pool_sizes
+        self._default_pool_size = default_pool_size
+        # Only connection errors and gateway statuses are retried: a read timeout may mean that the
+        # gateway already processed the request.
+        self.session = self._build_session(Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=status_forcelist,
+            allowed_methods=frozenset({'GET', 'POST'}),
+            raise_on_status=False,
+        ))
+        # Một 502/503/504 có thể đến sau khi cổng thanh toán đã xử lý yêu cầu: không gửi lại các
+        # thao tác không idempotent như tạo đơn hàng hay hoàn tiền
+        self.single_attempt_session = self._build_session(Retry(total=0, status=0, raise_on_status=False))
+
+    def _build_session(self, retry):
+        session = requests.Session()
+        for prefix in ('https://', 'http://'):
+            session.mount(prefix, HTTPAdapter(pool_maxsize=self._default_pool_size, max_retries=retry))
+        for host, pool_size in self._pool_sizes.items():
+            session.mount(host, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        return session
+
+    def post(self, url, operation, provider=None, **kwargs):
+        """Send a POST request with the timeout configured for the operation.
+
+        Args:
+            url: Endpoint to call
+            operation: Key of the operation in the timeouts, e.g. 'create_order'
+            provider: ID of the calling payment provider, recorded as a label of the metrics
+            **kwargs: Extra arguments passed to requests
+        """
+        return self._post(url, operation, kwargs, decode=False, provider=provider)[0]
+
+    def post_json(self, url, operation, provider=None, **kwargs):
+        """Send a POST request like `post` and decode its JSON answer.
+
+        Returns:
+            (response, decoded answer) tuple
+        Raises:
+            ValueError: if the answer is not JSON
+        """
+        return self._post(url, operation, kwargs, decode=True, provider=provider)
+
+    def _post(self, url, operation, kwargs, decode, provider=None):
+        kwargs.setdefault('timeout', self.timeouts[operation])
+        session = self.session if operation in self.retried_operations else self.single_attempt_session
+        labels = {'operation': operation}
+        if provider:
+            labels['provider'] = provider
+        start = time.perf_counter()
+        try:
+            response = session.post(url, **kwargs)
+        except Exception as e:
+            metrics.recorder.observe('gateway_request_seconds', time.perf_counter() - start,
+                                     {**labels, 'result': type(e).__name__})
+            raise
+        data = None
+        try:
+            if decode:
+                data = response.json()
+        finally:
+            metrics.recorder.observe('gateway_request_seconds', time.perf_counter() - start,
+                                     {**labels, 'result': _get_result_code(response, data)})
+        return response, data
+
+
+def _get_result_code(response, data):
+    """Result code of a gateway answer for the metrics: the code of its decoded answer, or the HTTP status"""
+    if response.ok and isinstance(data, dict) and data.get(const.METRICS_RESULT_KEY) is not None:
+        return str(data[const.METRICS_RESULT_KEY])
+    return f"http_{response.status_code}"
+
+
+def get_client(pool_sizes, timeouts, default_pool_size=4, max_retries=0, backoff_factor=0.0, status_forcelist=(),
+               retried_operations=()):
+    """Return the client of the current process for the given retry configuration.
+
+    Clients are never shared between processes, so that pooled connections are not inherited
+    by forked workers.
+    """
+    key = (os.getpid(), max_retries, backoff_factor)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                _logger.info("Creating gateway HTTP client (max_retries=%s, backoff_factor=%s)",
+                             max_retries, backoff_factor)
+                client = _clients[key] = GatewayHTTPClient(
+                    pool_sizes,
+                    timeouts,
+                    default_pool_size=default_pool_size,
+                    max_retries=max_retries,
+                    backoff_factor=backoff_factor,
+                    status_forcelist=status_forcelist,
+                    retried_operations=retried_operations,
+                )
+    return client
+
+
+def post_json_concurrently(queries, operation, max_workers=1, flight=None):
+    """Send several POST requests through a bounded thread pool and decode their JSON answers.
+
+    The requests must be fully prepared beforehand: the worker threads only do network I/O and
+    never touch the ORM.
+
+    Args:
+        queries: List of dictionaries with the client to use ('client'), the endpoint ('url'), the
+                 ID of the calling provider ('provider') and the extra arguments passed to requests
+        operation: Key of the operation in the timeouts, e.g. 'status_query'
+        max_workers: Maximum number of requests sent at the same time
+        flight: Optional SingleFlight through which the queries having a 'flight_key' are sent, so
+                that identical queries running at the same time share one request
+    Returns:
+        List of (response data, exception) tuples, in the order of the queries
+    """
+    # Các thread gửi request ghi metrics vào cơ sở dữ liệu của thread gọi
+    dbname = getattr(threading.current_thread(), 'dbname', None)
+
+    def send(query):
+        if dbname:
+            threading.current_thread().dbname = dbname
+        kwargs = dict(query)
+        client, url, flight_key = kwargs.pop('client'), kwargs.pop('url'), kwargs.pop('flight_key', None)
+        if flight is not None and flight_key is not None:
+            return flight.do(flight_key, lambda: client.post_json(url, operation, **kwargs)[1])
+        try:
+            return client.post_json(url, operation, **kwargs)[1], None
+        except Exception as e:
+            return None, e
+
+    if len(queries) <= 1 or max_workers <= 1:
+        return [send(query) for query in queries]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(queries)), thread_name_prefix='gateway-query') as executor:
+        return list(executor.map(send, queries))
@@ -0,0 +1,121 @@
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from odoo import SUPERUSER_ID, api
+from odoo.modules.registry import Registry
+from odoo.addons.mbbank_odoo import const
+
+_logger = logging.getLogger(__name__)
+
+
+def _format_bound(bound):
+    return f"{bound:g}"
+
+
+class MetricsRecorder:
+    """Aggregate metric samples in memory and add them to the metric table shared by all workers.
+
+    Recording a sample only updates a dictionary. Every `flush_interval` seconds, a background
+    thread of the process adds the aggregated samples of each database to the table with a single
+    upsert, in its own cursor, so that the counters of every worker end up in the same rows. The
+    remaining samples are flushed when the process exits, e.g. when a worker is recycled.
+    """
+
+    def __init__(self, model_name, buckets, flush_interval):
+        self.model_name = model_name
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._samples = defaultdict(float)
+        self._flusher_pid = None
+
+    def inc(self, name, labels=None, value=1, dbname=None):
+        """Add `value` to a counter"""
+        self._add(dbname, [((name, self._labels(labels), ''), value)])
+
+    def observe(self, name, seconds, labels=None, dbname=None):
+        """Record a duration in a histogram"""
+        bound = next((b for b in self.buckets if seconds <= b), None)
+        le = '+Inf' if bound is None else _format_bound(bound)
+        labels = self._labels(labels)
+        self._add(dbname, [((name, labels, le), 1), ((name, labels, 'sum'), seconds)])
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return ",".join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in sorted(labels.items())
+        )
+
+    def _add(self, dbname, samples):
+        dbname = dbname or getattr(threading.current_thread(), 'dbname', None)
+        if not dbname:
+            return
+        self._ensure_flusher()
+        with self._lock:
+            for key, value in samples:
+                self._samples[(dbname, *key)] += value
+
+    def _ensure_flusher(self):
+        """Start the background thread flushing the samples, once per process"""
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            # Worker được fork không kế thừa thread của tiến trình cha: tạo thread riêng
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name='gateway-metrics', daemon=True).start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                _logger.warning("Could not flush the metric samples", exc_info=True)
+
+    def flush(self, dbname=None):
+        """Add the samples aggregated so far to the metric table, for one or every database"""
+        with self._lock:
+            if dbname:
+                taken = {key: value for key, value in self._samples.items() if key[0] == dbname}
+                for key in taken:
+                    del self._samples[key]
+            else:
+                taken, self._samples = self._samples, defaultdict(float)
+
+        samples_by_db = defaultdict(list)
+        for (db, name, labels, le), value in taken.items():
+            samples_by_db[db].append((name, labels, le, value))
+        for db, samples in samples_by_db.items():
+            try:
+                with Registry(db).cursor() as cr:
+                    api.Environment(cr, SUPERUSER_ID, {})[self.model_name]._add_samples(samples)
+            except Exception:
+                _logger.warning("Could not store %s metric samples of %s", len(samples), db, exc_info=True)
+
+
+recorder = MetricsRecorder('mbbank.gateway.metric', const.METRICS_BUCKETS, const.METRICS_FLUSH_INTERVAL)
+
+
+def timed(name, **labels):
+    """Decorator recording the duration of every call in the `name` histogram"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                recorder.observe(name, time.perf_counter() - start, labels)
+        return wrapper
+    return decorator
@@ -0,0 +1,92 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from odoo.tools import config
+from odoo.addons.mbbank_odoo import const
+from odoo.addons.mbbank_odoo.tools import gateway_log
+
+_logger = logging.getLogger(__name__)
+
+# Chỉ đọc một lần khi nạp module: khi tắt, `profiled` trả về nguyên hàm gốc
+ENABLED = str(config.get('mbbank_odoo_profiling') or '').lower() in ('1', 'true', 'yes', 'on')
+# Chỉ một profiler có thể hoạt động cùng lúc trong một tiến trình (Python 3.12+)
+_profile_lock = threading.Lock()
+
+
+def _should_profile(provider):
+    """Whether the current request of the provider must be profiled"""
+    if not provider:
+        return False
+    if any(provider.mapped('mb_profiling')):
+        return True
+    rate = float(provider.env['ir.config_parameter'].sudo().get_param(
+        'mbbank_odoo.profiling_sample_rate', const.PROFILING_SAMPLE_RATE))
+    return random.random() < rate
+
+
+def _write_report(name, profiler, wall, queries, query_time):
+    """Write the profile of one call as a .prof file and a readable .txt report in the data directory"""
+    dbname = getattr(threading.current_thread(), 'dbname', None) or 'nodb'
+    directory = os.path.join(config['data_dir'], 'mbbank_odoo_profiles', dbname)
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(directory, f"{stamp}_{name}_{os.getpid()}")
+
+    profiler.dump_stats(f"{path}.prof")
+    report = io.StringIO()
+    report.write(f"{name}: {wall * 1000:.1f} ms, {queries} queries in {query_time * 1000:.1f} ms\n\n")
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(const.PROFILING_REPORT_LINES)
+    with open(f"{path}.txt", 'w') as f:
+        f.write(report.getvalue())
+    return path
+
+
+def profiled(name, get_provider):
+    """Decorator recording a cProfile profile and the SQL queries of the sampled calls.
+
+    Profiling is only compiled in when the server runs with `mbbank_odoo_profiling = True` in its
+    configuration file; otherwise the method is returned unchanged. When compiled in, a call is
+    profiled if its provider has `Profile Requests` checked or with the probability of the
+    `mbbank_odoo.profiling_sample_rate` system parameter, unless another call of the process is
+    already being profiled.
+
+    Args:
+        name: Name of the profiled entry point, used in the report file names
+        get_provider: Function receiving the arguments of the call and returning the provider
+    """
+    def decorator(method):
+        if not ENABLED:
+            return method
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not _should_profile(get_provider(*args, **kwargs)) or not _profile_lock.acquire(blocking=False):
+                return method(*args, **kwargs)
+
+            thread = threading.current_thread()
+            queries, query_time = getattr(thread, 'query_count', 0), getattr(thread, 'query_time', 0.0)
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profiler.runcall(method, *args, **kwargs)
+            finally:
+                wall = time.perf_counter() - start
+                _profile_lock.release()
+                queries = getattr(thread, 'query_count', 0) - queries
+                query_time = getattr(thread, 'query_time', 0.0) - query_time
+                try:
+                    path = _write_report(name, profiler, wall, queries, query_time)
+                    gateway_log.log_event('profile_recorded', name=name, path=path, wall_ms=round(wall * 1000, 1),
+                                          queries=queries, query_ms=round(query_time * 1000, 1))
+                except Exception:
+                    _logger.warning("Could not write the profile of %s", name, exc_info=True)
+        return wrapper
+    return decorator
@@ -0,0 +1,50 @@
+import hashlib
+import hmac
+from functools import lru_cache
+
+
+class MBBankSigner:
+    """Sign and verify MB Bank messages for one hash secret.
+
+    MB Bank hashes the hash secret followed by the sorted parameters, so the hash state after
+    the secret is computed once and copied for every message.
+    """
+
+    __slots__ = ('_states',)
+
+    def __init__(self, hash_secret):
+        secret = (hash_secret or '').encode('utf-8')
+        self._states = {
+            'MD5': hashlib.md5(secret),
+            'SHA256': hashlib.sha256(secret),
+        }
+
+    @staticmethod
+    def _get_sign_string(params):
+        """Build the string to sign: parameters sorted by name, without the MAC fields."""
+        return "&".join(f"{key}={params[key]}" for key in sorted(params) if key not in ('mac', 'mac_type'))
+
+    def sign(self, params, mac_type='MD5'):
+        """Compute the MAC of the parameters.
+
+        Args:
+            params: Dictionary of parameters to sign
+            mac_type: Type of MAC algorithm to use ('MD5' or 'SHA256')
+        """
+        state = self._states['MD5' if mac_type.upper() == 'MD5' else 'SHA256'].copy()
+        state.update(self._get_sign_string(params).encode('utf-8'))
+        return state.hexdigest().upper()
+
+    def verify(self, notification_data):
+        """Check the MAC of notification data, using SHA256 unless another mac_type is given."""
+        received_mac = notification_data.get('mac')
+        if not received_mac:
+            return False
+        calculated_mac = self.sign(notification_data, notification_data.get('mac_type') or 'SHA256')
+        return hmac.compare_digest(str(received_mac), calculated_mac)
+
+
+@lru_cache(maxsize=32)
+def get_signer(hash_secret):
+    """Return the signer of a hash secret, built once per process."""
+    return MBBankSigner(hash_secret)
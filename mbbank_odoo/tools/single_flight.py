@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+
+from odoo import SUPERUSER_ID, api
+from odoo.modules.registry import Registry
+from odoo.addons.mbbank_odoo import const
+
+_logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls made for the same key.
+
+    The first caller of a key runs the call; the callers that arrive while it is in flight wait
+    for it and share its result instead of calling again. Results accepted by `cache_if` are kept
+    for `ttl` seconds and returned to the next callers without any call.
+
+    Within a process, callers are coalesced in memory. With a `model_name`, whose model provides
+    `_get_final_result` and `_store_final_result`, the final results are also shared with the
+    other worker processes through the database; the keys are then (database name, reference)
+    tuples. The database is only read before the call and written after it: no lock nor
+    connection is held while the call is in flight.
+    """
+
+    def __init__(self, ttl, cache_if=None, model_name=None):
+        self.ttl = ttl
+        self.cache_if = cache_if
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._cache = {}
+
+    def do(self, key, fn):
+        """Run `fn` for `key` unless an identical call is in flight or cached.
+
+        Returns:
+            (result, exception) tuple; the exception raised by `fn` is returned, not raised
+        """
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                return cached[1], None
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'result': (None, None)}
+
+        if not leader:
+            call['event'].wait()
+            return call['result']
+
+        try:
+            call['result'] = (self._call(key, fn), None)
+        except Exception as e:
+            call['result'] = (None, e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+                result, error = call['result']
+                if error is None and self.cache_if and self.cache_if(result):
+                    now = time.monotonic()
+                    # Dọn các kết quả đã hết hạn trước khi thêm kết quả mới
+                    self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+                    self._cache[key] = (now + self.ttl, result)
+            call['event'].set()
+        return call['result']
+
+    def _call(self, key, fn):
+        if not self.model_name:
+            return fn()
+        dbname, reference = key
+        # Cursor ngắn riêng cho từng bước: thread gọi có thể không có cursor (thread pool của http_client)
+        with Registry(dbname).cursor() as cr:
+            result = api.Environment(cr, SUPERUSER_ID, {})[self.model_name]._get_final_result(reference, self.ttl)
+        if result is not None:
+            return result
+
+        result = fn()
+        if self.cache_if and self.cache_if(result):
+            try:
+                with Registry(dbname).cursor() as cr:
+                    api.Environment(cr, SUPERUSER_ID, {})[self.model_name]._store_final_result(reference, result)
+            except Exception:
+                _logger.warning("Could not share the result of %s with the other workers", reference, exc_info=True)
+        return result
+
+def _is_terminal_status(response_data):
+    """Whether an MB Bank status answer is final, i.e. will not change any more"""
+    return (
+        isinstance(response_data, dict)
+        and response_data.get('error_code') == '00'
+        and response_data.get('resp_code') in const.STATUS_FINAL_RESP_CODES
+    )
+
+
+# Status queries of the process, keyed by (database, transaction reference)
+status_queries = SingleFlight(const.STATUS_RESULT_CACHE_TTL, cache_if=_is_terminal_status,
+                              model_name='mbbank.status.result')
@@ -1,6 +1,6 @@
 {
     'name': 'MoMo Payment',
-    'version': '1.0',
+    'version': '1.2',
     'category': 'Payment',
     'sequence': 1,
     'summary': 'Integration with MoMo payment gateway',
@@ -14,6 +14,7 @@
         'views/payment_momo_template.xml',
         'views/momo_transaction_pending_views.xml',
         'views/momo_transaction_retry_views.xml',
+        'views/momo_ipn_inbox_views.xml',
         'data/cron_data.xml',
         'data/payment_provider_data.xml',
         'data/payment_method_data.xml',
@@ -12,6 +12,25 @@ PRODUCTION_DOMAIN = "https://payment.momo.vn"
 CREATE_PAYMENT_PATH = "/v2/gateway/api/create"
 CHECK_STATUS_PATH = "/v2/gateway/api/query"
 
+# Gateway HTTP client
+# Maximum number of kept-alive connections per gateway host
+HTTP_POOL_SIZES = {
+    SANDBOX_DOMAIN: 8,
+    PRODUCTION_DOMAIN: 16,
+}
+HTTP_DEFAULT_POOL_SIZE = 4
+# (connect, read) timeouts in seconds per operation
+HTTP_TIMEOUTS = {
+    'create_order': (5, 30),
+    'status_query': (5, 15),
+}
+# Defaults of the `momo_odoo.http_max_retries` and `momo_odoo.http_backoff_factor` system parameters
+HTTP_DEFAULT_MAX_RETRIES = 2
+HTTP_DEFAULT_BACKOFF_FACTOR = 0.3
+HTTP_RETRY_STATUSES = (502, 503, 504)
+# Idempotent operations retried on the statuses above; creating orders and refunds are sent only once
+HTTP_RETRIED_OPERATIONS = ('status_query',)
+
 # MoMo Request Types
 REQUEST_TYPE_CAPTURE_WALLET = "captureWallet"
 REQUEST_TYPE_PAY_WITH_METHOD = "payWithMethod"
@@ -25,7 +44,89 @@ RESULT_CODE_SUCCESS = 0
 RESULT_CODE_AUTHORIZED = 9000
 RESULT_CODE_PENDING = 1000
 
+# Gateway state ranks: a notification ranked below the state already applied to the transaction,
+# or with the same rank and an older responseTime, is stale and dropped. Codes that are not listed
+# are final.
+GATEWAY_STATE_RANK_PENDING = 1
+GATEWAY_STATE_RANK_AUTHORIZED = 2
+GATEWAY_STATE_RANK_FINAL = 3
+GATEWAY_STATE_RANKS = {
+    1000: GATEWAY_STATE_RANK_PENDING,
+    7000: GATEWAY_STATE_RANK_PENDING,
+    7002: GATEWAY_STATE_RANK_PENDING,
+    10: GATEWAY_STATE_RANK_PENDING,
+    11: GATEWAY_STATE_RANK_PENDING,
+    12: GATEWAY_STATE_RANK_PENDING,
+    99: GATEWAY_STATE_RANK_PENDING,
+    9000: GATEWAY_STATE_RANK_AUTHORIZED,
+}
+
 # Transaction Status Values
 TRANSACTION_STATUS_PENDING = 0
 TRANSACTION_STATUS_SUCCESS = 1
-TRANSACTION_STATUS_FAILED = 2
\ No newline at end of file
+TRANSACTION_STATUS_FAILED = 2
+
+# IPN inbox
+# Default of the `momo_odoo.ipn_batch_size` system parameter
+IPN_BATCH_SIZE = 100
+# Default of the `momo_odoo.ipn_max_attempts` system parameter: failed notifications are tried again
+# after 1, 2, 4... minutes, and are left in error after this many attempts
+IPN_MAX_ATTEMPTS = 5
+# Default of the `momo_odoo.ipn_ledger_retention_days` system parameter: days during which
+# a redelivered notification is recognized and skipped
+IPN_LEDGER_RETENTION_DAYS = 30
+
+# Status queries
+# Seconds during which a final status answer is reused instead of querying MoMo again
+STATUS_RESULT_CACHE_TTL = 30
+# resultCode values of a status answer that will not change any more: paid, authorized, failed
+STATUS_FINAL_RESULT_CODES = (0, 9000, 1003, 1005, 1006, 41, 42)
+
+# Post-processing
+# Default of the `momo_odoo.post_process_batch_size` system parameter: transactions post-processed
+# per committed batch
+POST_PROCESS_BATCH_SIZE = 100
+# Default of the `momo_odoo.post_process_chunk_size` system parameter: transactions of a
+# company and partner post-processed together in one savepoint
+POST_PROCESS_CHUNK_SIZE = 20
+# Transactions confirmed longer ago than this many days are left to the standard payment cron
+POST_PROCESS_MAX_AGE_DAYS = 4
+
+# Retry queue
+# Default of the `momo_odoo.retry_batch_size` system parameter
+RETRY_BATCH_SIZE = 50
+# Minutes after which a claimed retry that was never released is claimed again
+RETRY_CLAIM_TIMEOUT = 15
+# Default of the `momo_odoo.retry_query_concurrency` system parameter: status queries sent at once
+RETRY_QUERY_CONCURRENCY = 8
+
+# Expiry
+# Default of the `momo_odoo.expiry_chunk_size` system parameter
+EXPIRY_CHUNK_SIZE = 200
+
+# Metrics
+# Upper bounds in seconds of the duration histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Seconds between two flushes of the metric samples of a worker to the database
+METRICS_FLUSH_INTERVAL = 10
+# Key of the result code in the MoMo API answers, used as the `result` label of the gateway call metrics
+METRICS_RESULT_KEY = 'resultCode'
+
+# Gateway event logging
+# Keys whose values are masked in the logged events, compared case-insensitively
+LOG_REDACTED_KEYS = ('signature', 'accessKey', 'secretKey', 'authorization', 'cookie')
+# Share of the events of each kind that are logged (1.0 when not listed); warnings are always logged
+LOG_SAMPLE_RATES = {
+    'ipn_received': 0.1,
+    'status_query_response': 0.1,
+    'signature_checked': 0.01,
+}
+# Events waiting for the background log writer; further events are dropped instead of blocking
+LOG_QUEUE_SIZE = 10000
+
+# Profiling
+# Default of the `momo_odoo.profiling_sample_rate` system parameter: share of the requests profiled
+# when the server runs with `momo_odoo_profiling = True`
+PROFILING_SAMPLE_RATE = 0.0
+# Functions listed in the readable report of a profile, by cumulative time
+PROFILING_REPORT_LINES = 40
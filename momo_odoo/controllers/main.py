@@ -1,5 +1,4 @@
 import logging
-import pprint
 import hmac
 import hashlib
 import json
@@ -10,12 +9,20 @@ from odoo.exceptions import ValidationError
 from odoo.http import request
 from werkzeug.exceptions import Forbidden
 
+from odoo.addons.momo_odoo.tools import gateway_log, metrics, profiling
+
 _logger = logging.getLogger(__name__)
 
 
+def _get_ipn_providers(*args, **kwargs):
+    """Providers an IPN may belong to, known only once its signature is checked"""
+    return request.env['payment.provider'].sudo().search([('code', '=', 'momo')])
+
+
 class MoMoController(http.Controller):
     _return_url = "/payment/momo/return"
     _ipn_url = "/payment/momo/ipn"
+    _metrics_url = "/payment/momo/metrics"
 
     @http.route(_return_url, type="http", methods=["GET", "POST"], auth="public", csrf=False, save_session=False)
     def momo_return_from_checkout(self, **data):
@@ -39,47 +46,70 @@ class MoMoController(http.Controller):
         return request.redirect("/payment/status")
 
     @http.route(_ipn_url, type="http", auth="public", methods=["POST"], csrf=False, save_session=False)
+    @metrics.timed('ipn_seconds')
+    @profiling.profiled('ipn', _get_ipn_providers)
     def momo_webhook(self, **data):
         """Xử lý thông báo IPN từ MoMo."""
-        _logger.info("============= MoMo IPN CALLED =============")
-        _logger.info("IPN request headers: %s", pprint.pformat(dict(request.httprequest.headers)))
-
         try:
             # Parse JSON data nếu có
             notification_data = {}
             if not data and request.httprequest.data:
                 notification_data = json.loads(request.httprequest.data.decode('utf-8'))
-                _logger.info("IPN data from body: %s", pprint.pformat(notification_data))
             else:
                 notification_data = data
-                _logger.info("IPN data from params: %s", pprint.pformat(notification_data))
+            gateway_log.log_event('ipn_received', headers=request.httprequest.headers, payload=notification_data)
+
+            # Kiểm tra chữ ký trước khi truy cập cơ sở dữ liệu
+            provider_id = request.env['payment.provider'].sudo()._verify_momo_notification(notification_data)
+            if not provider_id:
+                _logger.warning("Rejected MoMo IPN with invalid signature")
+                metrics.recorder.inc('ipn_total', {'result': 'rejected'})
+                return request.make_response('', status=400)
 
-            # Tìm giao dịch
+            # Lưu thông báo vào inbox, cron inbox sẽ xử lý sau
             if 'orderId' in notification_data:
                 try:
-                    reference = notification_data.get('orderId')
-
-                    # Tìm transaction trong model pending
-                    pending_tx = request.env['momo.transaction.pending'].sudo().search([
-                        ('reference', '=', reference)
-                    ], limit=1)
+                    with request.env.cr.savepoint():
+                        # Thông báo gửi lại đã được ghi nhận: trả về ngay, không xử lý lại
+                        if request.env['momo.ipn.ledger'].sudo()._register_notification(provider_id, notification_data):
+                            request.env['momo.ipn.inbox'].sudo()._enqueue_notification(provider_id, notification_data)
+                            metrics.recorder.inc('ipn_total', {'result': 'accepted'})
+                        else:
+                            metrics.recorder.inc('ipn_total', {'result': 'redelivered'})
+                            _logger.info("Skipped redelivered MoMo IPN for %s", notification_data.get('orderId'))
 
-                    if pending_tx:
-                        _logger.info("Processing IPN via pending model: %s", pending_tx.reference)
-                        pending_tx.process_ipn_notification(notification_data)
-                    else:
-                        _logger.warning("Transaction not found or already processed for orderId: %s", reference)
-
-                    # Luôn trả về 204 OK
                     return request.make_response('', status=204)
 
                 except Exception as e:
-                    _logger.exception("Error processing transaction: %s", str(e))
-                    return request.make_response('', status=204)
+                    _logger.exception("Error storing MoMo IPN notification: %s", str(e))
+                    metrics.recorder.inc('ipn_total', {'result': 'error'})
+                    # Lỗi HTTP 5xx để MoMo gửi lại thông báo chưa được lưu
+                    return request.make_response('', status=500)
             else:
                 _logger.warning("Missing orderId in IPN")
+                metrics.recorder.inc('ipn_total', {'result': 'invalid'})
                 return request.make_response('', status=204)
 
         except Exception as e:
             _logger.exception("Error processing MoMo webhook: %s", str(e))
-            return request.make_response('', status=204)
\ No newline at end of file
+            metrics.recorder.inc('ipn_total', {'result': 'error'})
+            return request.make_response('', status=500)
+
+    @http.route(_metrics_url, type="http", auth="public", methods=["GET"], csrf=False, save_session=False)
+    def momo_metrics(self, **data):
+        """Expose the MoMo metrics in the Prometheus text format.
+
+        The route is disabled until the `momo_odoo.metrics_token` system parameter is set; the
+        scraper sends the token as a bearer token or in the `token` parameter.
+        """
+        token = request.env['ir.config_parameter'].sudo().get_param('momo_odoo.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        supplied = authorization[7:] if authorization.startswith('Bearer ') else data.get('token', '')
+        if not token or not hmac.compare_digest(supplied.encode(), token.encode()):
+            raise Forbidden()
+
+        # Ghi các mẫu của worker này, rồi đọc bảng trong cursor mới để thấy chúng
+        metrics.recorder.flush(request.db)
+        with request.env.registry.cursor() as cr:
+            body = request.env(cr=cr)['momo.gateway.metric'].sudo()._render_prometheus()
+        return request.make_response(body, headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
\ No newline at end of file
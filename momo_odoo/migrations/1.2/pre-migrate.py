@@ -0,0 +1,20 @@
+def migrate(cr, version):
+    # Gateway IDs are now unique. Clear the duplicates before the constraints are added, keeping
+    # the value on the oldest transaction.
+    cr.execute("""
+        UPDATE payment_transaction tx
+           SET momo_transaction_id = NULL
+          FROM payment_transaction older
+         WHERE older.momo_transaction_id = tx.momo_transaction_id
+           AND older.provider_id = tx.provider_id
+           AND older.id < tx.id
+    """)
+    # Request IDs of the queue records must be unique as well; give the duplicates a new one
+    for table in ('momo_transaction_pending', 'momo_transaction_retry'):
+        cr.execute(f"""
+            UPDATE {table} rec
+               SET momo_request_id = gen_random_uuid()::varchar
+              FROM {table} older
+             WHERE older.momo_request_id = rec.momo_request_id
+               AND older.id < rec.id
+        """)
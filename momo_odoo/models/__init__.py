@@ -1 +1 @@
-from . import payment_provider, payment_transaction, momo_transaction_pending, momo_transaction_retry
+from . import payment_provider, payment_transaction, momo_transaction_pending, momo_transaction_retry, momo_ipn_inbox, momo_ipn_ledger, momo_gateway_metric, momo_status_result
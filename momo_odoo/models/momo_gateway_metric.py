@@ -0,0 +1,107 @@
+from collections import defaultdict
+
+from odoo import models, fields, api
+from odoo.addons.momo_odoo import const
+
+METRIC_PREFIX = 'momo_'
+
+
+class MoMoGatewayMetric(models.Model):
+    _name = 'momo.gateway.metric'
+    _description = 'MoMo Gateway Metric'
+    _order = 'name, labels, le'
+    _log_access = False
+
+    name = fields.Char(string='Metric', required=True)
+    labels = fields.Char(string='Labels', required=True, default='')
+    # '' cho counter; cận trên của bucket hoặc 'sum' cho histogram
+    le = fields.Char(string='Bucket', required=True, default='')
+    value = fields.Float(string='Value', required=True, default=0)
+
+    _sql_constraints = [
+        ('sample_uniq', 'unique(name, labels, le)', "A metric sample can only be stored once."),
+    ]
+
+    @api.model
+    def _add_samples(self, samples):
+        """Add aggregated samples to the stored values with a single upsert.
+
+        Args:
+            samples: List of (name, labels, le, value) tuples
+        """
+        if not samples:
+            return
+        # Cùng thứ tự khoá giữa các worker để tránh deadlock
+        samples = sorted(samples)
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} AS metric (name, labels, le, value)
+                 VALUES {", ".join(["(%s, %s, %s, %s)"] * len(samples))}
+            ON CONFLICT (name, labels, le) DO UPDATE SET value = metric.value + EXCLUDED.value
+        """, [param for sample in samples for param in sample])
+
+    @api.model
+    def _get_queue_gauges(self):
+        """Return the current depth of the queues as (name, labels, value) tuples"""
+        now = fields.Datetime.now()
+        stats = self.env['momo.transaction.retry']._get_queue_stats()
+        oldest = stats['oldest_next_retry']
+        gauges = [
+            ('retry_queue_depth', 'state="retry"', stats['retry']),
+            ('retry_queue_depth', 'state="processing"', stats['processing']),
+            ('retry_queue_due', '', stats['due']),
+            ('retry_oldest_due_age_seconds', '',
+             (now - oldest).total_seconds() if oldest and oldest <= now else 0),
+            ('pending_queue_depth', '', self.env['momo.transaction.pending'].search_count([])),
+        ]
+        inbox_counts = dict.fromkeys(('new', 'error'), 0)
+        for state, count in self.env['momo.ipn.inbox']._read_group([], ['state'], ['__count']):
+            inbox_counts[state] = count
+        gauges += [('ipn_inbox_depth', f'state="{state}"', count) for state, count in inbox_counts.items()]
+        return gauges
+
+    @api.model
+    def _render_prometheus(self):
+        """Render the stored metrics and the queue gauges in the Prometheus text format"""
+        self.env.cr.execute(f"SELECT name, labels, le, value FROM {self._table} ORDER BY name, labels")
+        counters = defaultdict(list)
+        histograms = defaultdict(lambda: defaultdict(dict))
+        for name, labels, le, value in self.env.cr.fetchall():
+            if le:
+                histograms[name][labels][le] = value
+            else:
+                counters[name].append((labels, value))
+
+        fmt_labels, fmt_value = self._format_labels, self._format_value
+        lines = []
+        for name, samples in counters.items():
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+            lines += [f"{METRIC_PREFIX}{name}{fmt_labels(labels)} {fmt_value(value)}" for labels, value in samples]
+
+        for name, series in histograms.items():
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+            for labels, values in series.items():
+                # Các bucket được lưu riêng lẻ: cộng dồn theo thứ tự cận trên
+                cumulative = 0
+                for bound in [f"{b:g}" for b in const.METRICS_BUCKETS] + ['+Inf']:
+                    cumulative += values.get(bound, 0)
+                    bucket_labels = f'{labels},le="{bound}"' if labels else f'le="{bound}"'
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{{{bucket_labels}}} {fmt_value(cumulative)}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{fmt_labels(labels)} {fmt_value(values.get('sum', 0))}")
+                lines.append(f"{METRIC_PREFIX}{name}_count{fmt_labels(labels)} {fmt_value(cumulative)}")
+
+        gauge_names = set()
+        for name, labels, value in self._get_queue_gauges():
+            if name not in gauge_names:
+                gauge_names.add(name)
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+            lines.append(f"{METRIC_PREFIX}{name}{fmt_labels(labels)} {fmt_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _format_labels(labels):
+        return f"{{{labels}}}" if labels else ""
+
+    @staticmethod
+    def _format_value(value):
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
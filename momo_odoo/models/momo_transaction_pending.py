@@ -2,9 +2,12 @@ import hashlib
 import hmac
 from datetime import timedelta
 
-import requests
-
 from odoo import models, fields, api, _
+from odoo.tools import split_every
+from odoo.tools.sql import create_index
+from odoo.addons.momo_odoo import const
+from odoo.addons.momo_odoo.tools import locking, metrics
+from odoo.addons.momo_odoo.tools.cron import trigger_cron_at
 import logging
 import uuid
 
@@ -24,14 +27,39 @@ class MoMoTransactionPending(models.Model):
     reference = fields.Char(string='Reference', related='transaction_id.reference',
                             store=True, index=True)  # Add index for better performance
     signature = fields.Char(string='Signature')
-    momo_request_id = fields.Char(string='MoMo Request ID', index=True)  # Add index
+    momo_request_id = fields.Char(string='MoMo Request ID')  # Add index
     create_date = fields.Datetime(string='Created On', index=True)  # Add index
     timeout_time = fields.Datetime(string='Timeout', index=True)
 
+    _sql_constraints = [
+        ('momo_request_id_uniq', 'unique(momo_request_id)', "The MoMo request ID must be unique."),
+    ]
+
+    def init(self):
+        # Chỉ mục (timeout_time, id) cho phép cron hết hạn đọc trực tiếp từ chỉ mục
+        create_index(self.env.cr, f'{self._table}_timeout_idx', self._table,
+                     ['timeout_time', 'id'], where="timeout_time IS NOT NULL")
+
     def _compute_name(self):
         for record in self:
             record.name = f"Pending: {record.reference or ''}"
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        records._schedule_expiry_cron()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'timeout_time' in vals:
+            self._schedule_expiry_cron()
+        return res
+
+    def _schedule_expiry_cron(self):
+        """Trigger the expiry cron when the records time out"""
+        trigger_cron_at(self.env, 'momo_odoo.ir_cron_process_expired_pending_transactions', self.mapped('timeout_time'))
+
     @api.model
     def create_pending_transaction(self, transaction, signature=None, request_id=None):
         """Create a minimalist pending transaction record."""
@@ -115,6 +143,34 @@ class MoMoTransactionPending(models.Model):
             'target': 'current',
         }
 
+    def _try_lock(self):
+        """Lock the records without waiting, skipping those another worker is handling.
+
+        Returns:
+            The records that were locked; the caller owns them until the end of the transaction
+        """
+        return self.browse(locking.try_lock(self.env.cr, self._table, self.ids))
+
+    @api.model
+    def _handle_ipn_notification_data(self, notification_data):
+        """Tìm bản ghi pending tương ứng với thông báo IPN và xử lý nó.
+
+        Trả về None, không xử lý thông báo, khi bản ghi đang được worker khác giữ.
+        """
+        reference = notification_data.get('orderId')
+        pending_tx = self.search([('reference', '=', reference)], limit=1)
+        if not pending_tx:
+            _logger.warning("Transaction not found or already processed for orderId: %s", reference)
+            return False
+
+        if not pending_tx._try_lock():
+            # Bản ghi đang được worker khác xử lý: để thông báo trong inbox và xử lý lại sau
+            _logger.info("Transaction %s is being handled by another worker, IPN postponed", reference)
+            return None
+
+        _logger.info("Processing IPN via pending model: %s", pending_tx.reference)
+        return pending_tx.process_ipn_notification(notification_data)
+
     def process_ipn_notification(self, notification_data):
         """Process IPN notification và xóa bản ghi sau khi hoàn thành"""
         self.ensure_one()
@@ -126,18 +182,24 @@ class MoMoTransactionPending(models.Model):
                             transaction.reference)
             return False
 
-        # Uncomment test lỗi
-        notification_data['resultCode'] = '11'
-        _logger.info("Simulate error : change result code to 11")
+        # Uncomment test lỗi (hoặc dùng --ipn-codes của scripts/momo_emulator.py)
+        # notification_data['resultCode'] = '11'
+        # _logger.info("Simulate error : change result code to 11")
 
         # Xử lý resultCode
         result_code = notification_data.get('resultCode')
         result_code_int = int(result_code) if isinstance(result_code, str) and result_code.isdigit() else result_code
         message = notification_data.get('message', 'Unknown response')
 
+        # Bỏ qua thông báo cũ hơn trạng thái đã áp dụng
+        if not transaction._accept_momo_gateway_state(result_code_int, notification_data.get('responseTime')):
+            return False
+
         # Cập nhật trạng thái transaction
         if result_code_int == 0:  # Success
             transaction._set_done()
+            transaction.momo_transaction_id = notification_data.get('transId')
+            transaction._schedule_momo_post_processing()
             _logger.info("Transaction %s marked as DONE", self.reference)
             # Xóa bản ghi khỏi model pending sau khi hoàn tất
             _logger.info(f"Deleting pending record for completed transaction {self.reference}")
@@ -145,6 +207,7 @@ class MoMoTransactionPending(models.Model):
             return True
         elif result_code_int == 9000:  # Authorized
             transaction._set_authorized()
+            transaction.momo_transaction_id = notification_data.get('transId')
             _logger.info("Transaction %s marked as AUTHORIZED", self.reference)
             # Xóa bản ghi khỏi model pending
             _logger.info(f"Deleting pending record for completed transaction {self.reference}")
@@ -178,41 +241,53 @@ class MoMoTransactionPending(models.Model):
             self.sudo().unlink()
             return False
 
+    def _expire_transactions(self):
+        """Cancel the transactions of expired records and delete the records"""
+        payment_txs = self.transaction_id
+        payment_txs._set_canceled(state_message="MoMo: Transaction expired (timeout)")
+        _logger.info("Transactions %s marked as canceled due to timeout", ", ".join(payment_txs.mapped('reference')))
+        self.sudo().unlink()
+
     @api.model
-    def _cron_process_expired_pending_transactions(self):
+    @metrics.timed('cron_seconds', cron='expiry')
+    def _cron_process_expired_pending_transactions(self, chunk_size=None):
         """
         Cron job để xử lý các giao dịch MoMo trong model pending đã quá thời gian timeout.
         Giao dịch được coi là quá hạn nếu đã vượt quá thời gian timeout được thiết lập.
+
+        Các bản ghi quá hạn được xử lý theo từng nhóm: các giao dịch của một nhóm được hủy cùng
+        lúc, nhóm được xóa bằng một câu lệnh và commit. Nhóm bị lỗi sẽ được xử lý lại từng bản ghi.
         """
         _logger.info("Starting cron job to process expired pending MoMo transactions")
+        if not chunk_size:
+            chunk_size = int(self.env['ir.config_parameter'].sudo().get_param(
+                'momo_odoo.expiry_chunk_size', const.EXPIRY_CHUNK_SIZE))
 
         # Thời điểm hiện tại
         current_time = fields.Datetime.now()
 
         # Tìm tất cả giao dịch đã quá thời gian timeout
-        expired_transactions = self.search([('timeout_time', '<=', current_time)])
+        expired_ids = self.search([('timeout_time', '<=', current_time)], order='timeout_time, id').ids
 
-        _logger.info("Found %s expired pending MoMo transactions", len(expired_transactions))
+        _logger.info("Found %s expired pending MoMo transactions", len(expired_ids))
 
-        # Xử lý từng giao dịch
-        for transaction in expired_transactions:
+        # Xử lý từng nhóm bản ghi quá hạn, commit sau mỗi nhóm
+        for chunk_ids in split_every(chunk_size, expired_ids):
             try:
-                # Lấy transaction gốc
-                payment_tx = transaction.transaction_id
-
-                # Đánh dấu giao dịch đã hết hạn
-                payment_tx._set_canceled(state_message="MoMo: Transaction expired (timeout)")
-                _logger.info("Transaction %s marked as canceled due to timeout", payment_tx.reference)
-
-                # Xóa bản ghi pending
-                transaction.sudo().unlink()
-
-                # Commit sau mỗi giao dịch để không mất tiến trình nếu có lỗi
+                self.browse(chunk_ids).exists()._try_lock()._expire_transactions()
                 self.env.cr.commit()
-
             except Exception as e:
-                _logger.exception("Error in cron job for transaction %s: %s",
-                                  transaction.reference if hasattr(transaction, 'reference') else "Unknown", str(e))
+                _logger.exception("Error in cron job for a chunk of %s records, retrying them one by one: %s",
+                                  len(chunk_ids), str(e))
                 self.env.cr.rollback()
 
+                # Xử lý lại từng bản ghi để một bản ghi lỗi không chặn các bản ghi khác
+                for record in self.browse(chunk_ids).exists():
+                    try:
+                        record._try_lock()._expire_transactions()
+                        self.env.cr.commit()
+                    except Exception as e:
+                        _logger.exception("Error in cron job for transaction %s: %s", record.reference, str(e))
+                        self.env.cr.rollback()
+
         _logger.info("Finished processing expired pending MoMo transactions")
@@ -1,9 +1,11 @@
 from odoo import models, fields, api, _
+from odoo.tools.sql import create_index
+from odoo.addons.momo_odoo import const
+from odoo.addons.momo_odoo.tools import gateway_log, http_client, locking, metrics, single_flight
+from odoo.addons.momo_odoo.tools.cron import trigger_cron_at
+from odoo.addons.momo_odoo.tools.signature import get_signer
 import logging
-import hmac
-import hashlib
 import uuid
-import requests
 from datetime import datetime, timedelta
 
 _logger = logging.getLogger(__name__)
@@ -33,12 +35,75 @@ class MoMoTransactionRetry(models.Model):
         ('retry', 'To Retry'),
         ('processing', 'Processing')
     ], string='Status', default='retry', index=True)
+    claim_time = fields.Datetime(string='Claimed On', readonly=True)
     create_date = fields.Datetime(string='Created On', index=True, readonly=True)
 
+    _sql_constraints = [
+        ('momo_request_id_uniq', 'unique(momo_request_id)', "The MoMo request ID must be unique."),
+    ]
+
+    def init(self):
+        # Chỉ đánh chỉ mục các bản ghi đang chờ retry: cron chỉ quét các bản ghi này
+        create_index(self.env.cr, f'{self._table}_due_retry_idx', self._table,
+                     ['next_retry', 'id'], where="state = 'retry'")
+
     def _compute_name(self):
         for record in self:
             record.name = f"Retry: {record.reference or ''} (Attempt {record.retry_count + 1}/{record.max_retries})"
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        records._schedule_retry_cron()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'next_retry' in vals or vals.get('state') == 'retry':
+            self._schedule_retry_cron()
+        return res
+
+    def _schedule_retry_cron(self):
+        """Trigger the retry cron at the next retry time of the records waiting for a retry"""
+        trigger_cron_at(
+            self.env,
+            'momo_odoo.ir_cron_process_momo_transaction_retries',
+            self.filtered(lambda r: r.state == 'retry').mapped('next_retry'),
+        )
+
+    def _try_transition(self, from_state, values):
+        """Write values on the records that are still in from_state, without waiting for locks.
+
+        Records that another worker is changing, or changed since the current transaction started,
+        are skipped instead of raising a serialization failure.
+
+        Returns:
+            The records that were updated
+        """
+        self.flush_recordset()
+        values = dict(values, write_uid=self.env.uid, write_date=fields.Datetime.now())
+        updated = self.browse(locking.try_update(self.env.cr, self._table, self.ids, values, "state = %s", (from_state,)))
+        self.invalidate_recordset(list(values))
+        if len(updated) < len(self):
+            _logger.info("Skipped %s retries changed by another worker: %s",
+                         ", ".join((self - updated).mapped('reference')), values.get('state'))
+        if values.get('state') == 'retry':
+            updated._schedule_retry_cron()
+        return updated
+
+    def _lock_claimed(self):
+        """Lock the records that are still claimed, skipping those another worker took over.
+
+        Returns:
+            The records that were locked; the caller owns them until the end of the transaction
+        """
+        self.flush_recordset()
+        locked = self.browse(locking.try_lock(self.env.cr, self._table, self.ids, "state = 'processing'"))
+        if len(locked) < len(self):
+            _logger.info("Skipped retries processed by another worker: %s",
+                         ", ".join((self - locked).mapped('reference')))
+        return locked
+
     @api.model
     def create_retry_transaction(self, transaction, signature=None, request_id=None, error_message=None):
         """Create a retry transaction record with idempotency support."""
@@ -98,8 +163,20 @@ class MoMoTransactionRetry(models.Model):
     def retry_transaction(self):
         """Query MoMo and update transaction with minimal access to main model"""
         self.ensure_one()
+        if not self._try_transition('retry', {
+            'state': 'processing',
+            'claim_time': fields.Datetime.now()
+        }):
+            return False
+        return self._process_claimed_retry()
+
+    def _process_claimed_retry(self):
+        """Process a retry record that was moved to the 'processing' state by the caller"""
+        self.ensure_one()
 
         if self.retry_count >= self.max_retries:
+            if not self._lock_claimed():
+                return False
             # Max retries reached, update main model and delete record
             self.transaction_id._set_error(
                 f"MoMo: Max retry attempts reached. Last error: {self.error_message}")
@@ -107,81 +184,182 @@ class MoMoTransactionRetry(models.Model):
             _logger.info(f"Max retry attempts reached for transaction {self.reference}")
             return False
 
-        # Update retry count and state
+        if self._start_claimed_retry():
+            return self._perform_query_to_momo()
+        return False
+
+    def _start_claimed_retry(self):
+        """Count a new attempt for a claimed record and check its idempotency key"""
+        self.ensure_one()
+
+        # Update retry count
         self.write({
-            'state': 'processing',
             'retry_count': self.retry_count + 1
         })
         _logger.info(f"Processing retry #{self.retry_count} for transaction {self.reference}")
 
         # Check idempotency key
-        if self._check_and_update_idempotency():
-            return self._perform_query_to_momo()
-        return False
+        return self._check_and_update_idempotency()
 
-    def _perform_query_to_momo(self):
-        """Execute actual query to MoMo API"""
+    def _process_claimed_retries(self, max_workers):
+        """Process claimed records, sending their status queries concurrently.
+
+        The ORM is only used from the calling thread: the queries are prepared record by record,
+        sent through a thread pool, then their results are applied record by record, each with
+        its own commit.
+        """
+        records_to_query = []
+        for record in self:
+            try:
+                if record.retry_count >= record.max_retries:
+                    record._process_claimed_retry()
+                elif record._start_claimed_retry():
+                    try:
+                        query = record._prepare_momo_query()
+                    except Exception as e:
+                        query = None
+                        record._handle_momo_query_result(None, e)
+                    if query:
+                        records_to_query.append((record, query))
+                self.env.cr.commit()
+            except Exception as e:
+                _logger.exception(f"Error preparing retry for transaction ID {record.id}: {e}")
+                self.env.cr.rollback()
+
+        if not records_to_query:
+            return
+
+        _logger.info(f"Sending {len(records_to_query)} MoMo status queries with {max_workers} workers")
+        results = http_client.post_json_concurrently(
+            [query for _record, query in records_to_query], 'status_query', max_workers=max_workers,
+            flight=single_flight.status_queries
+        )
+        for (record, _query), (response_data, error) in zip(records_to_query, results):
+            try:
+                record._handle_momo_query_result(response_data, error)
+                self.env.cr.commit()
+            except Exception as e:
+                _logger.exception(f"Error processing retry for transaction ID {record.id}: {e}")
+                self.env.cr.rollback()
+
+    @api.model
+    def _release_stale_claims(self):
+        """Put back in the queue the records claimed by a worker that never released them"""
+        self.flush_model()
+        timeout = fields.Datetime.now() - timedelta(minutes=const.RETRY_CLAIM_TIMEOUT)
+        self.env.cr.execute(f"""
+            UPDATE {self._table}
+               SET state = 'retry', claim_time = NULL
+             WHERE state = 'processing'
+               AND COALESCE(claim_time, write_date) <= %s
+        """, (timeout,))
+        if self.env.cr.rowcount:
+            _logger.warning("Released %s stale MoMo retry claims", self.env.cr.rowcount)
+            self.invalidate_model(['state', 'claim_time'])
+
+    @api.model
+    def _claim_due_retries(self, batch_size):
+        """Atomically move a batch of due records to the 'processing' state and return them.
+
+        Records locked by another worker are skipped, so that several cron workers can drain the
+        queue in parallel without processing the same record twice. The claim is committed right
+        away so that it is visible to the other workers.
+        """
+        self.flush_model()
+        now = fields.Datetime.now()
+        self.env.cr.execute(f"""
+            UPDATE {self._table}
+               SET state = 'processing', claim_time = %s
+             WHERE id IN (
+                SELECT id FROM {self._table}
+                 WHERE state = 'retry'
+                   AND next_retry <= %s
+              ORDER BY next_retry
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+             )
+         RETURNING id
+        """, (now, now, batch_size))
+        record_ids = [row[0] for row in self.env.cr.fetchall()]
+        self.invalidate_model(['state', 'claim_time'])
+        self.env.cr.commit()
+        return self.browse(record_ids)
+
+    def _prepare_momo_query(self):
+        """Build the status query of the record.
+
+        Returns:
+            Dictionary of request arguments for http_client.post_json_concurrently
+        """
         self.ensure_one()
         tx = self.transaction_id
         provider = tx.provider_id
 
+        # Prepare query params for MoMo status check
+        params = {
+            'partnerCode': provider.momo_partner_code,
+            'accessKey': provider.momo_access_key,
+            'requestId': self.momo_request_id,  # Use current request ID
+            'orderId': tx.reference,
+            'lang': 'vi'
+        }
+
+        # Create signature
+        params['signature'] = get_signer(provider.momo_secret_key).sign_fields(
+            params, ('accessKey', 'orderId', 'partnerCode', 'requestId')
+        )
+
+        return {
+            'client': provider._get_momo_http_client(),
+            'url': provider._get_momo_query_url(),
+            'provider': provider.id,
+            'json': params,
+            'headers': {'Content-Type': 'application/json'},
+            'flight_key': (self.env.cr.dbname, tx.reference),
+        }
+
+    def _perform_query_to_momo(self):
+        """Execute actual query to MoMo API"""
+        self.ensure_one()
+
         try:
-            # Prepare query params for MoMo status check
-            params = {
-                'partnerCode': provider.momo_partner_code,
-                'accessKey': provider.momo_access_key,
-                'requestId': self.momo_request_id,  # Use current request ID
-                'orderId': tx.reference,
-                'lang': 'vi'
-            }
-
-            # Create signature
-            signature_base = (
-                f"accessKey={params['accessKey']}"
-                f"&orderId={params['orderId']}"
-                f"&partnerCode={params['partnerCode']}"
-                f"&requestId={params['requestId']}"
-            )
-
-            h = hmac.new(
-                bytes(provider.momo_secret_key, 'utf-8'),
-                bytes(signature_base, 'utf-8'),
-                hashlib.sha256
-            )
-            params['signature'] = h.hexdigest()
-
-            # Query MoMo
-            base_url = "https://test-payment.momo.vn"
-            endpoint = f"{base_url}/v2/gateway/api/query"
+            query = self._prepare_momo_query()
+            if not query:
+                return False
 
             # Log request for debugging
-            _logger.info(f"Sending MoMo status query for {self.reference} with requestId: {params['requestId']}")
+            _logger.info(f"Sending MoMo status query for {self.reference} with requestId: {self.momo_request_id}")
 
-            response = requests.post(
-                endpoint,
-                json=params,
-                headers={'Content-Type': 'application/json'},
-                timeout=30
-            )
+            response_data, error = http_client.post_json_concurrently(
+                [query], 'status_query', flight=single_flight.status_queries)[0]
+        except Exception as e:
+            response_data, error = None, e
 
-            response_data = response.json()
-            _logger.info(f"MoMo response: {response_data}")
+        return self._handle_momo_query_result(response_data, error)
 
-            # Process response
-            self._process_momo_response(response_data)
-            return True
+    def _handle_momo_query_result(self, response_data, error=None):
+        """Apply the result of a status query, or schedule the next retry if it failed"""
+        self.ensure_one()
+        if not self._lock_claimed():
+            return False
 
-        except Exception as e:
+        if error is not None:
             # Log error and schedule retry
-            _logger.exception(f"Error querying MoMo status for {self.reference}: {str(e)}")
+            _logger.error(f"Error querying MoMo status for {self.reference}: {str(error)}", exc_info=error)
             next_retry = fields.Datetime.now() + timedelta(minutes=max(5, 2 ** self.retry_count))
             self.write({
                 'state': 'retry',
                 'next_retry': next_retry,
-                'error_message': str(e)
+                'error_message': str(error)
             })
             return False
 
+        gateway_log.log_event('status_query_response', reference=self.reference, response=response_data)
+
+        # Process response
+        self._process_momo_response(response_data)
+        return True
+
     def _process_momo_response(self, response_data):
         """Process MoMo response data"""
         self.ensure_one()
@@ -193,15 +371,25 @@ class MoMoTransactionRetry(models.Model):
 
         _logger.info(f"MoMo resultCode: {result_code_int}")
 
+        # Kết quả cũ hơn trạng thái đã áp dụng, ví dụ từ IPN: không còn gì để truy vấn lại
+        is_gateway_state = (result_code_int in const.STATUS_FINAL_RESULT_CODES
+                            or result_code_int in const.GATEWAY_STATE_RANKS)
+        if is_gateway_state and not tx._accept_momo_gateway_state(result_code_int, response_data.get('responseTime')):
+            self.sudo().unlink()
+            return False
+
         # Xử lý theo resultCode
         if result_code_int == 0:  # Thành công
             tx._set_done()
+            tx.momo_transaction_id = response_data.get('transId')
+            tx._schedule_momo_post_processing()
             self.sudo().unlink()
             _logger.info(f"Transaction {tx.reference} marked as DONE")
             return True
 
         elif result_code_int == 9000:  # Authorized
             tx._set_authorized()
+            tx.momo_transaction_id = response_data.get('transId')
             self.sudo().unlink()
             _logger.info(f"Transaction {tx.reference} marked as AUTHORIZED")
             return True
@@ -254,50 +442,82 @@ class MoMoTransactionRetry(models.Model):
                 return False
 
     @api.model
-    def _cron_process_transaction_retries(self):
+    def _get_queue_stats(self):
+        """Return the figures of the retry queue, computed by a single aggregate query.
+
+        Returns:
+            Dictionary with the number of records per state, the number of due records, the
+            oldest next_retry of the records to retry and the highest retry count
+        """
+        self.flush_model(['state', 'next_retry', 'retry_count'])
+        now = fields.Datetime.now()
+        self.env.cr.execute(f"""
+            SELECT state,
+                   COUNT(*),
+                   COUNT(*) FILTER (WHERE state = 'retry' AND next_retry <= %s),
+                   MIN(next_retry) FILTER (WHERE state = 'retry'),
+                   MAX(retry_count)
+              FROM {self._table}
+          GROUP BY state
+        """, (now,))
+        stats = {'retry': 0, 'processing': 0, 'due': 0, 'oldest_next_retry': None, 'max_retry_count': 0}
+        for state, count, due, oldest, max_retry_count in self.env.cr.fetchall():
+            stats[state] = count
+            stats['due'] += due
+            if oldest and (not stats['oldest_next_retry'] or oldest < stats['oldest_next_retry']):
+                stats['oldest_next_retry'] = oldest
+            stats['max_retry_count'] = max(stats['max_retry_count'], max_retry_count or 0)
+        return stats
+
+    @api.model
+    def action_show_queue_stats(self):
+        """Show the figures of the retry queue in a notification"""
+        stats = self._get_queue_stats()
+        message = _(
+            "To retry: %(retry)s (due: %(due)s)\nProcessing: %(processing)s\n"
+            "Oldest next retry: %(oldest)s\nMax retry count: %(max_retry_count)s",
+            retry=stats['retry'], due=stats['due'], processing=stats['processing'],
+            oldest=stats['oldest_next_retry'] or '-', max_retry_count=stats['max_retry_count'],
+        )
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _("MoMo Retry Queue"),
+                'message': message,
+                'type': 'info',
+                'sticky': False,
+            },
+        }
+
+    @api.model
+    @metrics.timed('cron_seconds', cron='retry')
+    def _cron_process_transaction_retries(self, batch_size=None):
         """Process transactions whose next_retry time has come"""
         _logger.info("Starting MoMo transaction retry processing cron job")
 
-        current_time = fields.Datetime.now()
-        _logger.info(f"Current server time: {current_time}")
-        # Hiển thị tất cả các bản ghi trong trạng thái retry để debug
-        all_retry_records = self.search([('state', '=', 'retry')])
-        _logger.info(f"Total records in retry state: {len(all_retry_records)}")
-
-        for record in all_retry_records:
-            _logger.info(
-                f"Record {record.id} - {record.reference}: next_retry={record.next_retry}, "
-                f"retry_count={record.retry_count}, compare_result={(record.next_retry <= current_time)}")
-
-        # Tìm tất cả bản ghi đã tới thời hạn retry
-        domain = [
-            ('state', '=', 'retry'),
-            ('next_retry', '<=', current_time),
-            ('retry_count', '<', 5)
-        ]
-
-        record_ids = self.search(domain).ids
-        _logger.info(f"Found {len(record_ids)} MoMo transactions to retry with domain {domain}")
-
-        # Xử lý từng bản ghi một cách độc lập theo ID
-        for record_id in record_ids:
-            try:
-                # Tìm lại bản ghi theo ID tại thời điểm xử lý
-                record = self.browse(record_id).exists()
-                # Kiểm tra xem bản ghi có tồn tại không
-                if not record:
-                    _logger.info(f"Record with ID {record_id} no longer exists, skipping")
-                    continue
-
-                _logger.info(f"Starting to process transaction {record.reference}")
-
-                # Xử lý bản ghi
-                record.retry_transaction()
-                # Commit sau mỗi bản ghi để đảm bảo thay đổi được lưu
-                self.env.cr.commit()
+        stats = self._get_queue_stats()
+        _logger.info(
+            "MoMo retry queue: %s to retry (%s due, oldest next retry %s), %s processing, max retry count %s",
+            stats['retry'], stats['due'], stats['oldest_next_retry'] or '-',
+            stats['processing'], stats['max_retry_count'])
 
-            except Exception as e:
-                _logger.exception(f"Error processing retry for transaction ID {record_id}: {e}")
-                self.env.cr.rollback()
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not batch_size:
+            batch_size = int(ICP.get_param('momo_odoo.retry_batch_size', const.RETRY_BATCH_SIZE))
+        max_workers = int(ICP.get_param('momo_odoo.retry_query_concurrency', const.RETRY_QUERY_CONCURRENCY))
+
+        self._release_stale_claims()
+        self.env.cr.commit()
+
+        # Claim and process due records batch by batch
+        while True:
+            records = self._claim_due_retries(batch_size)
+            _logger.info(f"Claimed {len(records)} MoMo transactions to retry")
+
+            records._process_claimed_retries(max_workers)
+
+            if len(records) < batch_size:
+                break
 
         _logger.info("Finished MoMo transaction retry processing cron job")
@@ -3,8 +3,10 @@ import json
 import uuid
 import hmac
 import hashlib
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.addons.momo_odoo import const
+from odoo.addons.momo_odoo.tools import http_client
+from odoo.addons.momo_odoo.tools.signature import get_signer
 
 _logger = logging.getLogger(__name__)
 
@@ -37,6 +39,47 @@ class PaymentProviderMoMo(models.Model):
         required_if_provider="momo"
     )
 
+    momo_defer_post_processing = fields.Boolean(
+        string="Defer Post-Processing",
+        help="Only record the payment outcome when MoMo notifies it, and confirm the orders "
+             "of confirmed transactions in batches from a background job. When unchecked, the "
+             "standard post-processing of Odoo confirms them.",
+    )
+    momo_emulator_url = fields.Char(
+        string="Emulator URL",
+        help="In test mode, send every MoMo API call to this local gateway emulator instead of "
+             "the MoMo sandbox, e.g. http://localhost:8079 (see scripts/momo_emulator.py).",
+    )
+    momo_profiling = fields.Boolean(
+        string="Profile Requests",
+        help="Record a cProfile profile and the SQL queries of every MoMo IPN and checkout of this "
+             "provider in the data directory. Only effective when the server runs with "
+             "momo_odoo_profiling = True in its configuration file.",
+    )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Override to drop the cached MoMo signing keys when a provider is added."""
+        providers = super().create(vals_list)
+        if any(provider.code == 'momo' for provider in providers):
+            self.env.registry.clear_cache()
+        return providers
+
+    def write(self, vals):
+        """Override to drop the cached MoMo signing keys when the credentials change."""
+        res = super().write(vals)
+        if {'code', 'state', 'momo_partner_code', 'momo_access_key', 'momo_secret_key'} & vals.keys():
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        """Override to drop the cached MoMo signing keys when a provider is deleted."""
+        clear_cache = any(provider.code == 'momo' for provider in self)
+        res = super().unlink()
+        if clear_cache:
+            self.env.registry.clear_cache()
+        return res
+
     @api.model
     def _get_compatible_providers(
             self, *args, currency_id=None, is_validation=False, **kwargs
@@ -64,10 +107,38 @@ class PaymentProviderMoMo(models.Model):
             )
         return supported_currencies
 
+    def _momo_uses_emulator(self):
+        """Whether the MoMo API calls go to the local gateway emulator."""
+        self.ensure_one()
+        return self.state == 'test' and bool(self.momo_emulator_url)
+
+    def _get_momo_base_url(self):
+        """Get the MoMo API base URL based on environment."""
+        self.ensure_one()
+        if self._momo_uses_emulator():
+            return self.momo_emulator_url.rstrip('/')
+        return const.SANDBOX_DOMAIN if self.state == 'test' else const.PRODUCTION_DOMAIN
+
     def _get_momo_api_url(self):
         """Get the appropriate MoMo API URL based on environment."""
-        base_url = const.SANDBOX_DOMAIN if self.state == 'test' else const.PRODUCTION_DOMAIN
-        return f"{base_url}{const.CREATE_PAYMENT_PATH}"
+        return f"{self._get_momo_base_url()}{const.CREATE_PAYMENT_PATH}"
+
+    def _get_momo_query_url(self):
+        """Get the MoMo status query URL based on environment."""
+        return f"{self._get_momo_base_url()}{const.CHECK_STATUS_PATH}"
+
+    def _get_momo_http_client(self):
+        """Get the keep-alive HTTP client of this process for MoMo API calls."""
+        ICP = self.env['ir.config_parameter'].sudo()
+        return http_client.get_client(
+            const.HTTP_POOL_SIZES,
+            const.HTTP_TIMEOUTS,
+            default_pool_size=const.HTTP_DEFAULT_POOL_SIZE,
+            max_retries=int(ICP.get_param('momo_odoo.http_max_retries', const.HTTP_DEFAULT_MAX_RETRIES)),
+            backoff_factor=float(ICP.get_param('momo_odoo.http_backoff_factor', const.HTTP_DEFAULT_BACKOFF_FACTOR)),
+            status_forcelist=const.HTTP_RETRY_STATUSES,
+            retried_operations=const.HTTP_RETRIED_OPERATIONS,
+        )
 
     def _get_momo_request_type(self):
         """Get the MoMo request type based on payment type configuration."""
@@ -90,6 +161,32 @@ class PaymentProviderMoMo(models.Model):
         )
         return h.hexdigest()
 
+    @tools.ormcache()
+    def _get_momo_signing_keys(self):
+        """Get the (provider id, partner code, access key, secret key) of every enabled MoMo provider.
+
+        The result is cached in memory so that IPN signatures can be checked without any query.
+        """
+        providers = self.sudo().search([('code', '=', 'momo'), ('state', '!=', 'disabled')])
+        return tuple((p.id, p.momo_partner_code, p.momo_access_key, p.momo_secret_key) for p in providers)
+
+    @api.model
+    def _verify_momo_notification(self, notification_data):
+        """Find the MoMo provider whose secret key signed an IPN notification.
+
+        Returns:
+            The id of the provider, or None if the signature is invalid
+        """
+        if not notification_data.get('signature'):
+            return None
+        partner_code = notification_data.get('partnerCode')
+        for provider_id, provider_partner_code, access_key, secret_key in self._get_momo_signing_keys():
+            if partner_code and provider_partner_code and partner_code != provider_partner_code:
+                continue
+            if get_signer(secret_key).verify_ipn(notification_data, access_key=access_key):
+                return provider_id
+        return None
+
     def _get_default_payment_method_codes(self):
         """Override of payment to return the default payment method codes."""
         default_codes = super()._get_default_payment_method_codes()
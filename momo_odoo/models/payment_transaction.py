@@ -3,14 +3,18 @@ import json
 import uuid
 import hmac
 import hashlib
-import requests
+from collections import defaultdict
 from datetime import datetime, timedelta
 from werkzeug import urls
 
 from odoo import _, models, fields, api
 from odoo.exceptions import ValidationError
+from odoo.tools import split_every
 from odoo.http import request
 from odoo.addons.momo_odoo import const
+from odoo.addons.momo_odoo.tools import gateway_log, locking, metrics, profiling
+from odoo.addons.momo_odoo.tools.cron import trigger_cron_at
+from odoo.addons.momo_odoo.tools.signature import get_signer
 from odoo.addons.momo_odoo.controllers.main import MoMoController
 
 _logger = logging.getLogger(__name__)
@@ -26,6 +30,14 @@ class PaymentTransaction(models.Model):
     momo_payment_type = fields.Char(string="MoMo Payment Type", readonly=True)
     momo_pending_id = fields.One2many('momo.transaction.pending', 'transaction_id', string='MoMo Pending Record')
     momo_retry_id = fields.One2many('momo.transaction.retry', 'transaction_id', string='MoMo Retry Record')
+    momo_gateway_state_rank = fields.Integer(string="MoMo Gateway State Rank", readonly=True)
+    # responseTime (milliseconds since epoch) of the last applied notification
+    momo_response_time = fields.Float(string="MoMo Response Time", digits=(16, 0), readonly=True)
+
+    _sql_constraints = [
+        ('momo_transaction_id_uniq', 'unique(momo_transaction_id, provider_id)',
+         "The MoMo transaction ID must be unique per provider."),
+    ]
 
     @api.model
     def create(self, vals):
@@ -33,6 +45,8 @@ class PaymentTransaction(models.Model):
         transaction = super().create(vals)
         return transaction
 
+    @profiling.profiled('rendering', lambda tx, *args, **kwargs: tx.provider_id.filtered(
+        lambda provider: provider.code == 'momo'))
     def _get_specific_rendering_values(self, processing_values):
         """Override to return MoMo-specific rendering values."""
         self.ensure_one()
@@ -50,7 +64,10 @@ class PaymentTransaction(models.Model):
         # Create URLs
         ipn_url = urls.url_join("https://pay-dev.t4tek.tk", MoMoController._ipn_url)
         redirect_url = urls.url_join("https://pay-dev.t4tek.tk", MoMoController._return_url)
-        _logger.info("Generated MoMo URLs - IPN: %s, Redirect: %s", ipn_url, redirect_url)
+        if self.provider_id._momo_uses_emulator():
+            # Emulator gọi IPN trực tiếp về Odoo
+            ipn_url = urls.url_join(base_url, MoMoController._ipn_url)
+            redirect_url = urls.url_join(base_url, MoMoController._return_url)
 
         # Prepare parameters for MoMo API request
         params = {
@@ -72,17 +89,10 @@ class PaymentTransaction(models.Model):
             'accessKey', 'amount', 'extraData', 'ipnUrl', 'orderId',
             'orderInfo', 'partnerCode', 'redirectUrl', 'requestId', 'requestType'
         ]
-        signature_items = [f"{key}={params[key]}" for key in signature_keys]
-        signature_base = "&".join(signature_items)
-
         # Tạo chữ ký bằng thuật toán HMAC-SHA256
-        h = hmac.new(
-            bytes(self.provider_id.momo_secret_key, 'utf-8'),
-            bytes(signature_base, 'utf-8'),
-            hashlib.sha256
-        )
-        signature = h.hexdigest()
+        signature = get_signer(self.provider_id.momo_secret_key).sign_fields(params, signature_keys)
         params['signature'] = signature
+        gateway_log.log_event('create_order_request', reference=self.reference, params=params)
 
         # Record query start time for later status checks
         self.momo_query_start_time = fields.Datetime.now()
@@ -95,14 +105,15 @@ class PaymentTransaction(models.Model):
                 'Content-Length': str(len(json.dumps(params)))
             }
 
-            response = requests.post(
+            _response, response_data = self.provider_id._get_momo_http_client().post_json(
                 endpoint,
+                'create_order',
+                provider=self.provider_id.id,
                 json=params,
                 headers=headers
             )
 
-            response_data = response.json()
-            _logger.info("MoMo payment request response: %s", response_data)
+            gateway_log.log_event('create_order_response', reference=self.reference, response=response_data)
 
             # Kiểm tra nếu request thành công
             if response_data.get('resultCode') == 0:
@@ -136,47 +147,145 @@ class PaymentTransaction(models.Model):
             _logger.warning("MoMo notification missing signature")
             return False
 
-        received_signature = notification_data.get('signature')
-        secret_key = self.provider_id.momo_secret_key
-
         # Lấy accessKey từ cấu hình nếu không có trong dữ liệu thông báo
-        if 'accessKey' not in notification_data and self.provider_id.momo_access_key:
-            notification_data['accessKey'] = self.provider_id.momo_access_key
-
-        # Lấy danh sách trường từ tài liệu MoMo
-        expected_fields = [
-            'accessKey', 'amount', 'extraData', 'message', 'orderId',
-            'orderInfo', 'orderType', 'partnerCode', 'payType',
-            'requestId', 'responseTime', 'resultCode', 'transId'
+        result = get_signer(self.provider_id.momo_secret_key).verify_ipn(
+            notification_data, access_key=self.provider_id.momo_access_key
+        )
+        gateway_log.log_event('signature_checked', logging.INFO if result else logging.WARNING,
+                              reference=self.reference, valid=result)
+        return result
+
+    def _accept_momo_gateway_state(self, result_code, response_time=None):
+        """Record the rank and time of a MoMo result, unless it is older than the applied state.
+
+        Returns:
+            False if the result is stale and must be dropped, True otherwise
+        """
+        self.ensure_one()
+        rank = const.GATEWAY_STATE_RANKS.get(result_code, const.GATEWAY_STATE_RANK_FINAL)
+        response_time = float(response_time or 0)
+        if (rank, response_time) < (self.momo_gateway_state_rank, self.momo_response_time):
+            _logger.info("Dropped stale MoMo result %s for %s", result_code, self.reference)
+            return False
+        if (rank, response_time) > (self.momo_gateway_state_rank, self.momo_response_time):
+            self.write({'momo_gateway_state_rank': rank, 'momo_response_time': response_time})
+        return True
+
+    def _schedule_momo_post_processing(self):
+        """Wake up the batched post-processing job for the transactions whose provider defers it.
+
+        The other transactions are left to Odoo: the payment status page and the standard
+        post-processing cron post-process them.
+        """
+        if any(tx.provider_id.momo_defer_post_processing for tx in self):
+            trigger_cron_at(self.env, 'momo_odoo.ir_cron_post_process_momo_transactions', [fields.Datetime.now()])
+
+    @api.model
+    @metrics.timed('cron_seconds', cron='post_process')
+    def _cron_post_process_momo_transactions(self, batch_size=None):
+        """Post-process the confirmed MoMo transactions of the providers deferring it, in batches.
+
+        Transactions are handled in batches, each committed on its own. Transactions locked by
+        another worker, e.g. by the customer polling the payment status, are left to it.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not batch_size:
+            batch_size = int(ICP.get_param('momo_odoo.post_process_batch_size', const.POST_PROCESS_BATCH_SIZE))
+        chunk_size = int(ICP.get_param('momo_odoo.post_process_chunk_size', const.POST_PROCESS_CHUNK_SIZE))
+        domain = [
+            ('provider_id.code', '=', 'momo'),
+            ('provider_id.momo_defer_post_processing', '=', True),
+            ('state', '=', 'done'),
+            ('is_post_processed', '=', False),
+            ('last_state_change', '>=', fields.Datetime.now() - timedelta(days=const.POST_PROCESS_MAX_AGE_DAYS)),
         ]
 
-        # Tạo chuỗi signature theo đúng định dạng từ tài liệu MoMo
-        raw_signature = ""
-        for field in sorted(expected_fields):
-            if field in notification_data and notification_data[field] is not None:
-                if raw_signature:
-                    raw_signature += "&"
-                raw_signature += f"{field}={notification_data[field]}"
-
-        # Log để debug
-        _logger.info("Raw signature string: %s", raw_signature)
-
-        # Generate HMAC-SHA256 signature
-        h = hmac.new(
-            bytes(secret_key, 'utf-8'),
-            bytes(raw_signature, 'utf-8'),
-            hashlib.sha256
-        )
-        calculated_signature = h.hexdigest()
+        skipped_ids = []
+        processed_count = 0
+        while True:
+            txs = self.search(domain + [('id', 'not in', skipped_ids)], limit=batch_size, order='id')
+            if not txs:
+                break
+            locked = self.browse(locking.try_lock(self.env.cr, self._table, txs.ids))
+            skipped_ids += (txs - locked).ids
+            try:
+                processed = locked._post_process_momo_batch(chunk_size)
+                self.env.cr.commit()
+                processed_count += len(processed)
+                skipped_ids += (locked - processed).ids
+            except Exception as e:
+                _logger.exception("Error post-processing %s MoMo transactions: %s", len(locked), str(e))
+                self.env.cr.rollback()
+                skipped_ids += locked.ids
+            if len(txs) < batch_size:
+                break
 
-        # Log để debug
-        _logger.info("Received signature: %s", received_signature)
-        _logger.info("Calculated signature: %s", calculated_signature)
+        if processed_count or skipped_ids:
+            _logger.info("Post-processed %s MoMo transactions, %s skipped", processed_count, len(skipped_ids))
 
-        # Compare signatures securely
-        result = hmac.compare_digest(received_signature, calculated_signature)
-        _logger.info("Signature verification result: %s", "Success" if result else "Failed")
-        return result
+    def _post_process_momo_batch(self, chunk_size):
+        """Post-process transactions grouped by company and partner, chunk by chunk.
+
+        The sale orders and invoices of all the transactions are fetched with a few bulk queries
+        beforehand, so that post-processing reads them from the cache instead of querying them
+        transaction by transaction. Each chunk runs in its own savepoint; the transactions of a
+        chunk that fails are post-processed one by one.
+
+        Returns:
+            The transactions that were post-processed
+        """
+        self.fetch(['company_id', 'partner_id', 'amount', 'currency_id', 'operation', 'state'])
+        orders = self.sale_order_ids
+        orders.fetch(['state', 'amount_total', 'currency_id', 'partner_id', 'company_id'])
+        orders.order_line.fetch(['product_id', 'product_uom_qty', 'qty_invoiced', 'price_unit'])
+        self.invoice_ids.fetch(['state', 'move_type', 'amount_residual', 'payment_state'])
+
+        groups = defaultdict(list)
+        for tx in self:
+            groups[tx.company_id, tx.partner_id].append(tx.id)
+
+        processed_ids = []
+        for (company, _partner), tx_ids in groups.items():
+            for chunk in split_every(chunk_size, tx_ids, self.with_company(company).browse):
+                try:
+                    with self.env.cr.savepoint():
+                        chunk._post_process()
+                    processed_ids += chunk.ids
+                except Exception as e:
+                    _logger.warning("Error post-processing %s MoMo transactions together, "
+                                    "retrying them one by one: %s", len(chunk), str(e))
+                    for tx in chunk:
+                        try:
+                            with self.env.cr.savepoint():
+                                tx._post_process()
+                            processed_ids.append(tx.id)
+                        except Exception as e:
+                            _logger.exception("Error post-processing transaction %s: %s", tx.reference, str(e))
+        return self.browse(processed_ids)
+
+    @api.model
+    def _get_tx_from_momo_transaction_id(self, momo_transaction_id, provider=None):
+        """Find the transaction with the given MoMo transId.
+
+        The search is served by the unique index on (momo_transaction_id, provider_id).
+        """
+        if not momo_transaction_id:
+            return self.browse()
+        domain = [('momo_transaction_id', '=', str(momo_transaction_id))]
+        if provider:
+            domain.append(('provider_id', '=', provider.id))
+        return self.search(domain, limit=1)
+
+    @api.model
+    def _get_tx_from_momo_request_id(self, request_id):
+        """Find the transaction of a MoMo requestId through its pending or retry record"""
+        if not request_id:
+            return self.browse()
+        for model_name in ('momo.transaction.pending', 'momo.transaction.retry'):
+            record = self.env[model_name].sudo().search([('momo_request_id', '=', request_id)], limit=1)
+            if record:
+                return record.transaction_id.with_env(self.env)
+        return self.browse()
 
     # def _get_tx_from_notification_data(self, provider_code, notification_data):
     #     """Override to find the transaction based on MoMo data."""
@@ -0,0 +1,359 @@
+"""Local MoMo gateway emulator for offline development and load tests.
+
+Implements the create and query endpoints of the MoMo v2 gateway, with configurable latency,
+HTTP failures and outcome distribution, and fires signed IPNs back at the `ipnUrl` of each
+order, like MoMo does.
+
+The emulator only uses the standard library; it signs with the module's own signer so that its
+signatures always match what the module verifies.
+
+Usage:
+    python momo_odoo/scripts/momo_emulator.py --access-key KEY --secret-key SECRET --port 8079 \\
+        --latency 20:80 --ipn-delay 1:3 --ipn-codes 0=0.9,1006=0.05,9000=0.05 --http-errors 503=0.01
+
+Then set the Emulator URL of the MoMo provider (test mode) to http://localhost:8079.
+Counters are served as JSON on GET /_emulator/stats.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_logger = logging.getLogger('momo_emulator')
+
+# Dùng cùng đường dẫn API với module (const.py)
+CREATE_PAYMENT_PATH = "/v2/gateway/api/create"
+CHECK_STATUS_PATH = "/v2/gateway/api/query"
+STATS_PATH = "/_emulator/stats"
+
+# Các trường được ký của request, theo thứ tự ký
+CREATE_SIGNATURE_FIELDS = (
+    'accessKey', 'amount', 'extraData', 'ipnUrl', 'orderId',
+    'orderInfo', 'partnerCode', 'redirectUrl', 'requestId', 'requestType',
+)
+QUERY_SIGNATURE_FIELDS = ('accessKey', 'orderId', 'partnerCode', 'requestId')
+CREATE_RESPONSE_SIGNATURE_FIELDS = (
+    'accessKey', 'amount', 'message', 'orderId', 'partnerCode',
+    'payUrl', 'requestId', 'responseTime', 'resultCode',
+)
+
+RESULT_CODE_PENDING = 1000
+MESSAGES = {
+    0: "Successful.",
+    9000: "Transaction is authorized successfully.",
+    1000: "Transaction is initiated, waiting for user confirmation.",
+    1003: "Transaction is canceled.",
+    1005: "Transaction failed because the url or QR code expired.",
+    1006: "Transaction failed because user has denied to confirm the payment.",
+    11: "Access denied.",
+    40: "Duplicated requestId.",
+    41: "Duplicated orderId.",
+    42: "Invalid orderId or orderId is not found.",
+    99: "Unknown error.",
+}
+
+
+def _load_signature_module():
+    """Load the signature tools of the module without importing Odoo"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools', 'signature.py')
+    spec = importlib.util.spec_from_file_location('momo_signature', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_range(value):
+    """Parse 'MIN:MAX' (or a single value) into a (min, max) tuple of floats"""
+    low, _sep, high = value.partition(':')
+    return float(low), float(high or low)
+
+
+def parse_distribution(value):
+    """Parse 'code=weight,code=weight' into a list of (code, weight)"""
+    distribution = []
+    for item in filter(None, value.split(',')):
+        code, _sep, weight = item.partition('=')
+        distribution.append((int(code), float(weight or 1)))
+    return distribution
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class Emulator:
+    """State of the emulated gateway: orders, IPN queue and counters"""
+
+    def __init__(self, options):
+        self.options = options
+        signature = _load_signature_module()
+        self.signer = signature.MoMoSigner(options.secret_key)
+        self.ipn_signature_fields = signature.IPN_SIGNATURE_FIELDS
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.ipn_queue = queue.Queue()
+        self.ipn_codes = parse_distribution(options.ipn_codes)
+        self.http_errors = parse_distribution(options.http_errors)
+
+    # Helpers
+
+    def sleep_latency(self):
+        low, high = parse_range(self.options.latency)
+        time.sleep(random.uniform(low, high) / 1000)
+
+    def draw_http_error(self):
+        """Return an HTTP status to fail with, or None"""
+        draw = random.random()
+        for status, probability in self.http_errors:
+            if draw < probability:
+                return status
+            draw -= probability
+        return None
+
+    def draw_ipn_code(self):
+        codes, weights = zip(*self.ipn_codes)
+        return random.choices(codes, weights)[0]
+
+    def check_signature(self, params, keys):
+        if not self.options.check_signature:
+            return True
+        if any(key not in params for key in keys):
+            return False
+        return self.signer.sign_fields(params, keys) == params.get('signature')
+
+    def sign_ipn_fields(self, data):
+        """Sign like MoMo signs IPNs and query responses: the fields present, accessKey included"""
+        data = dict(data, accessKey=self.options.access_key)
+        return self.signer.sign("&".join(
+            f"{field}={data[field]}" for field in self.ipn_signature_fields if data.get(field) is not None
+        ))
+
+    @staticmethod
+    def error(params, result_code):
+        return 200, {
+            'partnerCode': params.get('partnerCode'),
+            'orderId': params.get('orderId'),
+            'requestId': params.get('requestId'),
+            'responseTime': now_ms(),
+            'resultCode': result_code,
+            'message': MESSAGES[result_code],
+        }
+
+    # Endpoints
+
+    def create(self, params):
+        self.stats['create'] += 1
+        if not self.check_signature(params, CREATE_SIGNATURE_FIELDS):
+            self.stats['create_bad_signature'] += 1
+            return self.error(params, 11)
+
+        order_id = params.get('orderId')
+        ipn_delay = random.uniform(*parse_range(self.options.ipn_delay))
+        order = {
+            'partnerCode': params.get('partnerCode'),
+            'orderId': order_id,
+            'requestId': params.get('requestId'),
+            'amount': int(params.get('amount') or 0),
+            'orderInfo': params.get('orderInfo'),
+            'extraData': params.get('extraData', ''),
+            'ipnUrl': self.options.ipn_url or params.get('ipnUrl'),
+            'outcome': self.draw_ipn_code(),
+            'transId': random.randint(10 ** 9, 10 ** 10 - 1),
+            'notify_at': time.monotonic() + ipn_delay,
+        }
+        with self.lock:
+            if order_id in self.orders:
+                return self.error(params, 41)
+            self.orders[order_id] = order
+        if not self.options.no_ipn and order['ipnUrl']:
+            for _i in range(1 + self.options.ipn_redeliveries):
+                self.ipn_queue.put((order['notify_at'], order))
+
+        pay_url = f"http://{self.options.host}:{self.options.port}/pay/{order['transId']}"
+        response = {
+            'partnerCode': order['partnerCode'],
+            'orderId': order_id,
+            'requestId': order['requestId'],
+            'amount': order['amount'],
+            'responseTime': now_ms(),
+            'message': MESSAGES[0],
+            'resultCode': 0,
+            'payUrl': pay_url,
+            'deeplink': f"momo://pay/{order['transId']}",
+            'qrCodeUrl': pay_url,
+        }
+        response['signature'] = self.signer.sign_fields(
+            dict(response, accessKey=self.options.access_key), CREATE_RESPONSE_SIGNATURE_FIELDS
+        )
+        return 200, response
+
+    def query(self, params):
+        self.stats['query'] += 1
+        if not self.check_signature(params, QUERY_SIGNATURE_FIELDS):
+            return self.error(params, 11)
+        with self.lock:
+            order = self.orders.get(params.get('orderId'))
+            if not order and self.options.accept_unknown_orders:
+                # Đơn không tạo qua emulator (vd. dữ liệu benchmark): kết quả rút ngẫu nhiên ngay
+                order = self.orders[params.get('orderId')] = {
+                    'partnerCode': params.get('partnerCode'),
+                    'orderId': params.get('orderId'),
+                    'extraData': '',
+                    'amount': 0,
+                    'outcome': self.draw_ipn_code(),
+                    'transId': random.randint(10 ** 9, 10 ** 10 - 1),
+                    'notify_at': time.monotonic(),
+                }
+        if not order:
+            return self.error(params, 42)
+
+        result_code = RESULT_CODE_PENDING if time.monotonic() < order['notify_at'] else order['outcome']
+        response = {
+            'partnerCode': order['partnerCode'],
+            'orderId': order['orderId'],
+            'requestId': params.get('requestId'),
+            'extraData': order['extraData'],
+            'amount': order['amount'],
+            'transId': order['transId'],
+            'payType': 'qr',
+            'resultCode': result_code,
+            'message': MESSAGES.get(result_code, MESSAGES[99]),
+            'responseTime': now_ms(),
+        }
+        response['signature'] = self.sign_ipn_fields(response)
+        return 200, response
+
+    # IPN
+
+    def build_ipn(self, order):
+        notification = {
+            'partnerCode': order['partnerCode'],
+            'orderId': order['orderId'],
+            'requestId': order['requestId'],
+            'amount': order['amount'],
+            'orderInfo': order['orderInfo'],
+            'orderType': 'momo_wallet',
+            'transId': order['transId'],
+            'resultCode': order['outcome'],
+            'message': MESSAGES.get(order['outcome'], MESSAGES[99]),
+            'payType': 'qr',
+            'responseTime': now_ms(),
+            'extraData': order['extraData'],
+        }
+        notification['signature'] = self.sign_ipn_fields(notification)
+        return notification
+
+    def send_ipn(self, order):
+        body = json.dumps(self.build_ipn(order)).encode()
+        request = urllib.request.Request(order['ipnUrl'], data=body, headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.options.ipn_timeout) as response:
+                response.read()
+                self.stats[f"ipn_{response.status}"] += 1
+        except Exception as e:
+            self.stats['ipn_failed'] += 1
+            _logger.warning("IPN for %s failed: %s", order['orderId'], e)
+        finally:
+            with self.lock:
+                self.stats['ipn_total_ms'] += int((time.perf_counter() - start) * 1000)
+
+    def ipn_worker(self):
+        while True:
+            notify_at, order = self.ipn_queue.get()
+            delay = notify_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.send_ipn(order)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    emulator = None
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == STATS_PATH:
+            return self._reply(200, dict(self.emulator.stats, orders=len(self.emulator.orders)))
+        return self._reply(404, {'message': "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = json.loads(self.rfile.read(length).decode() or '{}') if length else {}
+
+        routes = {
+            CREATE_PAYMENT_PATH: self.emulator.create,
+            CHECK_STATUS_PATH: self.emulator.query,
+        }
+        route = routes.get(self.path)
+        if not route:
+            return self._reply(404, {'message': "Not found"})
+
+        self.emulator.sleep_latency()
+        error_status = self.emulator.draw_http_error()
+        if error_status:
+            self.emulator.stats[f"http_{error_status}"] += 1
+            return self._reply(error_status, {'message': "Emulated failure"})
+        return self._reply(*route(params))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8079)
+    parser.add_argument('--access-key', required=True, help="access key configured on the provider")
+    parser.add_argument('--secret-key', required=True, help="secret key configured on the provider")
+    parser.add_argument('--latency', default='20:80', help="API latency range in milliseconds, MIN:MAX")
+    parser.add_argument('--http-errors', default='', help="HTTP failure probabilities, e.g. 503=0.01,504=0.005")
+    parser.add_argument('--ipn-codes', default='0=1', help="IPN resultCode distribution, e.g. 0=0.9,1006=0.1")
+    parser.add_argument('--ipn-delay', default='1:3', help="delay before the IPN in seconds, MIN:MAX")
+    parser.add_argument('--ipn-url', help="send the IPNs here instead of the ipnUrl of the orders")
+    parser.add_argument('--ipn-redeliveries', type=int, default=0, help="extra deliveries of every IPN")
+    parser.add_argument('--ipn-workers', type=int, default=8, help="IPNs sent at the same time")
+    parser.add_argument('--ipn-timeout', type=float, default=10)
+    parser.add_argument('--no-ipn', action='store_true', help="never send IPNs (status queries only)")
+    parser.add_argument('--accept-unknown-orders', action='store_true',
+                        help="answer queries of orders not created here with an outcome from --ipn-codes")
+    parser.add_argument('--no-check-signature', dest='check_signature', action='store_false',
+                        help="accept any request signature")
+    parser.add_argument('--log-level', default='INFO')
+    options = parser.parse_args()
+    logging.basicConfig(level=options.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    emulator = Emulator(options)
+    for _i in range(options.ipn_workers):
+        threading.Thread(target=emulator.ipn_worker, daemon=True).start()
+
+    Handler.emulator = emulator
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    _logger.info("MoMo emulator listening on http://%s:%s", options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _logger.info("Stats: %s", dict(emulator.stats))
+
+
+if __name__ == '__main__':
+    main()
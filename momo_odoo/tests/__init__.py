@@ -0,0 +1 @@
+from . import test_ipn, test_retry_queue, test_tools
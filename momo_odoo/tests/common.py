@@ -0,0 +1,17 @@
+from odoo.addons.payment.tests.common import PaymentCommon
+
+
+class MoMoCommon(PaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.momo = cls._prepare_provider('momo', update_values={
+            'momo_partner_code': 'MOMOTEST',
+            'momo_access_key': 'test_access_key',
+            'momo_secret_key': 'test_secret_key',
+        })
+        cls.provider = cls.momo
+
+    def _create_momo_transaction(self, reference):
+        return self._create_transaction('redirect', reference=reference)
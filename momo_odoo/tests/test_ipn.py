@@ -0,0 +1,105 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.momo_odoo import const
+from odoo.addons.momo_odoo.tests.common import MoMoCommon
+from odoo.addons.momo_odoo.tools.signature import IPN_SIGNATURE_FIELDS, get_signer
+
+
+@tagged('post_install', '-at_install')
+class TestMoMoIPN(MoMoCommon):
+
+    def _notification(self, **values):
+        return {
+            'orderId': self.reference,
+            'transId': 4088878653,
+            'resultCode': 0,
+            **values,
+        }
+
+    def test_redelivered_notification_is_registered_once(self):
+        Ledger = self.env['momo.ipn.ledger']
+        notification = self._notification()
+        self.assertTrue(Ledger._register_notification(self.momo.id, notification))
+        self.assertFalse(Ledger._register_notification(self.momo.id, notification))
+        # Một kết quả khác của cùng giao dịch là một thông báo mới
+        self.assertTrue(Ledger._register_notification(self.momo.id, self._notification(resultCode=1000)))
+
+    def test_notification_without_transaction_number_is_always_accepted(self):
+        Ledger = self.env['momo.ipn.ledger']
+        notification = self._notification(transId='')
+        self.assertTrue(Ledger._register_notification(self.momo.id, notification))
+        self.assertTrue(Ledger._register_notification(self.momo.id, notification))
+
+    def test_forgotten_notification_is_only_accepted_again_for_its_provider(self):
+        Ledger = self.env['momo.ipn.ledger']
+        other_provider = self.momo.copy()
+        notification = self._notification()
+        Ledger._register_notification(self.momo.id, notification)
+        Ledger._register_notification(other_provider.id, notification)
+
+        Ledger._forget_notification(self.momo.id, notification)
+        self.assertTrue(Ledger._register_notification(self.momo.id, notification))
+        self.assertFalse(Ledger._register_notification(other_provider.id, notification))
+
+    def test_signing_keys_follow_created_and_deleted_providers(self):
+        Provider = self.env['payment.provider']
+        notification = self._notification(partnerCode='MOMOOTHER', accessKey='other_access_key')
+        notification['signature'] = get_signer('other_secret_key').sign("&".join(
+            f"{field}={notification[field]}" for field in IPN_SIGNATURE_FIELDS if field in notification
+        ))
+        self.assertIsNone(Provider._verify_momo_notification(notification))
+
+        other_provider = Provider.create({
+            'name': "MoMo (other)",
+            'code': 'momo',
+            'state': 'test',
+            'momo_partner_code': 'MOMOOTHER',
+            'momo_access_key': 'other_access_key',
+            'momo_secret_key': 'other_secret_key',
+        })
+        self.assertEqual(Provider._verify_momo_notification(notification), other_provider.id)
+
+        other_provider.unlink()
+        self.assertIsNone(Provider._verify_momo_notification(notification))
+
+    def test_older_gateway_state_is_dropped(self):
+        tx = self._create_momo_transaction(self.reference)
+        self.assertTrue(tx._accept_momo_gateway_state(1000, 1700000000000))
+        self.assertEqual(tx.momo_gateway_state_rank, const.GATEWAY_STATE_RANK_PENDING)
+        # Cùng hạng nhưng cũ hơn
+        self.assertFalse(tx._accept_momo_gateway_state(7000, 1600000000000))
+        self.assertTrue(tx._accept_momo_gateway_state(0, 1700000001000))
+        self.assertEqual(tx.momo_gateway_state_rank, const.GATEWAY_STATE_RANK_FINAL)
+        self.assertFalse(tx._accept_momo_gateway_state(9000, 1700000002000))
+        self.assertEqual(tx.momo_gateway_state_rank, const.GATEWAY_STATE_RANK_FINAL)
+
+    def test_process_again_resets_the_attempts(self):
+        notification = self.env['momo.ipn.inbox']._enqueue_notification(self.momo.id, self._notification())
+        notification.write({'state': 'error', 'attempts': const.IPN_MAX_ATTEMPTS, 'error_message': "Failed"})
+
+        notification.action_process_again()
+        self.assertRecordValues(notification, [{
+            'provider_id': self.momo.id,
+            'state': 'new',
+            'attempts': 0,
+            'next_attempt': False,
+            'error_message': False,
+        }])
+
+    def test_failed_notification_is_forgotten_after_the_last_attempt(self):
+        Ledger = self.env['momo.ipn.ledger']
+        payload = self._notification()
+        Ledger._register_notification(self.momo.id, payload)
+        notification = self.env['momo.ipn.inbox']._enqueue_notification(self.momo.id, payload)
+        notification.attempts = const.IPN_MAX_ATTEMPTS - 1
+
+        pending_model = type(self.env['momo.transaction.pending'])
+        with patch.object(pending_model, '_handle_ipn_notification_data', side_effect=ValueError("Failed")):
+            processed = notification._process_notifications()
+
+        self.assertFalse(processed)
+        self.assertEqual(notification.state, 'error')
+        # Cổng thanh toán có thể gửi lại thông báo
+        self.assertTrue(Ledger._register_notification(self.momo.id, payload))
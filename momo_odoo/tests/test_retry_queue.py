@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.momo_odoo import const
+from odoo.addons.momo_odoo.tests.common import MoMoCommon
+
+
+@tagged('post_install', '-at_install')
+class TestMoMoRetryQueue(MoMoCommon):
+
+    def setUp(self):
+        super().setUp()
+        # Các claim được commit ngay để các worker khác thấy: không commit trong test
+        self.patch(self.env.cr, 'commit', lambda: None)
+        self.now = fields.Datetime.now()
+
+    def _create_retry(self, reference, next_retry, **values):
+        tx = self._create_momo_transaction(reference)
+        retry = self.env['momo.transaction.retry'].create_retry_transaction(tx)
+        retry.write({'next_retry': next_retry, **values})
+        return retry
+
+    def test_claim_only_takes_due_records_once(self):
+        due = self._create_retry('TEST-DUE', self.now - timedelta(minutes=1))
+        later = self._create_retry('TEST-LATER', self.now + timedelta(hours=1))
+        claimed_elsewhere = self._create_retry('TEST-CLAIMED', self.now - timedelta(minutes=1), state='processing')
+        retries = due | later | claimed_elsewhere
+
+        claimed = self.env['momo.transaction.retry']._claim_due_retries(const.RETRY_BATCH_SIZE)
+        self.assertEqual(claimed & retries, due)
+        self.assertEqual(due.state, 'processing')
+        self.assertTrue(due.claim_time)
+
+        claimed = self.env['momo.transaction.retry']._claim_due_retries(const.RETRY_BATCH_SIZE)
+        self.assertFalse(claimed & retries)
+
+    def test_stale_claims_are_released(self):
+        stale = self._create_retry('TEST-STALE', self.now, state='processing',
+                                   claim_time=self.now - timedelta(minutes=const.RETRY_CLAIM_TIMEOUT + 1))
+        recent = self._create_retry('TEST-RECENT', self.now, state='processing', claim_time=self.now)
+
+        self.env['momo.transaction.retry']._release_stale_claims()
+        self.assertRecordValues(stale | recent, [
+            {'state': 'retry', 'claim_time': False},
+            {'state': 'processing', 'claim_time': self.now},
+        ])
+
+    def test_transition_skips_records_in_another_state(self):
+        retry = self._create_retry('TEST-TRANSITION', self.now)
+        self.assertFalse(retry._try_transition('processing', {'state': 'retry'}))
+        self.assertEqual(retry._try_transition('retry', {'state': 'processing'}), retry)
+        self.assertEqual(retry.state, 'processing')
+
+    def test_older_status_answer_drops_the_retry(self):
+        retry = self._create_retry('TEST-OLDER', self.now, state='processing')
+        tx = retry.transaction_id
+        # Một IPN đã áp dụng trạng thái cuối cùng
+        tx._accept_momo_gateway_state(0, 1700000001000)
+        tx._set_done()
+
+        self.assertFalse(retry._process_momo_response({'resultCode': 1000, 'responseTime': 1700000000000}))
+        self.assertFalse(retry.exists())
+        self.assertEqual(tx.state, 'done')
+
+    def test_query_error_keeps_the_retry(self):
+        retry = self._create_retry('TEST-DUPLICATE', self.now, state='processing')
+        retry.transaction_id._accept_momo_gateway_state(1000, 1700000000000)
+
+        # Lỗi của chính truy vấn (trùng requestId) không phải trạng thái giao dịch
+        self.assertFalse(retry._process_momo_response({'resultCode': 40}))
+        self.assertTrue(retry.exists())
+        self.assertEqual(retry.state, 'retry')
+        self.assertEqual(retry.transaction_id.momo_gateway_state_rank, const.GATEWAY_STATE_RANK_PENDING)
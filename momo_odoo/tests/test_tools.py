@@ -0,0 +1,100 @@
+import threading
+import time
+
+from odoo.tests import TransactionCase, tagged
+
+from odoo.addons.momo_odoo.tools import gateway_log, locking, metrics, single_flight
+
+
+@tagged('post_install', '-at_install')
+class TestMoMoTools(TransactionCase):
+
+    def test_locking_only_returns_rows_matching_the_condition(self):
+        partners = self.env['res.partner'].create([{'name': "Active"}, {'name': "Archived", 'active': False}])
+        partners.flush_recordset()
+        table = self.env['res.partner']._table
+
+        self.assertEqual(locking.try_lock(self.env.cr, table, partners.ids, "active = %s", (True,)), partners[0].ids)
+        updated = locking.try_update(self.env.cr, table, partners.ids, {'comment': "Updated"}, "active = %s", (False,))
+        self.assertEqual(updated, partners[1].ids)
+        self.assertEqual(locking.try_lock(self.env.cr, table, []), [])
+
+    def test_single_flight_coalesces_concurrent_calls(self):
+        flight = single_flight.SingleFlight(ttl=60)
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def query():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'calls': len(calls)}
+
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', query)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(flight.do('key', query)))
+        follower.start()
+        # Chờ lệnh gọi thứ hai tham gia lệnh gọi đang chạy
+        time.sleep(0.1)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [({'calls': 1}, None)] * 2)
+
+    def test_single_flight_only_caches_accepted_results(self):
+        flight = single_flight.SingleFlight(ttl=60, cache_if=lambda result: result == 'final')
+        answers = iter(['pending', 'final', 'other'])
+        self.assertEqual(flight.do('key', lambda: next(answers)), ('pending', None))
+        self.assertEqual(flight.do('key', lambda: next(answers)), ('final', None))
+        self.assertEqual(flight.do('key', lambda: next(answers)), ('final', None))
+
+    def test_single_flight_returns_the_error(self):
+        error = ValueError("Failed")
+
+        def query():
+            raise error
+
+        self.assertEqual(single_flight.SingleFlight(ttl=60).do('key', query), (None, error))
+
+    def test_metric_labels_are_sorted_and_escaped(self):
+        self.assertEqual(
+            metrics.MetricsRecorder._labels({'result': '00', 'operation': 'status_query', 'provider': 7}),
+            'operation="status_query",provider="7",result="00"',
+        )
+        self.assertEqual(metrics.MetricsRecorder._labels({'message': 'a "b"\n'}), 'message="a \\"b\\"\\n"')
+
+    def test_prometheus_histograms_are_cumulative(self):
+        Metric = self.env['momo.gateway.metric']
+        labels = 'operation="test_operation",provider="0",result="00"'
+        Metric._add_samples([
+            ('gateway_request_seconds', labels, '0.1', 2),
+            ('gateway_request_seconds', labels, '0.5', 1),
+            ('gateway_request_seconds', labels, 'sum', 0.5),
+        ])
+        # Các mẫu của worker khác được cộng vào cùng dòng
+        Metric._add_samples([('gateway_request_seconds', labels, '0.1', 1)])
+
+        lines = Metric._render_prometheus().splitlines()
+        self.assertIn('# TYPE momo_gateway_request_seconds histogram', lines)
+        self.assertIn(f'momo_gateway_request_seconds_bucket{{{labels},le="0.1"}} 3', lines)
+        self.assertIn(f'momo_gateway_request_seconds_bucket{{{labels},le="0.25"}} 3', lines)
+        self.assertIn(f'momo_gateway_request_seconds_bucket{{{labels},le="+Inf"}} 4', lines)
+        self.assertIn(f'momo_gateway_request_seconds_sum{{{labels}}} 0.5', lines)
+        self.assertIn(f'momo_gateway_request_seconds_count{{{labels}}} 4', lines)
+
+    def test_secrets_are_redacted_in_nested_values(self):
+        self.assertEqual(
+            gateway_log.redact({
+                'signature': 'abc',
+                'headers': {'Authorization': 'Basic xyz', 'Accept': '*/*'},
+                'items': [{'secretKey': 'secret', 'amount': 1000}],
+            }),
+            {
+                'signature': '***',
+                'headers': {'Authorization': '***', 'Accept': '*/*'},
+                'items': [{'secretKey': '***', 'amount': 1000}],
+            },
+        )
@@ -0,0 +1,104 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from odoo.addons.momo_odoo import const
+
+# Logger riêng cho các sự kiện cổng thanh toán: có thể chỉnh mức log bằng --log-handler
+_event_logger = logging.getLogger('odoo.addons.momo_odoo.gateway')
+
+_REDACTED_KEYS = frozenset(key.lower() for key in const.LOG_REDACTED_KEYS)
+_setup_lock = threading.Lock()
+_setup_pid = None
+
+
+def redact(value):
+    """Return a copy of the value with the secrets of every nested dictionary masked"""
+    if isinstance(value, dict):
+        return {key: '***' if str(key).lower() in _REDACTED_KEYS else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+class GatewayEvent:
+    """Message of a gateway event, rendered as one JSON line only when a handler formats it"""
+
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps({'event': self.event, **redact(self.fields)}, default=str, ensure_ascii=False)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that never formats in the calling thread and drops records when the queue is full"""
+
+    def prepare(self, record):
+        # Formatter của Odoo lấy tên cơ sở dữ liệu từ thread hiện tại: ghi lại trước khi chuyển thread
+        record.gateway_dbname = getattr(threading.current_thread(), 'dbname', '?')
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class _EventListener(QueueListener):
+
+    def handle(self, record):
+        threading.current_thread().dbname = getattr(record, 'gateway_dbname', '?')
+        super().handle(record)
+
+
+def _ensure_listener():
+    """Start the background thread writing the events, once per process"""
+    global _setup_pid
+    if _setup_pid == os.getpid():
+        return
+    with _setup_lock:
+        if _setup_pid == os.getpid():
+            return
+        # Worker được fork không kế thừa thread của tiến trình cha: tạo lại hàng đợi
+        event_queue = queue.Queue(const.LOG_QUEUE_SIZE)
+        listener = _EventListener(event_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        for handler in list(_event_logger.handlers):
+            _event_logger.removeHandler(handler)
+        _event_logger.addHandler(_NonBlockingQueueHandler(event_queue))
+        _event_logger.propagate = False
+        _setup_pid = os.getpid()
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """Log a gateway event as structured JSON.
+
+    Events below WARNING are sampled with the rate of `const.LOG_SAMPLE_RATES`. Nothing is
+    formatted in the calling thread: the secrets are masked and the JSON is rendered by the
+    background thread that writes the record.
+
+    Args:
+        event: Name of the event, e.g. 'ipn_received'
+        level: Logging level of the event
+        **fields: Data of the event; mappings are copied so that later changes are not logged
+    """
+    if not _event_logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING:
+        rate = const.LOG_SAMPLE_RATES.get(event, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return
+    _ensure_listener()
+    fields = {key: dict(value.items()) if hasattr(value, 'items') else value for key, value in fields.items()}
+    _event_logger.log(level, "%s", GatewayEvent(event, fields))
@@ -0,0 +1,56 @@
+from psycopg2 import errors
+
+
+def try_lock(cr, table, ids, where="TRUE", params=()):
+    """Lock rows matching a condition without waiting for other transactions.
+
+    Rows locked by another transaction, rows that no longer match `where` and rows changed by a
+    transaction committed after the current one started are left out instead of raising.
+
+    Returns:
+        List of the ids that were locked
+    """
+    if not ids:
+        return []
+    try:
+        with cr.savepoint(flush=False):
+            cr.execute(f"""
+                SELECT id FROM {table}
+                 WHERE id IN %s AND ({where})
+                   FOR UPDATE SKIP LOCKED
+            """, (tuple(ids), *params))
+            return [row[0] for row in cr.fetchall()]
+    except errors.SerializationFailure:
+        if len(ids) == 1:
+            return []
+        # Có bản ghi đã bị thay đổi sau khi transaction bắt đầu: thử lại từng bản ghi
+        return [record_id for record_id in ids if try_lock(cr, table, [record_id], where, params)]
+
+
+def try_update(cr, table, ids, values, where, params=()):
+    """Update the rows still matching a condition, i.e. `UPDATE ... WHERE <where> RETURNING id`.
+
+    Like try_lock, rows that another transaction is changing or has changed are skipped: the
+    caller that loses the race gets them back as not updated instead of an error.
+
+    Returns:
+        List of the ids that were updated
+    """
+    if not ids:
+        return []
+    columns = ", ".join(f'"{column}" = %s' for column in values)
+    try:
+        with cr.savepoint(flush=False):
+            cr.execute(f"""
+                UPDATE {table}
+                   SET {columns}
+                 WHERE id IN (
+                    SELECT id FROM {table}
+                     WHERE id IN %s AND ({where})
+                       FOR UPDATE SKIP LOCKED
+                 )
+             RETURNING id
+            """, (*values.values(), tuple(ids), *params))
+            return [row[0] for row in cr.fetchall()]
+    except errors.SerializationFailure:
+        return []
@@ -0,0 +1,56 @@
+import hashlib
+import hmac
+from functools import lru_cache
+
+# Fields of an IPN notification covered by its signature, in signing order
+IPN_SIGNATURE_FIELDS = (
+    'accessKey', 'amount', 'extraData', 'message', 'orderId',
+    'orderInfo', 'orderType', 'partnerCode', 'payType',
+    'requestId', 'responseTime', 'resultCode', 'transId',
+)
+
+
+class MoMoSigner:
+    """Sign and verify MoMo messages with HMAC-SHA256 for one secret key.
+
+    The HMAC state keyed with the secret is computed once and copied for every message.
+    """
+
+    __slots__ = ('_hmac',)
+
+    def __init__(self, secret_key):
+        self._hmac = hmac.new((secret_key or '').encode('utf-8'), digestmod=hashlib.sha256)
+
+    def sign(self, raw_signature):
+        """Compute the signature of an already built raw signature string."""
+        h = self._hmac.copy()
+        h.update(raw_signature.encode('utf-8'))
+        return h.hexdigest()
+
+    def sign_fields(self, params, keys):
+        """Compute the signature of the given keys of the parameters, in the given order."""
+        return self.sign("&".join(f"{key}={params[key]}" for key in keys))
+
+    def verify_ipn(self, notification_data, access_key=None):
+        """Check the signature of IPN notification data.
+
+        Args:
+            notification_data: The notification data received from MoMo
+            access_key: Access key to sign with when the notification does not contain one
+        """
+        received_signature = notification_data.get('signature')
+        if not received_signature:
+            return False
+        if 'accessKey' not in notification_data and access_key:
+            notification_data = dict(notification_data, accessKey=access_key)
+        raw_signature = "&".join(
+            f"{field}={notification_data[field]}" for field in IPN_SIGNATURE_FIELDS
+            if notification_data.get(field) is not None
+        )
+        return hmac.compare_digest(str(received_signature), self.sign(raw_signature))
+
+
+@lru_cache(maxsize=32)
+def get_signer(secret_key):
+    """Return the signer of a secret key, built once per process."""
+    return MoMoSigner(secret_key)